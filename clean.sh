@@ -2,4 +2,4 @@
 
 rm -rf __pycache__
 rm -rf screen_content_cache
-rm -f content_queue.bin
+rm -f content_queue.bin* content_queue.json content_queue.journal* content_stats.json
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Screen
+from .models import Screen, DesiredContent, ScreenContent
 
 
 admin.site.register(Screen)
+admin.site.register(DesiredContent)
+admin.site.register(ScreenContent)
@@ -73,3 +73,10 @@ class URLContentForm(ContentBaseForm):
     url = forms.URLField(label='URL', required=True,
                          help_text='The URL to display (as an embedded '
                                    'frame.)')
+    snapshot = forms.IntegerField(
+                    min_value=60, required=False,
+                    label='Snapshot max-age (seconds)',
+                    help_text='Show a local copy of the page, refreshed '
+                              'once it is this old, rather than loading '
+                              'the page each time it is shown.  Leave '
+                              'blank to always load the live page.')
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from screens.models import Screen
+
+
+class Command(BaseCommand):
+    help = "Ping screens and fetch their content listings, storing what " \
+           "is found for the controller's pages to show.  Run it " \
+           "periodically (e.g., from cron), or with --interval to keep " \
+           "polling."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'screens', nargs='*',
+            help="Names of screens to poll (default: all screens)")
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help="Poll again every this many seconds, until interrupted")
+        parser.add_argument(
+            '--deadline', type=float, default=None,
+            help="Seconds to wait for screens to answer (default: "
+                 f"{Screen.PING_DEADLINE})")
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.time()
+            screens = Screen.objects.all()
+            if options['screens']:
+                screens = screens.filter(name__in=options['screens'])
+            screens = list(screens)
+            Screen.poll_all(screens, deadline=options['deadline'])
+            if options['verbosity'] > 1:
+                for s in screens:
+                    state = f"{s.item_count} items" if s.isonline \
+                        else "not reachable"
+                    self.stdout.write(f"{s.name}: {state}")
+            if options['interval'] is None:
+                break
+            time.sleep(max(0, options['interval'] - (time.time() - start)))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+import requests
+from screens.models import Screen, ScreenNotAccessible
+
+
+class Command(BaseCommand):
+    help = "Bring the content on screens in line with the content the " \
+           "controller has recorded for them, sending only what is " \
+           "missing or out of date."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'screens', nargs='*',
+            help="Names of screens to sync (default: all screens)")
+        parser.add_argument(
+            '--no-prune', action='store_false', dest='prune',
+            help="Don't delete content the controller no longer wants")
+
+    def handle(self, *args, **options):
+        screens = Screen.objects.all()
+        if options['screens']:
+            screens = screens.filter(name__in=options['screens'])
+        for s in screens:
+            try:
+                success, reason, results = s.sync(prune=options['prune'])
+            except (ScreenNotAccessible, requests.RequestException) as e:
+                self.stderr.write(f"{s.name}: not reachable ({e})")
+                continue
+            write = self.stdout.write if success else self.stderr.write
+            write(f"{s.name}: {reason}")
+            for result in results:
+                write(f"    {result['op']} {result['name']}: "
+                      f"{result['reason']}")
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screens', '0005_auto_20170604_2349'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DesiredContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('xtype', models.CharField(max_length=10)),
+                ('spec', models.TextField()),
+                ('hash', models.CharField(max_length=44)),
+                ('version', models.CharField(max_length=44)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('screen', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='desired_content', to='screens.Screen')),
+            ],
+            options={
+                'ordering': ('screen', 'name'),
+                'unique_together': {('screen', 'name')},
+            },
+        ),
+    ]
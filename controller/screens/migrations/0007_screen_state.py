@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screens', '0006_desiredcontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='screen',
+            name='isonline',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='screen',
+            name='item_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='screen',
+            name='lastping',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='screen',
+            name='listing',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('screens', '0007_screen_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScreenContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('xtype', models.CharField(max_length=20)),
+                ('hash', models.CharField(blank=True, max_length=44)),
+                ('duration', models.IntegerField(default=0)),
+                ('expiry', models.DateTimeField(blank=True, null=True)),
+                ('display_count', models.IntegerField(default=0)),
+                ('only', models.TextField(blank=True)),
+                ('xexcept', models.TextField(blank=True)),
+                ('screen', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='content', to='screens.Screen')),
+            ],
+            options={
+                'ordering': ('screen', 'name'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='screencontent',
+            index=models.Index(fields=['hash'], name='screens_scr_hash_4ab759_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='screencontent',
+            index=models.Index(fields=['expiry'], name='screens_scr_expiry_e5ca2a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='screencontent',
+            unique_together={('screen', 'name')},
+        ),
+    ]
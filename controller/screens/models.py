@@ -1,12 +1,26 @@
 import base64
+import hashlib
 import json
-from django.db import models
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from django.core.cache import cache
+from django.db import models, transaction
 import django.utils.timezone as tz
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext as _
 import requests
 requests.packages.urllib3.disable_warnings()
 
+# pooled connections to the screens, kept alive between requests so that
+# repeated calls to a screen skip the TCP and TLS handshakes; one pool per
+# screen, for up to this many screens
+MAX_SCREENS = 100
+_session = requests.Session()
+_session.mount('https://',
+               requests.adapters.HTTPAdapter(pool_connections=MAX_SCREENS))
+
 
 class ScreenNotAccessible(Exception):
     pass
@@ -16,6 +30,19 @@ class Screen(models.Model):
     """Represents a deployed screen."""
 
     STALE_WINDOW = 180
+    # (connect, read) timeouts in seconds for requests that send content
+    PUSH_TIMEOUT = (2.0, 30.0)
+    # most screens contacted at once
+    PUSH_WORKERS = 16
+    # seconds to wait for all screens to answer a ping
+    PING_DEADLINE = 2.0
+    # seconds a cached listing is kept to be revalidated with its ETag
+    LISTING_TTL = 24 * 3600
+    # seconds one process may spend refreshing a screen's cached status
+    # or listing before others stop waiting for it
+    REFRESH_LOCK = 5
+    # seconds between checks of the cache while waiting
+    WAIT_POLL = 0.05
     name = models.CharField(
         max_length=100,
         help_text="A unique name for the screen")
@@ -25,80 +52,290 @@ class Screen(models.Model):
     password = models.CharField(max_length=100)
     lastfetch = models.DateTimeField(null=True, blank=True, editable=False)
     lastupdate = models.DateTimeField(auto_now=True, editable=False)
+    # last known state of the screen, kept by poll_all (see the
+    # pollscreens command) so that pages don't have to contact screens
+    isonline = models.BooleanField(default=False, editable=False)
+    lastping = models.DateTimeField(null=True, blank=True, editable=False)
+    item_count = models.IntegerField(default=0, editable=False)
+    # JSON content listing as of lastfetch
+    listing = models.TextField(blank=True, editable=False)
 
     class Meta:
         ordering = ('name',)
 
     @staticmethod
     def get_all_and_ping():
-        screens = Screen.objects.all()
-        # print("In get all and ping {}".format(screens))
-        for s in screens:
-            # print("Pinging {}".format(s))
-            s.ping()
+        screens = list(Screen.objects.all())
+        Screen.ping_all(screens)
         return screens
 
-    def _remote_call(self, xtype, command):
+    @staticmethod
+    def ping_all(screens, deadline=None):
+        """Ping the given screens concurrently, from up to PUSH_WORKERS
+        threads.  Screens pinged within STALE_WINDOW, by this or any other
+        controller process, aren't contacted again; if another process is
+        already pinging a screen, its result is awaited instead.  Screens
+        that haven't answered after deadline seconds (PING_DEADLINE by
+        default) are taken to be down, so this returns in bounded time
+        however many screens are unreachable.
+        """
+        now = tz.now()
+        if deadline is None:
+            deadline = Screen.PING_DEADLINE
+        end = time.time() + deadline
+        screens = [s for s in screens if not s._ping_fresh(now)]
+        cached = cache.get_many([s._cache_key('status') for s in screens])
+        stale = []
+        waiting = []
+        for s in screens:
+            status = cached.get(s._cache_key('status'), None)
+            if status is not None:
+                s._set_status(status)
+            elif s._refresh_lock('status'):
+                stale.append(s)
+            else:
+                waiting.append(s)
+
+        if stale:
+            pool = ThreadPoolExecutor(
+                max_workers=min(Screen.PUSH_WORKERS, len(stale)))
+            futures = [pool.submit(s._ping_remote) for s in stale]
+            done, late = wait(futures, timeout=deadline)
+            for future in late:
+                future.cancel()
+            # pings already under way finish in the background, within
+            # their own timeout
+            pool.shutdown(wait=False)
+            statuses = {}
+            for s, future in zip(stale, futures):
+                up, count = False, None
+                if future in done:
+                    up, count = future.result()
+                status = {'up': up, 'count': count, 'time': now}
+                s._set_status(status)
+                statuses[s._cache_key('status')] = status
+            cache.set_many(statuses, Screen.STALE_WINDOW)
+            cache.delete_many([s._cache_key('status:lock') for s in stale])
+
+        statuses = Screen._wait_for(
+            [s._cache_key('status') for s in waiting], end)
+        for s in waiting:
+            s._set_status(statuses.get(s._cache_key('status'),
+                                       {'up': False, 'time': now}))
+
+    @staticmethod
+    def poll_all(screens, deadline=None):
+        """Ping the given screens and fetch their content listings,
+        concurrently as for ping_all, and store the results with each
+        screen (and in the cache).  Screens that don't answer within
+        deadline seconds (PING_DEADLINE by default) are recorded as
+        offline, keeping the last listing fetched from them.
+        """
+        if not screens:
+            return
+        if deadline is None:
+            deadline = Screen.PING_DEADLINE
+        now = tz.now()
+        entries = cache.get_many([s._cache_key('listing') for s in screens])
+        pool = ThreadPoolExecutor(
+            max_workers=min(Screen.PUSH_WORKERS, len(screens)))
+        futures = [pool.submit(s._poll_remote,
+                               entries.get(s._cache_key('listing'), None))
+                   for s in screens]
+        done, late = wait(futures, timeout=deadline)
+        for future in late:
+            future.cancel()
+        pool.shutdown(wait=False)
+        # database and cache writes stay on this thread
+        statuses = {}
+        for s, future in zip(screens, futures):
+            up, count, listing = False, None, None
+            if future in done:
+                up, count, listing = future.result()
+            status = {'up': up, 'count': count, 'time': now}
+            s._set_status(status)
+            statuses[s._cache_key('status')] = status
+            s.isonline = up
+            s.lastping = now
+            fields = ['isonline', 'lastping']
+            if count is not None:
+                s.item_count = count
+                fields.append('item_count')
+            if listing is not None:
+                s._cache = listing
+                s.listing = json.dumps(listing)
+                s.lastfetch = now
+                fields.extend(['listing', 'lastfetch'])
+                cache.set(s._cache_key('listing'),
+                          {'etag': getattr(s, '_etag', None),
+                           'content': listing, 'time': now},
+                          Screen.LISTING_TTL)
+                ScreenContent.store(s, listing)
+            s.save(update_fields=fields)
+        cache.set_many(statuses, Screen.STALE_WINDOW)
+
+    def _poll_remote(self, entry):
+        # returns whether the screen is up, its number of items and its
+        # listing (or None); safe to call from another thread
+        up, count = self._ping_remote()
+        if up:
+            try:
+                return up, count, self._listing_remote(entry)
+            except Exception as e:
+                pass
+        return up, count, None
+
+    @staticmethod
+    def _wait_for(keys, end):
+        # poll the cache for keys being filled in by another process,
+        # until time end
+        found = {}
+        while keys:
+            found.update(cache.get_many(keys))
+            keys = [k for k in keys if k not in found]
+            if not keys or time.time() >= end:
+                break
+            time.sleep(Screen.WAIT_POLL)
+        return found
+
+    def _cache_key(self, what):
+        return f"screen:{self.pk}:{what}"
+
+    def _refresh_lock(self, what):
+        # only one process at a time refreshes a screen's cached status
+        # or listing; the lock lapses if that process dies.  (The file
+        # cache can very occasionally let two through, which is harmless.)
+        return cache.add(self._cache_key(f"{what}:lock"), True,
+                         self.REFRESH_LOCK)
+
+    def invalidate(self):
+        """Drop the screen's cached status and content listing, e.g.,
+        after changing its content, so that they are fetched afresh.
+        """
+        cache.delete_many([self._cache_key('status'),
+                           self._cache_key('listing')])
+        for attr in ('_cache', '_last_ping'):
+            self.__dict__.pop(attr, None)
+
+    def _remote_call(self, xtype, command, etag=None):
         xpass = "?password={}".format(self.password)
         starturl = f"https://{self.ipaddress}:{self.port}"
         if xtype == 'get':
+            # with an etag, None is returned if the result hasn't changed
+            headers = {'If-None-Match': etag} if etag else {}
             response = \
-                requests.get(f"{starturl}/{command}{xpass}",
+                _session.get(f"{starturl}/{command}{xpass}",
                              verify=False,
+                             headers=headers,
                              timeout=1.0)
+            if etag and response.status_code == 304:
+                return None
         elif xtype == 'delete':
-            xurl = f"{starturl}/display/{command}{xpass}"
-            response = requests.delete(xurl, verify=False, timeout=1.0)
+            # the item name, quoted whole so that '/', '?' and the like
+            # stay part of it
+            xurl = f"{starturl}/display/{quote(command, safe='')}{xpass}"
+            response = _session.delete(xurl, verify=False, timeout=1.0)
         elif xtype == 'add':
             xurl = f"{starturl}/display{xpass}"
-            xtype, formdata = command
-            # print(f"Add: {xurl} {xtype}")
-            xdata = self._construct_add_object(xtype, formdata)
-            # print(xdata)
-            response = requests.post(xurl, verify=False, data=xdata)
+            # print(f"Add: {xurl} {command}")
+            response = _session.post(xurl, verify=False, data=command,
+                                     timeout=self.PUSH_TIMEOUT)
+        elif xtype == 'batch':
+            xurl = f"{starturl}/display/batch{xpass}"
+            response = _session.post(xurl, verify=False, data=command,
+                                     timeout=self.PUSH_TIMEOUT)
         if response.status_code != 200:
             raise \
               ScreenNotAccessible(
                 f"Status code failure: {response.status_code}")
+        self._etag = response.headers.get('ETag', None)
         return response.json()
 
     def fetch_current(self, force=False):
-        now = tz.now()
-        if hasattr(self, "lastfetch") and hasattr(self, "_cache"):
-            timediff = (now - self.lastfetch)
-            if timediff.total_seconds() < self.STALE_WINDOW:
+        """Return the screen's content listing, from the cache if fetched
+        within STALE_WINDOW (unless force is given).  Otherwise the screen
+        is asked for the listing only if it has changed since the cached
+        copy.  While another process is refetching the listing, the
+        cached copy is returned even if stale.
+        """
+        key = self._cache_key('listing')
+        entry = cache.get(key, None)
+        if entry is not None and not force:
+            age = (tz.now() - entry['time']).total_seconds()
+            if age < self.STALE_WINDOW:
+                self._cache = entry['content']
                 return self._cache
-        rdata = self._remote_call('get', 'display')
+        if not self._refresh_lock('listing'):
+            if entry is None:
+                entry = self._wait_for(
+                    [key], time.time() + self.REFRESH_LOCK).get(key, None)
+            if entry is not None:
+                self._cache = entry['content']
+                return self._cache
+        try:
+            return self._fetch_remote(entry)
+        finally:
+            cache.delete(self._cache_key('listing:lock'))
+
+    def _listing_remote(self, entry):
+        # fetch the listing, unless unchanged since the cache entry
+        etag = entry['etag'] if entry is not None else None
+        rdata = self._remote_call('get', 'display', etag)
+        if rdata is None:
+            # unchanged since the listing we hold
+            rdata = {'status': 'success', 'content': entry['content']}
+            self._etag = etag
         self._update_status = rdata['status']
-        if rdata['status'] == 'success':
-            self.lastfetch = tz.now()
-            self.save()
-        else:
+        if rdata['status'] != 'success':
             raise \
               ScreenNotAccessible("Connection succeeded but call failed.")
-        self._cache = rdata['content']
+        return rdata['content']
+
+    def _fetch_remote(self, entry):
+        self._cache = self._listing_remote(entry)
+        self.lastfetch = tz.now()
+        self.listing = json.dumps(self._cache)
+        self.save()
+        ScreenContent.store(self, self._cache)
+        cache.set(self._cache_key('listing'),
+                  {'etag': getattr(self, '_etag', None),
+                   'content': self._cache,
+                   'time': self.lastfetch},
+                  self.LISTING_TTL)
         return self._cache
 
-    def ping(self):
-        now = tz.now()
+    def _set_status(self, status):
+        self._last_ping = status['time']
+        self._ping_up = status['up']
+        if status.get('count', None) is not None:
+            self._content_count = status['count']
+
+    def _ping_fresh(self, now):
         if hasattr(self, '_last_ping'):
             delta = now - self._last_ping
-            if delta.total_seconds() < self.STALE_WINDOW:
-                return self._ping_up
-        self._last_ping = tz.now()
+            return delta.total_seconds() < self.STALE_WINDOW
+        return False
+
+    def _ping_remote(self):
+        # returns whether the screen is up and its number of items (or
+        # None); safe to call from another thread
         try:
             rdata = self._remote_call('get', 'ping')
             if rdata['status'] == 'success':
-                self._ping_up = True
-                self._content_count = int(rdata['content']['display_items'])
-            else:
-                self._ping_up = False
+                return True, int(rdata['content']['display_items'])
         except Exception as e:
-            self._ping_up = False
+            pass
+        return False, None
+
+    def ping(self):
+        Screen.ping_all([self])
         return self._ping_up
 
     def content_cache(self):
-        return getattr(self, "_cache", {})
+        if hasattr(self, "_cache"):
+            return self._cache
+        # as stored by the last poll or fetch
+        return json.loads(self.listing) if self.listing else []
 
     def isup(self):
         return getattr(self, "_ping_up", False)
@@ -110,18 +347,153 @@ class Screen(models.Model):
         return getattr(self, "_last_ping", None)
 
     def add_content(self, xtype, formdata):
-        response = self._remote_call('add', (xtype, formdata))
+        spec = DesiredContent.versioned(
+            self._construct_add_dict(xtype, formdata))
+        try:
+            response = self._remote_call('add', json.dumps(spec))
+        except (ScreenNotAccessible, requests.RequestException):
+            # the screen gets the item at the next sync
+            DesiredContent.record(self, spec)
+            raise
+        finally:
+            self.invalidate()
+        if response['status'] == 'success':
+            DesiredContent.record(self, spec)
         return response['status'] == 'success', response['reason']
 
+    @staticmethod
+    def add_content_to_screens(screens, xtype, formdata):
+        """Add the same content item to several screens at once.
+
+        The request is built and encoded once and sent to up to
+        PUSH_WORKERS screens concurrently, each limited by PUSH_TIMEOUT,
+        so the whole push takes about as long as the slowest screen.
+        Returns a list of (screen, success, message) tuples in the order
+        of screens; success is None for a screen that couldn't be reached
+        (it gets the item at its next sync).
+        """
+        spec = DesiredContent.versioned(
+            Screen._construct_add_dict(xtype, formdata))
+        xdata = json.dumps(spec)
+
+        def push(s):
+            try:
+                response = s._remote_call('add', xdata)
+            except (ScreenNotAccessible, requests.RequestException) as e:
+                return s, None, f"not reachable, sending at next sync ({e})"
+            return s, response['status'] == 'success', response['reason']
+
+        if not screens:
+            return []
+        workers = min(Screen.PUSH_WORKERS, len(screens))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(push, screens))
+        # database and cache writes stay on this thread
+        for s, success, mesg in results:
+            s.invalidate()
+            if success is not False:
+                DesiredContent.record(s, spec)
+        return results
+
     def delete_content(self, xname):
-        response = self._remote_call('delete', xname)
-        return response
+        self.desired_content.filter(name=xname).delete()
+        try:
+            return self._remote_call('delete', xname)
+        finally:
+            self.invalidate()
+
+    def batch(self, operations, atomic=False):
+        """Apply several content changes to the screen in one request.
+
+        Each operation is ('add', xtype, formdata), ('update', xtype,
+        formdata) or ('delete', name).  The screen applies them all
+        together; if atomic is True, none are applied unless all can be.
+        Returns whether all succeeded, the screen's summary, and a list of
+        per-operation result dicts (with name, op, status and reason).
+        """
+        ops = []
+        for operation in operations:
+            if operation[0] == 'delete':
+                op = {'name': operation[1]}
+            else:
+                op = DesiredContent.versioned(
+                    self._construct_add_dict(operation[1], operation[2]))
+            op['op'] = operation[0]
+            ops.append(op)
+        return self._send_batch(ops, atomic)
+
+    def _send_batch(self, ops, atomic=False):
+        try:
+            response = self._remote_call(
+                'batch', json.dumps({'operations': ops, 'atomic': atomic}))
+        finally:
+            self.invalidate()
+        results = response.get('content', [])
+        for op, result in zip(ops, results):
+            if result['status'] != 'success':
+                continue
+            if op['op'] == 'delete':
+                self.desired_content.filter(name=op['name']).delete()
+            else:
+                DesiredContent.record(self, op)
+        return (response['status'] == 'success', response['reason'],
+                results)
+
+    def manifest(self):
+        """Return the screen's manifest: a dict mapping the name of each
+        item on the screen to its content hash, version and install time.
+        """
+        rdata = self._remote_call('get', 'manifest')
+        if rdata['status'] != 'success':
+            raise \
+              ScreenNotAccessible("Connection succeeded but call failed.")
+        return rdata['content']
+
+    def sync(self, prune=True):
+        """Bring the content on the screen in line with the content the
+        controller has recorded for it, sending only the items that are
+        missing or differ.  With prune, items put on the screen by the
+        controller but no longer wanted are deleted; items added by other
+        means (e.g., screenclient.py) are left alone.  Returns the same
+        as batch.
+        """
+        onscreen = self.manifest()
+        desired = self.desired_content.values_list('name', 'hash', 'version')
+        wanted = set()
+        changes = []
+        for name, xhash, version in desired:
+            wanted.add(name)
+            entry = onscreen.get(name, None)
+            if entry is None:
+                changes.append((name, 'add'))
+            elif entry['hash'] != xhash or entry['version'] != version:
+                changes.append((name, 'update'))
+
+        ops = []
+        specs = dict(self.desired_content.filter(
+            name__in=[name for name, op in changes]).values_list('name', 'spec'))
+        for name, op in changes:
+            spec = json.loads(specs[name])
+            spec['op'] = op
+            ops.append(spec)
+        if prune:
+            for name, entry in onscreen.items():
+                if name not in wanted and entry.get('version', None):
+                    ops.append({'op': 'delete', 'name': name})
+
+        if not ops:
+            return True, "already in sync", []
+        return self._send_batch(ops)
 
     def __str__(self):
         return f"{self.name} @{self.ipaddress}"
 
     @staticmethod
     def _construct_add_object(xtype, formdata):
+        return json.dumps(Screen._construct_add_dict(xtype, formdata))
+
+    @staticmethod
+    def _construct_add_dict(xtype, formdata):
         content = {}
         if xtype not in ['url', 'image', 'html']:
             raise ValidationError(_('Invalid content type'), code='invalid')
@@ -139,6 +511,9 @@ class Screen(models.Model):
                 raise ValidationError(_('Missing URL'), code='invalid')
             content['content'] = \
                 base64.b64encode(urlc.encode('utf8')).decode('utf8')
+            snapshot = formdata.pop('snapshot', None)
+            if snapshot:
+                content['snapshot'] = int(snapshot)
         elif xtype == 'image':
             # print(formdata)
             inmemfile = formdata.pop('content_file')
@@ -185,4 +560,151 @@ class Screen(models.Model):
             elist = exceptstr.split(',')
             content['xexcept'] = elist
 
-        return json.dumps(content)
+        return content
+
+
+class DesiredContent(models.Model):
+    """Content that the controller has put on a screen, kept so that the
+    screen can be brought back in line with it by Screen.sync (e.g., after
+    the screen was unreachable or lost its content).
+    """
+
+    screen = models.ForeignKey(Screen, on_delete=models.CASCADE,
+                               related_name='desired_content')
+    name = models.CharField(max_length=100)
+    xtype = models.CharField(max_length=10)
+    # JSON specification as sent to the screen to add the item
+    spec = models.TextField()
+    # base64 SHA-256 of the item's content, as reported by the screen
+    hash = models.CharField(max_length=44)
+    # base64 SHA-256 of the specification, stored by the screen with the
+    # item; a mismatch means the item on the screen is out of date
+    version = models.CharField(max_length=44)
+    updated = models.DateTimeField(auto_now=True, editable=False)
+
+    class Meta:
+        ordering = ('screen', 'name')
+        unique_together = (('screen', 'name'),)
+
+    @staticmethod
+    def _digest(data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        return base64.b64encode(hashlib.sha256(data).digest()).decode('utf8')
+
+    @staticmethod
+    def versioned(spec):
+        """Set (and return) spec with its 'version' entry filled in."""
+        spec.pop('version', None)
+        spec['version'] = DesiredContent._digest(
+            json.dumps(spec, sort_keys=True))
+        return spec
+
+    @staticmethod
+    def record(screen, spec):
+        """Record the versioned add specification spec as wanted on
+        screen, replacing any earlier item of the same name.
+        """
+        spec = {k: v for k, v in spec.items() if k != 'op'}
+        # the screen hashes a URL, or the decoded image or HTML data
+        content = base64.b64decode(spec.get('content', ''))
+        DesiredContent.objects.update_or_create(
+            screen=screen, name=spec['name'],
+            defaults={'xtype': spec['type'],
+                      'spec': json.dumps(spec),
+                      'hash': DesiredContent._digest(content),
+                      'version': spec['version']})
+
+    def __str__(self):
+        return f"{self.name} on {self.screen.name}"
+
+
+
+class ScreenContent(models.Model):
+    """An item on a screen, as of the last content listing fetched from
+    the screen, so that content can be looked up across all screens
+    without contacting them.
+    """
+
+    screen = models.ForeignKey(Screen, on_delete=models.CASCADE,
+                               related_name='content')
+    name = models.CharField(max_length=100)
+    # the screen's content class, e.g., URLContent
+    xtype = models.CharField(max_length=20)
+    # base64 SHA-256 of the item's content, as reported by the screen
+    hash = models.CharField(max_length=44, blank=True)
+    duration = models.IntegerField(default=0)
+    expiry = models.DateTimeField(null=True, blank=True)
+    display_count = models.IntegerField(default=0)
+    only = models.TextField(blank=True)
+    xexcept = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('screen', 'name')
+        unique_together = (('screen', 'name'),)
+        indexes = [models.Index(fields=['hash']),
+                   models.Index(fields=['expiry'])]
+
+    @staticmethod
+    def _expiry(value):
+        # the screen reports its local time, or '' for no expiry
+        if not value:
+            return None
+        try:
+            return tz.make_aware(datetime.fromisoformat(value))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def store(screen, listing):
+        """Replace the content recorded for screen with the items in
+        listing, a content listing as returned by the screen.
+        """
+        items = []
+        for cdict in listing:
+            restrictions = cdict.get('display_restrictions', {})
+            items.append(ScreenContent(
+                screen=screen, name=cdict['name'],
+                xtype=cdict.get('type', ''),
+                hash=cdict.get('hash', '') or '',
+                duration=cdict.get('duration', 0) or 0,
+                expiry=ScreenContent._expiry(cdict.get('expire', '')),
+                display_count=cdict.get('display_count', 0) or 0,
+                only=restrictions.get('only', ''),
+                xexcept=restrictions.get('except', '')))
+        with transaction.atomic():
+            ScreenContent.objects.filter(screen=screen).delete()
+            ScreenContent.objects.bulk_create(items)
+
+    @staticmethod
+    def screens_showing(name=None, xhash=None):
+        """Return the screens that have an item of the given name or with
+        the given content hash.
+        """
+        items = ScreenContent.objects.all()
+        if name is not None:
+            items = items.filter(name=name)
+        if xhash is not None:
+            items = items.filter(hash=xhash)
+        return Screen.objects.filter(pk__in=items.values('screen'))
+
+    @staticmethod
+    def expiring(within=timedelta(days=7)):
+        """Return the items that expire within the given time from now,
+        soonest first.
+        """
+        now = tz.now()
+        return ScreenContent.objects.filter(
+            expiry__gte=now, expiry__lt=now + within).select_related(
+            'screen').order_by('expiry')
+
+    @staticmethod
+    def plays_by_item():
+        """Return the total display count of each item across all screens,
+        as dicts with name and plays, most played first.
+        """
+        return ScreenContent.objects.values('name').annotate(
+            plays=models.Sum('display_count')).order_by('-plays', 'name')
+
+    def __str__(self):
+        return f"{self.name} on {self.screen.name}"
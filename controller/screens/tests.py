@@ -1,10 +1,35 @@
-from unittest.mock import Mock
-from django.test import TestCase, Client
+import base64
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from unittest.mock import Mock, patch
+import django.utils.timezone as tz
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
-from .models import Screen, ScreenNotAccessible
+from .models import Screen, ScreenNotAccessible, DesiredContent, \
+    ScreenContent
 
+# a cache of the tests' own, rather than the controller's shared one
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
+
+@override_settings(CACHES=TEST_CACHES)
 class ScreenTests(TestCase):
         def setUp(self):
             self.s = Screen(name="test", ipaddress="10.0.1.18",
@@ -12,6 +37,7 @@ class ScreenTests(TestCase):
             self.s.save()
             self.user = User.objects.create_user('js', 'js@localhost', 'test')
             self.user.save()
+            cache.clear()
 
         def test_fetch1(self):
             xdict = \
@@ -20,7 +46,8 @@ class ScreenTests(TestCase):
                'duration': 10,
                'last_display': 'Wed May 24 10:40:15 2017',
                'installed': 'Wed May 24 10:40:15 2017',
-               'hash': b'\x03\x1e\xdd}Ae',
+               # as sent by the screen, in JSON
+               'hash': 'Ax7dfUFl',
                'expire': '',
                'display_count': 200,
                'display_restrictions': {},
@@ -36,6 +63,146 @@ class ScreenTests(TestCase):
             self.assertEqual(self.s._update_status, "success")
             self.assertEqual(self.s._cache, [xdict])
             self.assertIsNotNone(self.s.lastfetch)
+            s = Screen.objects.get(pk=self.s.pk)
+            self.assertEqual(s.content_cache(), [xdict])
+
+        def test_fetch_not_modified(self):
+            xdict = {'type': 'URLContent', 'name': 'cs', 'duration': 10}
+
+            def remote_call(xtype, command, etag=None):
+                self.s._etag = 'W/"1a2b.3"'
+                return {'status': 'success', 'content': [xdict]}
+            self.s._remote_call = Mock(side_effect=remote_call)
+            self.s.fetch_current()
+            self.s._remote_call.assert_called_with('get', 'display', None)
+
+            # a new instance for the same screen uses the cached listing,
+            # and when refetching asks for it only if it has changed
+            s = Screen.objects.get(pk=self.s.pk)
+            s._remote_call = Mock(return_value=None)
+            self.assertEqual(s.fetch_current(), [xdict])
+            s._remote_call.assert_not_called()
+            self.assertEqual(s.fetch_current(force=True), [xdict])
+            s._remote_call.assert_called_with('get', 'display', 'W/"1a2b.3"')
+            self.assertEqual(s._update_status, "success")
+
+        def test_counts_after_not_modified(self):
+            def screen(count, etag):
+                # the screen's listing and its ETag, or 304 if unchanged
+                def remote_call(xtype, command, ifnone=None):
+                    if ifnone == etag:
+                        return None
+                    self.s._etag = etag
+                    return {'status': 'success',
+                            'content': [{'type': 'URLContent', 'name': 'cs',
+                                         'display_count': count}]}
+                return Mock(side_effect=remote_call)
+
+            self.s._remote_call = screen(5, 'W/"1a2b.1"')
+            self.s.fetch_current()
+            self.s.fetch_current(force=True)
+            self.assertEqual(self.s._remote_call.call_count, 2)
+            self.assertEqual(self.s.content.get(name='cs').display_count, 5)
+            # the screen bumps its ETag when it flushes display counters
+            self.s._remote_call = screen(9, 'W/"1a2b.2"')
+            self.s.fetch_current(force=True)
+            self.s._remote_call.assert_called_with('get', 'display',
+                                                   'W/"1a2b.1"')
+            self.assertEqual(self.s.content.get(name='cs').display_count, 9)
+            self.assertEqual(list(ScreenContent.plays_by_item()),
+                             [{'name': 'cs', 'plays': 9}])
+
+        def test_content_queries(self):
+            soon = (tz.localtime() + timedelta(days=2)).replace(
+                tzinfo=None, microsecond=0)
+
+            def item(name, xhash, count, expire=''):
+                return {'type': 'URLContent', 'name': name, 'hash': xhash,
+                        'duration': 10, 'expire': expire,
+                        'display_count': count,
+                        'display_restrictions': {'only': 'MWF:08:00-17:00',
+                                                 'except': ''}}
+            s2 = Screen.objects.create(name="test2", ipaddress="10.0.1.19",
+                                       password="TEST")
+            self.s._remote_call = Mock(return_value={
+                'status': 'success',
+                'content': [item('a', 'h1', 5, str(soon)), item('b', 'h2', 1)]})
+            self.s.fetch_current()
+            ScreenContent.store(s2, [item('a', 'h1', 7),
+                                     item('c', 'h2', 2, '2099-12-31 00:00:00')])
+
+            with self.assertNumQueries(1):
+                self.assertEqual([ s.name for s in
+                                   ScreenContent.screens_showing(name='a') ],
+                                 ['test', 'test2'])
+            with self.assertNumQueries(1):
+                self.assertEqual([ s.name for s in
+                                   ScreenContent.screens_showing(xhash='h2') ],
+                                 ['test', 'test2'])
+            with self.assertNumQueries(1):
+                expiring = [ (c.screen.name, c.name, c.expiry) for c in
+                             ScreenContent.expiring() ]
+            self.assertEqual(expiring,
+                             [('test', 'a', tz.make_aware(soon))])
+            with self.assertNumQueries(1):
+                self.assertEqual(list(ScreenContent.plays_by_item()),
+                                 [{'name': 'a', 'plays': 12},
+                                  {'name': 'c', 'plays': 2},
+                                  {'name': 'b', 'plays': 1}])
+
+            # a refetched listing replaces the recorded items
+            self.s._remote_call = Mock(return_value={
+                'status': 'success', 'content': [item('b', 'h2', 3)]})
+            self.s.fetch_current(force=True)
+            self.assertEqual(
+                list(self.s.content.values_list('name', 'display_count',
+                                                'only')),
+                [('b', 3, 'MWF:08:00-17:00')])
+
+        def test_cache(self):
+            listing = {'status': 'success', 'content': [{'name': 'cs'}]}
+            ping = {'status': 'success', 'content': {'display_items': 1}}
+
+            def remote_call(s, xtype, command, etag=None):
+                if xtype == 'get':
+                    return ping if command == 'ping' else listing
+                return {'status': 'success', 'reason': 'Create item'}
+            with patch.object(Screen, '_remote_call', autospec=True,
+                              side_effect=remote_call) as call:
+                # instances made for separate page views share the results
+                for i in range(3):
+                    s = Screen.objects.get(pk=self.s.pk)
+                    self.assertTrue(s.ping())
+                    self.assertEqual(s.fetch_current(), listing['content'])
+                self.assertEqual(call.call_count, 2)
+
+                # changing the content drops the cached status and listing
+                s.add_content('url', {'content_name': 'blah',
+                                      'url': 'http://cs.colgate.edu'})
+                s = Screen.objects.get(pk=self.s.pk)
+                s.ping()
+                s.fetch_current()
+                self.assertEqual(call.call_count, 5)
+
+                # while another process is refreshing a screen, its stale
+                # listing is served rather than contacting it too
+                with patch.object(Screen, 'STALE_WINDOW', 0):
+                    self.assertTrue(s._refresh_lock('listing'))
+                    s = Screen.objects.get(pk=self.s.pk)
+                    self.assertEqual(s.fetch_current(), listing['content'])
+                    self.assertEqual(call.call_count, 5)
+                    # and others wait for its ping rather than pinging too
+                    cache.delete(s._cache_key('status'))
+                    self.assertTrue(s._refresh_lock('status'))
+                    start = time.time()
+                    threading.Timer(0.2, cache.set, args=(
+                        s._cache_key('status'),
+                        {'up': True, 'count': 7, 'time': tz.now()}
+                    )).start()
+                    self.assertTrue(s.ping())
+                    self.assertEqual(s.content_count(), 7)
+                    self.assertLess(time.time() - start, 1.0)
+                    self.assertEqual(call.call_count, 5)
 
         def test_fetch_fail(self):
             # erturn vablue status=failure raise ScreenNotAccessible
@@ -52,6 +219,133 @@ class ScreenTests(TestCase):
             with self.assertRaises(ScreenNotAccessible):
                 self.s.fetch_current()
 
+        def test_batch(self):
+            self.s._remote_call = Mock(return_value={
+                'status': 'failure',
+                'reason': '1 of 2 operations applied',
+                'content': [
+                    {'name': 'blah', 'op': 'add', 'status': 'success',
+                     'reason': 'Create item: blah'},
+                    {'name': 'old', 'op': 'delete', 'status': 'failure',
+                     'reason': "no content object named 'old'"}]
+            })
+            ok, reason, results = self.s.batch(
+                [('add', 'url', {'content_name': 'blah', 'duration': 10,
+                                 'url': 'http://cs.colgate.edu'}),
+                 ('delete', 'old')], atomic=False)
+            self.assertFalse(ok)
+            self.assertEqual(len(results), 2)
+            xtype, xdata = self.s._remote_call.call_args[0]
+            self.assertEqual(xtype, 'batch')
+            xdata = json.loads(xdata)
+            self.assertFalse(xdata['atomic'])
+            self.assertEqual([ (op['op'], op['name'])
+                               for op in xdata['operations'] ],
+                             [('add', 'blah'), ('delete', 'old')])
+            self.assertEqual(xdata['operations'][0]['duration'], 10)
+
+        def test_sync(self):
+            def url_spec(name, url):
+                return DesiredContent.versioned(
+                    Screen._construct_add_dict('url', {'content_name': name,
+                                                       'url': url}))
+            for name in 'abc':
+                DesiredContent.record(self.s, url_spec(name, 'http://x/'))
+            a, b, c = DesiredContent.objects.all()
+            manifest = {
+                'a': {'hash': a.hash, 'version': a.version, 'mtime': 0},
+                'c': {'hash': c.hash, 'version': 'old', 'mtime': 0},
+                'x': {'hash': a.hash, 'version': 'old', 'mtime': 0},
+                'y': {'hash': a.hash, 'version': None, 'mtime': 0}}
+            batches = []
+
+            def remote_call(xtype, command, etag=None):
+                if xtype == 'get':
+                    return {'status': 'success', 'content': manifest}
+                batches.append(json.loads(command))
+                return {'status': 'success', 'reason': '',
+                        'content': [{'name': op['name'], 'op': op['op'],
+                                     'status': 'success', 'reason': ''}
+                                    for op in batches[-1]['operations']]}
+            self.s._remote_call = Mock(side_effect=remote_call)
+            ok, reason, results = self.s.sync()
+            self.assertTrue(ok)
+            # only the missing, changed and unwanted items; y was not
+            # added by the controller, so it stays
+            self.assertEqual([ (op['op'], op['name'])
+                               for op in batches[0]['operations'] ],
+                             [('add', 'b'), ('update', 'c'), ('delete', 'x')])
+            self.assertEqual(batches[0]['operations'][0]['content'],
+                             base64.b64encode(b'http://x/').decode('utf8'))
+
+            self.s.sync(prune=False)
+            self.assertEqual([ op['op'] for op in batches[1]['operations'] ],
+                             ['add', 'update'])
+
+            manifest.pop('x')
+            manifest['b'] = dict(manifest['a'], version=b.version)
+            manifest['c'] = dict(manifest['a'], version=c.version)
+            self.assertEqual(self.s.sync(), (True, "already in sync", []))
+            self.assertEqual(len(batches), 2)
+
+        def test_add_content_to_screens(self):
+            screens = [self.s] + [
+                Screen.objects.create(name=f"s{i}", ipaddress="10.0.1.19",
+                                      password="TEST") for i in range(3)]
+            payloads = []
+
+            def remote_call(s, xtype, command, etag=None):
+                payloads.append(command)
+                time.sleep(0.3)
+                if s.name == 's1':
+                    raise ScreenNotAccessible("timed out")
+                if s.name == 's2':
+                    return {'status': 'failure', 'reason': 'already exists'}
+                return {'status': 'success', 'reason': 'Create item'}
+
+            start = time.time()
+            with patch.object(Screen, '_remote_call', autospec=True,
+                              side_effect=remote_call):
+                results = Screen.add_content_to_screens(
+                    screens, 'url', {'content_name': 'blah',
+                                     'url': 'http://cs.colgate.edu'})
+            # concurrently, not one after another
+            self.assertLess(time.time() - start, 0.3 * len(screens))
+            self.assertEqual([ (s.name, ok) for s, ok, mesg in results ],
+                             [('test', True), ('s0', True), ('s1', None),
+                              ('s2', False)])
+            # encoded once for all screens
+            self.assertEqual(len(set(map(id, payloads))), 1)
+            # the unreachable screen gets it at the next sync
+            self.assertEqual(
+                sorted(DesiredContent.objects.values_list('screen__name',
+                                                          flat=True)),
+                ['s0', 's1', 'test'])
+
+        def test_upload_many(self):
+            s2 = Screen.objects.create(name="test2", ipaddress="10.0.1.19",
+                                       password="TEST")
+            c = Client()
+            c.login(username='js', password='test')
+            postcontent = {'content_name': 'blah',
+                           'duration': 10,
+                           'xexcept': '',
+                           'xonly': '',
+                           'expire': '',
+                           'url': 'http://cs.colgate.edu',
+                           'screen': f"{self.s.id},{s2.id}",
+                           'action': 'url'}
+            with patch.object(Screen, '_remote_call', return_value={
+                    'status': 'success', 'reason': 'Create item'}) as call:
+                response = c.post(reverse('screencontent-update'),
+                                  postcontent)
+            self.assertEqual([ c[0][0] for c in call.call_args_list ].count(
+                'add'), 2)
+            self.assertRedirects(response, reverse('screen-list'),
+                                 fetch_redirect_response=False)
+            self.assertIn("Updated 2 of 2 screens",
+                          c.cookies['messages'].value)
+
         def test_index(self):
             c = Client()
             # not logged in; should redirect to login
@@ -71,7 +365,7 @@ class ScreenTests(TestCase):
               'duration': 10,
               'last_display': 'Wed May 24 10:40:15 2017',
               'installed': 'Wed May 24 10:40:15 2017',
-              'hash': b'\x03\x1e\xdd}Ae',
+              'hash': 'Ax7dfUFl',
               'expire': '',
               'display_count': 200,
               'display_restrictions': {},
@@ -133,9 +427,162 @@ class ScreenTests(TestCase):
             self.assertTemplateUsed("screens/screen_content_update.html")
             self.assertContains(response, "Enter a valid value.")
 
+        def test_delete_quoted(self):
+            response = Mock(status_code=200, headers={})
+            response.json.return_value = {'status': 'success'}
+            with patch('screens.models._session.delete',
+                       return_value=response) as delete:
+                self.s.delete_content('a b/c?%')
+            self.assertIn('/display/a%20b%2Fc%3F%25?password=TEST',
+                          delete.call_args[0][0])
+
         def test_delete_content(self):
             c = Client()
             c.login(username='js', password='test')
             response = c.get(reverse('screencontent-delete',
                                      args=[self.s.id, 'notexist']))
             self.assertRedirects(response, reverse('screen-detail', args=[1]))
+
+
+class FakeScreenHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if self.path.startswith('/display'):
+            content = [{'name': 'cs', 'type': 'URLContent'}]
+        else:
+            content = {'display_items': 3}
+        output = json.dumps({'status': 'success',
+                             'content': content}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', len(output))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class FakeScreen(ThreadingMixIn, HTTPServer):
+    """Stand-in for a screen's RPC server that answers pings after latency
+    seconds."""
+    daemon_threads = True
+
+    def __init__(self, context, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeScreenHandler)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.latency = latency
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, args=(0.05,),
+                         daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        # clients give up on hung screens
+        pass
+
+
+@unittest.skipUnless(shutil.which('openssl'), "needs openssl for a test cert")
+@override_settings(CACHES=TEST_CACHES)
+class FleetPingTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        certfile = os.path.join(cls.tmpdir.name, 'server.pem')
+        # an EC key keeps handshakes cheap, since the fake screens share
+        # the test's CPU
+        subprocess.run(['openssl', 'req', '-new', '-x509', '-days', '1',
+                        '-nodes', '-subj', '/CN=localhost',
+                        '-newkey', 'ec', '-pkeyopt',
+                        'ec_paramgen_curve:prime256v1',
+                        '-out', certfile, '-keyout', certfile],
+                       check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        cls.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        cls.context.load_cert_chain(certfile)
+        cls.fakes = []
+
+    @classmethod
+    def tearDownClass(cls):
+        for fake in cls.fakes:
+            fake.shutdown()
+            fake.server_close()
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user('js', 'js@localhost', 'test')
+        cache.clear()
+
+    def make_fleet(self, n, latency, hung=0):
+        # n screens answering after latency seconds, of which hung never
+        # answer within the ping timeout
+        Screen.objects.all().delete()
+        for i in range(n):
+            fake = FakeScreen(self.context, 5.0 if i < hung else latency)
+            self.fakes.append(fake)
+            Screen.objects.create(name=f"fake{i}", ipaddress='127.0.0.1',
+                                  port=fake.server_address[1],
+                                  password='x')
+        return self.fakes[-n:]
+
+    def test_ping_all(self):
+        fakes = self.make_fleet(6, 0.2, hung=2)
+        screens = list(Screen.objects.all())
+        start = time.time()
+        Screen.ping_all(screens)
+        self.assertLess(time.time() - start, Screen.PING_DEADLINE)
+        self.assertEqual([ s.isup() for s in screens ],
+                         [False, False, True, True, True, True])
+        self.assertEqual(screens[2].content_count(), 3)
+        # within STALE_WINDOW, screens aren't contacted again
+        Screen.ping_all(screens)
+        for s in screens:
+            s.ping()
+        self.assertEqual([ f.requests for f in fakes ], [1] * 6)
+
+    def test_deadline(self):
+        self.make_fleet(3, 0.8)
+        screens = list(Screen.objects.all())
+        start = time.time()
+        Screen.ping_all(screens, deadline=0.3)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertFalse(any(s.isup() for s in screens))
+
+    def test_poll_all(self):
+        fakes = self.make_fleet(4, 0.2, hung=1)
+        Screen.objects.filter(name='fake0').update(
+            listing=json.dumps([{'name': 'old'}]))
+        start = time.time()
+        call_command('pollscreens')
+        # polling takes about as long for a large fleet as for a small
+        # one, allowing for the fake screens' handshakes
+        self.assertLess(time.time() - start, Screen.PING_DEADLINE + 1.0)
+        screens = list(Screen.objects.all())
+        self.assertEqual([ s.isonline for s in screens ],
+                         [False, True, True, True])
+        self.assertEqual(screens[1].item_count, 3)
+        self.assertEqual(screens[1].content_cache(),
+                         [{'name': 'cs', 'type': 'URLContent'}])
+        self.assertIsNotNone(screens[0].lastping)
+        # an unreachable screen keeps its last known listing
+        self.assertEqual(screens[0].content_cache(), [{'name': 'old'}])
+
+        call_command('pollscreens', 'fake1')
+        self.assertEqual([ f.requests for f in fakes ], [1, 4, 2, 2])
+
+    def test_page_latency(self):
+        # the pages show the stored state of screens, without contacting
+        # them, however many there are or don't answer
+        c = Client()
+        c.login(username='js', password='test')
+        fakes = self.make_fleet(8, 0.2, hung=2)
+        start = time.time()
+        response = c.get(reverse('screen-list'))
+        self.assertEqual(len(response.context['screens']), 8)
+        response = c.get(reverse('screen-detail',
+                                 args=[Screen.objects.first().pk]))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(sum(f.requests for f in fakes), 0)
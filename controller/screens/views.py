@@ -11,6 +11,8 @@ from .forms import HTMLContentForm, ImageContentForm, URLContentForm
 
 
 class ScreenList(ListView):
+    # shows the state stored by the last poll (see the pollscreens
+    # command), so the page doesn't wait on screens
     model = Screen
     context_object_name = 'screens'
 
@@ -19,14 +21,6 @@ class ScreenDetail(DetailView):
     model = Screen
     context_object_name = 'screen'
 
-    def get_object(self, queryset=None):
-        obj = super(ScreenDetail, self).get_object(queryset)
-        try:
-            obj.fetch_current()
-        except:
-            pass
-        return obj
-
 
 class ScreenCreate(CreateView):
     model = Screen
@@ -95,28 +89,42 @@ class ScreenContentUpdate(View):
                 html_assets = request.FILES.getlist('html_assets')
                 form.cleaned_data['html_assets'] = html_assets
 
+            # the form carries the selected screen ids joined by commas
+            sids = ','.join(request.POST.getlist('screen')).split(',')
+            screens = list(Screen.objects.filter(
+                pk__in=[int(sid) for sid in sids if sid.strip()]))
+            if not screens:
+                messages.warning(request, "No screens specified for update.")
+                return HttpResponseRedirect(reverse('screen-list'))
+
             faillist = []
             successlist = []
-            for sid in request.POST['screen']:
-                s = Screen.objects.get(pk=sid)
-                try:
-                    success, mesg = s.add_content(request.POST['action'],
-                                                  form.cleaned_data)
-                except ValidationError as ve:
-                    smsg = f"Screen {s.name} update failed: {ve}"
-                    faillist.append(smsg)
+            try:
+                results = Screen.add_content_to_screens(
+                    screens, request.POST['action'], form.cleaned_data)
+            except ValidationError as ve:
+                results = [(s, False, ve) for s in screens]
+            # refresh the stored state of the screens just changed
+            Screen.poll_all([s for s, success, mesg in results if success])
+            for s, success, mesg in results:
+                if success:
+                    smsg = f"Screen {s.name} update successful: {mesg}"
+                    successlist.append(smsg)
                 else:
-                    if success:
-                        smsg = f"Screen {s.name} update successful: {mesg}"
-                        successlist.append(smsg)
-                    else:
-                        smsg = f"Screen {s.name} update failed: {mesg}"
-                        faillist.append(smsg)
+                    smsg = f"Screen {s.name} update failed: {mesg}"
+                    faillist.append(smsg)
+            if len(results) > 1:
+                messages.info(request,
+                              f"Updated {len(successlist)} of "
+                              f"{len(results)} screens.")
             if faillist:
                 messages.warning(request, ", ".join(faillist))
             if successlist:
                 messages.success(request, ", ".join(successlist))
-            return HttpResponseRedirect(reverse('screen-detail', args=[s.id]))
+            if len(screens) > 1:
+                return HttpResponseRedirect(reverse('screen-list'))
+            return HttpResponseRedirect(reverse('screen-detail',
+                                                args=[screens[0].id]))
         else:
             messages.warning(request, "Invalid form content.")
             context = {'form': form,
@@ -151,5 +159,7 @@ class ScreenContentDelete(DetailView):
                 messages.warning(request, response['reason'].capitalize())
         except Exception as e:
             messages.warning(request, f"Content not deleted: {e}")
+        else:
+            Screen.poll_all([obj])
         return HttpResponseRedirect(reverse('screen-detail',
                                             args=[obj.id]))
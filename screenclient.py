@@ -4,11 +4,20 @@ import argparse
 import os
 import base64
 import re
+import shlex
 from datetime import datetime
 import textwrap
+from urllib.parse import quote
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import requests
 requests.packages.urllib3.disable_warnings()
 
+# one pooled session, so that the requests made by an action (e.g., the
+# upload and create requests for an add) share a kept-alive connection
+session = requests.Session()
+
 
 def make_base_url(host='localhost', port=4443):
     return "https://{}:{}".format(host, port)
@@ -42,23 +51,24 @@ def print_response(responsedata):
         pass
 
 def ping_screen(baseurl, password):
-    response = requests.get('{}/ping?password={}'.format(baseurl, password),
+    response = session.get('{}/ping?password={}'.format(baseurl, password),
         verify=False)
     print(response.json())
 
-def list_content(baseurl, password):
-    response = requests.get('{}/display?password={}'.format(baseurl, password),
-        verify=False)
+def list_content(baseurl, password, summary=False):
+    response = session.get('{}/display?password={}&summary={}'.format(baseurl,
+        password, int(summary)), verify=False)
     print_response(response.json())
 
 def get_content(baseurl, password, name):
-    response = requests.get("{}/display/{}?password={}".format(baseurl,
-        name, password), verify=False)
+    response = session.get("{}/display/{}?password={}".format(baseurl,
+        quote(name, safe=''), password), verify=False)
     print_response(response.json())
 
 def delete_content(baseurl, password, name):
-    xurl = "{}/display/{}?password={}".format(baseurl, name, password)
-    response = requests.delete(xurl, verify=False)
+    xurl = "{}/display/{}?password={}".format(baseurl, quote(name, safe=''),
+                                              password)
+    response = session.delete(xurl, verify=False)
     print_response(response.json())
 
 def check_parm(pname, params):
@@ -89,15 +99,18 @@ def construct_add_object(params):
         content['content'] = \
           base64.b64encode(params['content'].encode('ascii')).decode('ascii')
         del params['content']
+        if 'snapshot' in params:
+            content['snapshot'] = int(params.pop('snapshot'))
     elif params['type'] == 'image':
         check_parm('content', params)
-        content['content'] = encode_filedata(params['content']).decode('ascii')
+        # image and html files are streamed separately (see add_content)
+        content['upload'] = params['content']
         content['filename'] = os.path.basename(params['content'])
         content['caption'] = params.pop('caption', '')
         del params['content']
     elif params['type'] == 'html':
         check_parm('content', params)
-        content['content'] = encode_filedata(params['content']).decode('ascii')
+        content['upload'] = params['content']
         del params['content']
         for i, asset in enumerate(params.get('asset')):
             content[f"assetname_{i}"] = asset
@@ -154,7 +167,7 @@ def verify_time_constraint(xstr):
         print ("Can't parse time constraint string {}.  Should be in the format [MTWRFSU:]HH:MM-HH:MM or [MTWRFSU:]HHMM-HHMM".format(xstr))
         sys.exit()
 
-def add_content(baseurl, password, args):
+def parse_add_args(args):
     # assume that args is a list of strings in the form:
     #   name=x type=url|image|html expire=YYYYMMDDHHMMSS begin=HHMM end=HHMM duration=int
     #   no spaces between argument key/value pairs
@@ -179,18 +192,147 @@ def add_content(baseurl, password, args):
         else:
             params[k] = v
 
-    content = construct_add_object(params)
+    return construct_add_object(params)
+
+def upload_content(baseurl, password, content):
+    # send the file data for an image or html item as a raw streamed
+    # body, ahead of the request that creates the item
+    upload = content.pop('upload', None)
+    if upload is None:
+        return True
+    xurl = "{}/display/{}/content?password={}&filename={}".format(
+        baseurl, quote(content['name'], safe=''), password,
+        quote(os.path.basename(upload)))
+    with open(upload, 'rb') as infile:
+        response = session.put(xurl, verify=False, data=infile)
+    if response.json()['status'] != 'success':
+        print_response(response.json())
+        return False
+    return True
+
+def add_content(baseurl, password, args):
+    content = parse_add_args(args)
+    if not upload_content(baseurl, password, content):
+        return
+    # just the metadata as JSON
     xdata = json.dumps(content)
     xurl = "{}/display?password={}".format(baseurl, password)
-    response = requests.post(xurl, verify=False, data=xdata)
+    response = session.post(xurl, verify=False, data=xdata)
     print_response(response.json())
 
+def batch_content(baseurl, password, args):
+    # args are a file name, then optionally atomic=yes.  Each line of the
+    # file is an add, update or delete action with its arguments, as they
+    # would be given on the command line.
+    if not args:
+        print ("For 'batch' action, the name of a file of actions is required.")
+        sys.exit()
+    params = dict(kv.split('=', 1) for kv in args[1:] if '=' in kv)
+    operations = []
+    with open(args[0]) as infile:
+        for line in infile:
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if words[0] in ('add', 'update'):
+                op = parse_add_args(words[1:])
+            elif words[0] == 'delete' and len(words) == 2:
+                op = {'name': words[1]}
+            else:
+                print ("Can't parse batch action '{}'".format(line.strip()))
+                sys.exit()
+            op['op'] = words[0]
+            operations.append(op)
+
+    for op in operations:
+        if not upload_content(baseurl, password, op):
+            return
+    xdata = json.dumps({'operations': operations,
+                        'atomic': params.get('atomic', 'no') == 'yes'})
+    xurl = "{}/display/batch?password={}".format(baseurl, password)
+    response = session.post(xurl, verify=False, data=xdata)
+    responsedata = response.json()
+    print_status(responsedata['status'], responsedata)
+    for result in responsedata.get('content', []):
+        print("    {} {}: {}".format(result['op'], result['name'],
+                                     result['reason']))
+
+def benchmark(baseurl, password, args):
+    # args are key=value strings:
+    #   requests=N concurrency=N action=ping|list reuse=yes|no
+    params = dict(kv.split('=', 1) for kv in args if '=' in kv)
+    nrequests = int(params.get('requests', 200))
+    concurrency = int(params.get('concurrency', 8))
+    action = params.get('action', 'ping')
+    reuse = params.get('reuse', 'yes') != 'no'
+    path = {'ping': 'ping', 'list': 'display'}[action]
+    xurl = "{}/{}?password={}".format(baseurl, path, password)
+    pingurl = "{}/ping?password={}".format(baseurl, password)
+    local = threading.local()
+
+    def tls_stats():
+        try:
+            response = requests.get(pingurl, verify=False, timeout=30)
+            return response.json().get('content', {})
+        except (requests.RequestException, ValueError):
+            return {}
+
+    def timed_request(i):
+        # with reuse, each thread keeps one connection open for all its
+        # requests; without, every request makes a new connection
+        if reuse:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            getter = local.session.get
+        else:
+            getter = requests.get
+        start = perf_counter()
+        try:
+            response = getter(xurl, verify=False, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, perf_counter() - start
+
+    before = tls_stats().get('tls')
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_request, range(nrequests)))
+    elapsed = perf_counter() - start
+
+    latencies = sorted(t for ok, t in results if ok)
+    failures = len(results) - len(latencies)
+    print("{} {} requests, concurrency {}, {}: {:.1f} requests/sec, {} failed".format(
+          nrequests, action, concurrency,
+          'kept-alive connections' if reuse else 'new connection per request',
+          len(latencies) / elapsed, failures))
+    if latencies:
+        print("latency ms: mean {:.1f}  p50 {:.1f}  p95 {:.1f}  max {:.1f}".format(
+              sum(latencies) * 1000 / len(latencies),
+              latencies[len(latencies) // 2] * 1000,
+              latencies[int(len(latencies) * 0.95)] * 1000,
+              latencies[-1] * 1000))
+
+    # the display's GUI responsiveness and TLS handshakes while under load
+    status = tls_stats()
+    after = status.get('tls')
+    if before and after:
+        # less the handshake for the status ping after the run
+        handshakes = after['handshakes'] - before['handshakes'] - 1
+        print("TLS handshakes: {} ({:.2f} per request), {} resumed".format(
+              handshakes, handshakes / nrequests,
+              after['resumed'] - before['resumed']))
+    lag = status.get('gui_lag_ms', None)
+    if lag:
+        print("display GUI timer lag ms: mean {}  max {}".format(lag['mean'],
+              lag['max']))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--password', '-p', default='password', help='Specify password used to authenticate requests for modifying and querying content on the display')
     parser.add_argument('--host', '-H', default='localhost', help='Specify hostname or IP address of display server')
     parser.add_argument('--port', '-P', default=4443, help='Specify port number of display server')
-    parser.add_argument('action', nargs=1, type=str, choices=['ping','get','show','list','delete','add','help'], help="Query action.  Must be one of ping, get, show, list, delete, add, or help.  The 'help' action gives detailed help on actions and arguments.")
+    parser.add_argument('action', nargs=1, type=str, choices=['ping','get','show','list','delete','add','batch','bench','help'], help="Query action.  Must be one of ping, get, show, list, delete, add, batch, bench, or help.  The 'help' action gives detailed help on actions and arguments.")
     parser.add_argument('action_args', nargs='*', help='''Any arguments to the specified action.  Use the option --actions to show detailed help for valid action/argument combinations.''')
     args = parser.parse_args()
 
@@ -206,8 +348,10 @@ The following are the valid combinations of action and arguments:
         The get/show action requires the name of the content item for which
         to display details.
 
-    list
+    list [summary]
         The list action lists all content items installed in the display app.
+        With summary, the content of each item (URL, image file name or
+        HTML text) is left out.
 
     delete <name>
         The delete action requires the name of the content item to delete.
@@ -261,11 +405,35 @@ The following are the valid combinations of action and arguments:
             * For html content, an addition option is asset=<filename>.  This
               option can be specified more than once to include multiple
               assets.
+            * For url content, snapshot=<seconds> has the display show a
+              local copy of the page, refreshed once it is older than the
+              given number of seconds, instead of loading the page each
+              time it is shown.  Only text/html pages are copied; others
+              are always loaded live.
+
+    batch <filename> atomic=<yes|no>
+        The batch action applies a list of actions to the display app in a
+        single request.  Each line of the file is an add, update or delete
+        action followed by its arguments, as they would be given on the
+        command line (add and update take the same arguments; update
+        replaces the item with the given name).  Blank lines and comments
+        starting with # are ignored.  The display app applies the actions
+        all together and reports the result of each one.  If atomic=yes
+        is given, none of the actions are applied unless all of them can be.
+
+    bench requests=<n> concurrency=<n> action=<ping|list> reuse=<yes|no>
+        The bench action sends a number of requests (default 200) to the
+        display app from several threads at once (default 8), and reports
+        requests per second, request latency, the number of TLS handshakes
+        the display did, and how far the display's GUI timer fell behind
+        while handling them.  By default each thread keeps its connection
+        open between requests; with reuse=no every request makes a new
+        connection.
         ''')
     elif action == 'ping':
         ping_screen(baseurl, args.password)
     elif action == 'list':
-        list_content(baseurl, args.password)
+        list_content(baseurl, args.password, 'summary' in args.action_args)
     elif action == 'get' or action == 'show':
         if len(args.action_args) != 1:
             print ("For 'get' action, the name of the content item to get information about is required.")
@@ -278,3 +446,7 @@ The following are the valid combinations of action and arguments:
         delete_content(baseurl, args.password, args.action_args[0])
     elif action == 'add':
         add_content(baseurl, args.password, args.action_args)
+    elif action == 'batch':
+        batch_content(baseurl, args.password, args.action_args)
+    elif action == 'bench':
+        benchmark(baseurl, args.password, args.action_args)
@@ -6,25 +6,38 @@ import os.path
 import shutil
 import tempfile
 from abc import ABCMeta,abstractmethod
-from datetime import datetime
-from time import mktime, time, asctime
+from datetime import datetime, timedelta
+from time import mktime, time, asctime, strptime
 from threading import Lock
 import pickle
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import heapq
+from itertools import count
 import re
 import textwrap
 import hashlib
 import base64
-from subprocess import getstatusoutput
+import json
+import urllib.request
+from threading import Thread
 
-from PyQt4.QtCore import QUrl
+from PyQt4.QtCore import QUrl, Qt, QBuffer, QIODevice
+from PyQt4.QtGui import QImage
+
+from screenimage import image_dimensions
 
 assert(sys.version_info.major == 3)
 
 CACHE_DIR = 'screen_content_cache'
+# local assets for the built-in pages, so that they needn't be fetched
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
 
 TimeConstraintSpec = namedtuple('TimeConstraintSpec', ['days','begin','end'])
 
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
 class TimeConstraint(metaclass=ABCMeta):
     _dowmap = {}
     _revdow = {}
@@ -33,6 +46,10 @@ class TimeConstraint(metaclass=ABCMeta):
         _dowmap[dayletter.lower()] = i
         _revdow[i] = dayletter
 
+    _days = '([mM]?[tT]?[wW]?[rR]?[fF]?[Ss]?[Uu]?):?'
+    _formats = (re.compile(_days + r'(\d{2}):(\d{2})-(\d{2}):(\d{2})'),
+                re.compile(_days + r'(\d{2})(\d{2})-(\d{2})(\d{2})'))
+
     def __init__(self, s):
         self.__constraint = TimeConstraint.parse_constraint(s)
 
@@ -47,10 +64,10 @@ class TimeConstraint(metaclass=ABCMeta):
 
     @staticmethod
     def parse_constraint(s):
-        days = '([mM]?[tT]?[wW]?[rR]?[fF]?[Ss]?[Uu]?):?'
-        mobj = re.match(days + '(\d{2}):(\d{2})-(\d{2}):(\d{2})', s)
-        if not mobj:
-            mobj = re.match(days + '(\d{2})(\d{2})-(\d{2})(\d{2})', s)
+        for fmt in TimeConstraint._formats:
+            mobj = fmt.match(s)
+            if mobj:
+                break
 
         if not mobj:
             raise Exception("Can't parse time constraint string {}.  Should be in the format [MTWRFSU:]HH:MM-HH:MM or [MTWRFSU:]HHMM-HHMM".format(s))
@@ -60,6 +77,10 @@ class TimeConstraint(metaclass=ABCMeta):
         end = int(mobj.groups()[3]) * 60 + int(mobj.groups()[4])
         return TimeConstraintSpec(days, begin, end)
 
+    @property
+    def spec(self):
+        return self.__constraint
+
     def now_matches_constraint(self, now):
         dow = now.weekday()
         hourmin = now.hour * 60 + now.minute
@@ -86,16 +107,205 @@ class Except(TimeConstraint):
         return not self.now_matches_constraint(now)
 
 
-def _make_hash(data):
-    m = hashlib.sha256()
+def _digest(data):
     if isinstance(data, str):
         data = data.encode('utf8')
-    m.update(data)
-    h = m.digest()
-    return base64.b64encode(h).decode('utf8')
+    return hashlib.sha256(data).digest()
+
+
+def _make_hash(data):
+    return base64.b64encode(_digest(data)).decode('utf8')
+
+
+_builtin_style = None
+
+def builtin_style():
+    '''
+    Return the stylesheet for the built-in pages (see static/screen.css),
+    to be inlined in them.  It is read once.
+    '''
+    global _builtin_style
+    if _builtin_style is None:
+        try:
+            with open(os.path.join(STATIC_DIR, 'screen.css'),
+                      encoding='utf8') as infile:
+                _builtin_style = infile.read()
+        except OSError:
+            _builtin_style = ''
+    return _builtin_style
+
+
+class AssetStore(object):
+    '''
+    Content-addressed, reference-counted file store under CACHE_DIR.
+
+    Blobs are kept in CACHE_DIR/objects, named by the hex SHA-256 of their
+    data plus the original file extension, so the same data uploaded under
+    several content names is stored once, and storing data that is already
+    present skips the write.  Directories built from blobs (HTML pages and
+    their assets) are kept in CACHE_DIR/pages, named by a hash of their
+    file names and blob keys, with the files hard-linked to the blobs.
+
+    A stored file or directory is deleted when its last reference is
+    released.  Reference counts are kept in memory only: they are rebuilt
+    as content items are restored, and sweep removes anything left over.
+    '''
+    OBJECT_DIR = 'objects'
+    PAGE_DIR = 'pages'
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.__refs = {}
+        self.__lock = Lock()
+
+    @staticmethod
+    def path(key):
+        return os.path.join(os.getcwd(), CACHE_DIR, key)
+
+    @staticmethod
+    def digest(key):
+        '''
+        Return the SHA-256 digest of the blob with the given key.
+        '''
+        return bytes.fromhex(os.path.basename(key).split('.')[0])
+
+    def put(self, data, ext='', digest=None):
+        '''
+        Store data (bytes) and take a reference to it.  digest may be
+        passed if the caller has already computed it.  Returns the key.
+        '''
+        if digest is None:
+            digest = _digest(data)
+        key = os.path.join(AssetStore.OBJECT_DIR, digest.hex() + ext.lower())
+        path = AssetStore.path(key)
+        with self.__lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _atomic_write(path, data)
+            self.__refs[key] = self.__refs.get(key, 0) + 1
+        return key
+
+    def put_stream(self, infile, length, ext=''):
+        '''
+        Store length bytes read from the file object infile, hashing them
+        as they are written in chunks, and take a reference to the result.
+        Returns the key.
+        '''
+        objdir = AssetStore.path(AssetStore.OBJECT_DIR)
+        os.makedirs(objdir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=objdir, prefix='.tmp')
+        m = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                remaining = length
+                while remaining > 0:
+                    chunk = infile.read(min(remaining, AssetStore.CHUNK_SIZE))
+                    if not chunk:
+                        raise Exception("Upload ended {} bytes short".format(
+                                        remaining))
+                    m.update(chunk)
+                    outfile.write(chunk)
+                    remaining -= len(chunk)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            key = os.path.join(AssetStore.OBJECT_DIR,
+                               m.hexdigest() + ext.lower())
+            with self.__lock:
+                if os.path.exists(AssetStore.path(key)):
+                    os.unlink(tmppath)
+                else:
+                    os.replace(tmppath, AssetStore.path(key))
+                self.__refs[key] = self.__refs.get(key, 0) + 1
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        return key
+
+    def put_dir(self, files):
+        '''
+        Store a directory given as a dict mapping relative file names to
+        blob keys, and take a reference to it.  Returns the key.
+        '''
+        m = hashlib.sha256()
+        for name in sorted(files):
+            m.update('{}\0{}\0'.format(name, files[name]).encode('utf8'))
+        key = os.path.join(AssetStore.PAGE_DIR, m.hexdigest())
+        path = AssetStore.path(key)
+        with self.__lock:
+            if not os.path.isdir(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path),
+                                          prefix='.tmp')
+                for name, blob in files.items():
+                    outname = os.path.join(tmpdir, name)
+                    os.makedirs(os.path.dirname(outname), exist_ok=True)
+                    try:
+                        os.link(AssetStore.path(blob), outname)
+                    except OSError:
+                        shutil.copyfile(AssetStore.path(blob), outname)
+                os.rename(tmpdir, path)
+            self.__refs[key] = self.__refs.get(key, 0) + 1
+        return key
+
+    def acquire(self, key):
+        '''
+        Take another reference to an already stored key.
+        '''
+        with self.__lock:
+            self.__refs[key] = self.__refs.get(key, 0) + 1
+
+    def release(self, key):
+        '''
+        Drop a reference to key, deleting its file or directory if that
+        was the last one.
+        '''
+        with self.__lock:
+            refs = self.__refs.get(key, 0) - 1
+            if refs > 0:
+                self.__refs[key] = refs
+                return
+            self.__refs.pop(key, None)
+            self.__remove(key)
+
+    def sweep(self):
+        '''
+        Delete anything in the store that nothing holds a reference to.
+        '''
+        with self.__lock:
+            for subdir in (AssetStore.OBJECT_DIR, AssetStore.PAGE_DIR):
+                try:
+                    names = os.listdir(AssetStore.path(subdir))
+                except FileNotFoundError:
+                    continue
+                for name in names:
+                    key = os.path.join(subdir, name)
+                    if key not in self.__refs:
+                        self.__remove(key)
+
+    @staticmethod
+    def __remove(key):
+        path = AssetStore.path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+asset_store = AssetStore()
 
 
 class ContentItem(metaclass=ABCMeta):
+    # not set for items saved by older versions
+    __version = None
+    # weekly bitmask compiled from the only/except constraints (see
+    # ScheduleIndex); compiled on first use for items saved by older
+    # versions
+    __schedule = None
+
     def __init__(self, name, **kwargs):
         self.__display_duration = int(kwargs.get('duration', 10))
         self.__last_display = '(none)'
@@ -132,9 +342,13 @@ class ContentItem(metaclass=ABCMeta):
                 self.__only.append(Only(xstr))
         elif only is not None:
             raise Exception("only argument needs a list")
+        self.__schedule = ScheduleIndex.compile(*self.time_constraints)
 
         self.__display_count = 0
         self.__name = name
+        # opaque version of the item's specification, given by the client
+        # that created it to tell later whether the item is up to date
+        self.__version = kwargs.get('version', None)
 
     @abstractmethod
     def render(self, webview, width, height):
@@ -145,6 +359,16 @@ class ContentItem(metaclass=ABCMeta):
         '''
         pass
 
+    def prepare(self, width, height):
+        '''
+        Method which is invoked when the content item is added to a
+        display whose web view is width x height pixels, so that any
+        display-specific work can be done ahead of time instead of in
+        render.  Returns True if that changed the item's record (see
+        to_record).  The default does nothing.
+        '''
+        return False
+
     @property
     def name(self):
         return self.__name
@@ -171,10 +395,29 @@ class ContentItem(metaclass=ABCMeta):
         '''
         return self.__display_count
 
+    @property
+    def version(self):
+        return self.__version
+
+    def manifest_entry(self):
+        '''
+        Return a dict with this item's content hash, its version (or None)
+        and when it was installed, in seconds since the epoch.
+        '''
+        return {
+            'hash': self.to_dict(summary=True)['hash'],
+            'version': self.__version,
+            'mtime': mktime(strptime(self.__installed)),
+        }
+
     def displayed(self):
         self.__last_display = asctime()
         self.__display_count += 1
 
+    def _restore_stats(self, display_count, last_display):
+        self.__display_count = display_count
+        self.__last_display = last_display
+
     @property
     def expiry(self):
         '''
@@ -183,10 +426,33 @@ class ContentItem(metaclass=ABCMeta):
         '''
         return self.__expire_datetime
 
+    @property
+    def time_constraints(self):
+        '''
+        Return a tuple of (only, except) lists of TimeConstraintSpec
+        objects for this content item.
+        '''
+        return [ c.spec for c in self.__only ], [ c.spec for c in self.__except ]
+
+    @property
+    def schedule_mask(self):
+        '''
+        Weekly bitmask of the minutes in which this item may be displayed,
+        as made by ScheduleIndex.compile; ScheduleIndex.ALWAYS itself if
+        the item has no time constraints.
+        '''
+        if self.__schedule is None:
+            self.__schedule = ScheduleIndex.compile(*self.time_constraints)
+        return self.__schedule
+
     def __str__(self):
         return "{} ({}) duration:{} last_display:{} display_count:{} expire:{} {} {}".format(self.__class__.__name__, self.name, self.display_duration, self.last_display, self.display_count, self.expiry, ','.join([str (e) for e in self.__only]), ','.join([str(e) for e in self.__except]))
 
-    def to_dict(self):
+    def to_dict(self, summary=False):
+        '''
+        Return a dict describing this item for listings.  If summary is
+        True, the possibly bulky 'content' entry is left out.
+        '''
         expire = ''
         if self.__expire_datetime is not None:
             expire = str(self.__expire_datetime)
@@ -203,6 +469,39 @@ class ContentItem(metaclass=ABCMeta):
             'display_restrictions': restrictions,
         }
 
+    def to_record(self):
+        '''
+        Return a JSON-serializable dict from which content_from_record
+        can recreate this item.  Any file data belonging to the item is
+        referred to by path, not copied into the record.
+        '''
+        expire = ''
+        if self.__expire_datetime is not None:
+            expire = self.__expire_datetime.strftime('%Y%m%d%H%M%S')
+        kwargs = {'duration': self.display_duration,
+                  'expiry': expire,
+                  'only': [str(e) for e in self.__only],
+                  'xexcept': [str(e) for e in self.__except],
+                  'version': self.__version}
+        return {
+            'type': self.__class__.__name__,
+            'name': self.name,
+            'kwargs': kwargs,
+            'installed': self.__installed,
+            'last_display': self.last_display,
+            'display_count': self.display_count,
+        }
+
+    def _restore(self, record):
+        '''
+        Reinitialize this item from a dict made by to_record.  Derived
+        classes extend this to restore their own state.
+        '''
+        ContentItem.__init__(self, record['name'], **record['kwargs'])
+        self.__installed = record['installed']
+        self.__last_display = record['last_display']
+        self.__display_count = record['display_count']
+
     @abstractmethod
     def content_removed(self):
         '''
@@ -214,6 +513,14 @@ class ContentItem(metaclass=ABCMeta):
         '''
         pass
 
+    def content_replaced(self, item):
+        '''
+        Called instead of content_removed when item takes this item's
+        place in the content queue.  Derived classes whose resources a
+        replacement can share override this to keep them.
+        '''
+        self.content_removed()
+
     def should_display(self, now):
         '''
         Return True if this item should be displayed now.  Handles all
@@ -222,63 +529,231 @@ class ContentItem(metaclass=ABCMeta):
         We only display an item if it satisfies *all except* clauses (i.e.,
         current time is not a "black-listed" time), and satisfies *any*
         of the *only* constraints (i.e., it satisfies at least one of the
-        "whitelisted" times).
+        "whitelisted" times).  The constraints are compiled into a weekly
+        bitmask when the item is created, so this is a bit test.
         '''
-        # definitely display if there are no constraints specified
-        if not (self.__only or self.__except):
+        mask = self.schedule_mask
+        if mask == ScheduleIndex.ALWAYS:
             return True
+        return bool((mask >> ScheduleIndex.bucket(now)) & 1)
 
-        # otherwise, respect the constraints
-        if self.__only:
-            xonly = [ constraint.should_display(now) for constraint in self.__only ]
-        else:
-            xonly = [True]
-
-        if self.__except:
-            xexcept = [ constraint.should_display(now) for constraint in self.__except ]
+    def next_display_time(self, now):
+        '''
+        Return the earliest time, from now on, at which this item may be
+        displayed (now itself if it may be displayed now), or None if it
+        never may be again because of its constraints or expiry.
+        '''
+        mask = self.schedule_mask
+        if not mask:
+            return None
+        bucket = ScheduleIndex.bucket(now)
+        ahead = mask >> bucket
+        if ahead & 1:
+            when = now
         else:
-            xexcept = [True]
-        return all(xexcept) and any(xonly)
+            if ahead:
+                wait = (ahead & -ahead).bit_length() - 1
+            else:
+                # not again this week, so at the first minute next week
+                wait = MINUTES_PER_WEEK - bucket + \
+                    (mask & -mask).bit_length() - 1
+            when = now.replace(second=0, microsecond=0) + \
+                timedelta(minutes=wait)
+        if self.__expire_datetime is not None and \
+                when >= self.__expire_datetime:
+            return None
+        return when
+
+
+def _should_display_unindexed(only, xexcept, now):
+    # how ContentItem.should_display evaluated lists of Only and Except
+    # objects before their constraints were compiled, kept here for
+    # benchmarking
+    if not (only or xexcept):
+        return True
+    if only:
+        xonly = [ constraint.should_display(now) for constraint in only ]
+    else:
+        xonly = [True]
+    if xexcept:
+        xexcepts = [ constraint.should_display(now) for constraint in xexcept ]
+    else:
+        xexcepts = [True]
+    return all(xexcepts) and any(xonly)
 
 
 class URLContent(ContentItem):
+    '''
+    A web page, loaded from its URL each time it is shown; or, if created
+    with snapshot=<seconds>, shown from a local copy of the page that is
+    refreshed in the background once it is older than that (checked when
+    the item is shown, and periodically by the display through
+    ContentQueue.refresh_snapshots).  Only text/html pages are copied,
+    since the copy is shown with setHtml.  The copy is
+    shown with the page's URL as its base, so its images, stylesheets and
+    so on still come from the site (or the web view's cache).  If a
+    refresh fails, the last good copy is shown; before there is any copy,
+    the live page is.
+    '''
+    # snapshots are kept in CACHE_DIR/SNAPSHOT_DIR
+    SNAPSHOT_DIR = 'snapshots'
+    # seconds to wait for the page when refreshing a snapshot
+    SNAPSHOT_TIMEOUT = 10
+    # largest page kept as a snapshot
+    SNAPSHOT_MAX_SIZE = 4 * 1024 * 1024
+
+    # not set for items saved by older versions
+    __snapshot_age = None
+
     def __init__(self, url, name, **kwargs):
         super(URLContent, self).__init__(name, **kwargs)
         self.__hash = _make_hash(url)
         self.__url = url
+        self.__init_snapshot(kwargs.get('snapshot', None))
+
+    def __init_snapshot(self, max_age):
+        self.__snapshot_age = int(max_age) if max_age else None
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__snapshot_error = None
+        self.__snapshot_checked = None
+        self.__refreshing = False
+        self.__removed = False
+        if self.__snapshot_age is None:
+            return
+        # a copy kept from before a restart
+        try:
+            path = self.__snapshot_path()
+            with open(path, encoding='utf8') as infile:
+                self.__snapshot = infile.read()
+            self.__snapshot_time = os.path.getmtime(path)
+            self.__snapshot_checked = self.__snapshot_time
+        except OSError:
+            pass
+
+    def __snapshot_path(self):
+        # by name and URL, so that a replacement item doesn't pick up the
+        # copy of an older item's page
+        key = _digest('{}\n{}'.format(self.name, self.__url)).hex()
+        return os.path.join(os.getcwd(), CACHE_DIR, URLContent.SNAPSHOT_DIR,
+                            key + '.html')
+
+    @property
+    def snapshot_age(self):
+        '''
+        Seconds since the snapshot was taken, or None if there is none.
+        '''
+        if self.__snapshot_age is None or self.__snapshot_time is None:
+            return None
+        return time() - self.__snapshot_time
+
+    def refresh_snapshot(self, background=True):
+        '''
+        Fetch a new snapshot of the page if the last attempt was more
+        than the item's snapshot max-age ago (and one isn't already being
+        fetched).
+        '''
+        if self.__snapshot_age is None or self.__refreshing:
+            return
+        if self.__snapshot_checked is not None and \
+                time() - self.__snapshot_checked < self.__snapshot_age:
+            return
+        self.__snapshot_checked = time()
+        self.__refreshing = True
+        if background:
+            Thread(target=self.__fetch_snapshot, daemon=True).start()
+        else:
+            self.__fetch_snapshot()
+
+    def __fetch_snapshot(self):
+        try:
+            request = urllib.request.Request(
+                self.__url, headers={'User-Agent': 'csscreen'})
+            with urllib.request.urlopen(
+                    request, timeout=URLContent.SNAPSHOT_TIMEOUT) as response:
+                ctype = response.headers.get_content_type()
+                if ctype != 'text/html':
+                    raise Exception("not an HTML page ({})".format(ctype))
+                data = response.read(URLContent.SNAPSHOT_MAX_SIZE + 1)
+                charset = response.headers.get_content_charset() or 'utf-8'
+            if len(data) > URLContent.SNAPSHOT_MAX_SIZE:
+                raise Exception("page is larger than {} bytes".format(
+                                URLContent.SNAPSHOT_MAX_SIZE))
+            page = data.decode(charset, 'replace')
+            if not self.__removed:
+                path = self.__snapshot_path()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _atomic_write(path, page.encode('utf8'))
+            self.__snapshot = page
+            self.__snapshot_time = time()
+            self.__snapshot_error = None
+        except Exception as e:
+            # the last good copy, if any, is still shown
+            self.__snapshot_error = str(e)
+        finally:
+            self.__refreshing = False
 
     def render(self, webview, width, height):
         self.displayed()
-        webview.load(QUrl(self.__url))
+        self.refresh_snapshot()
+        if self.__snapshot_age is not None and self.__snapshot is not None:
+            webview.setHtml(self.__snapshot, QUrl(self.__url))
+        else:
+            webview.load(QUrl(self.__url))
 
     def content_removed(self):
-        pass
+        self.__removed = True
+        if self.__snapshot_age is not None:
+            try:
+                os.unlink(self.__snapshot_path())
+            except OSError:
+                pass
+
+    def content_replaced(self, item):
+        # an update that keeps the URL keeps the copy, which is kept
+        # under the same path
+        if isinstance(item, URLContent) and item.__url == self.__url and \
+                item.__snapshot_age is not None:
+            self.__removed = True
+        else:
+            self.content_removed()
+
+    def to_record(self):
+        record = ContentItem.to_record(self)
+        record['kwargs']['snapshot'] = self.__snapshot_age
+        record['url'] = self.__url
+        return record
+
+    def _restore(self, record):
+        ContentItem._restore(self, record)
+        self.__url = record['url']
+        self.__hash = _make_hash(self.__url)
+        self.__init_snapshot(record['kwargs'].get('snapshot', None))
 
     def __str__(self):
         return '{} {}'.format(ContentItem.__str__(self), str(self.__url))
 
-    def to_dict(self):
-        xdict = ContentItem.to_dict(self)
+    def to_dict(self, summary=False):
+        xdict = ContentItem.to_dict(self, summary)
         xdict['hash'] = self.__hash
-        xdict['content'] = str(self.__url)
+        if not summary:
+            xdict['content'] = str(self.__url)
+        if self.__snapshot_age is not None:
+            age = self.snapshot_age
+            xdict['snapshot'] = {
+                'max_age': self.__snapshot_age,
+                'age': None if age is None else int(age),
+                'error': self.__snapshot_error,
+            }
         return xdict
 
 
 class ImageContent(ContentItem):
-    def __init__(self, filename, name, content, **kwargs):
-        super(ImageContent, self).__init__(name, **kwargs)
-        # NB: filename should be an absolute path
-        absfile = self.__write_data(filename, content)
-        self.__filename = absfile
-        self.__hash = _make_hash(content)
-        self.__imgdim = self.__get_img_dimensions()
-        self.__caption = kwargs.pop('caption', '')
-        self.__frame = '''
+    FRAME = '''
 <!DOCTYPE html>
 <html lang="en">
   <head>
-    <link rel="stylesheet"
-  href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css">
+    <style>{}</style>
   </head>
   <body>
     <br>
@@ -289,68 +764,197 @@ class ImageContent(ContentItem):
   </body>
 </html>'''
 
-    def __write_data(self, filename, content):
-        base, ext = os.path.splitext(filename)
-        outdir = os.path.join(os.getcwd(), CACHE_DIR)
-        fd, outpath = tempfile.mkstemp(suffix=ext, dir=outdir, text=False)
-        os.close(fd)
-        with open(outpath, 'wb') as outfile:
-            outfile.write(content)
-        return outpath
+    # asset store key; None for items saved before the asset store existed
+    __key = None
+    # (image file, size attribute) and the page last made from FRAME
+    __page = None
+    # (key, 'width'|'height', size) of a copy of the image scaled down to
+    # the size it is shown at, or None if the original is shown
+    __derived = None
+    DERIVED_TYPES = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+    # prepare runs on the display's thread and content_removed may run on
+    # the RPC server's, so the scaled copy is swapped and released under
+    # this lock, and not replaced once the item has been removed
+    __derived_lock = Lock()
+    __removed = False
+
+    def __init__(self, filename, name, content, **kwargs):
+        '''
+        content is the image data.  Alternatively, content may be None and
+        the key keyword argument give the asset store key of image data
+        that has already been stored (e.g., by a streaming upload).
+        '''
+        super(ImageContent, self).__init__(name, **kwargs)
+        key = kwargs.get('key', None)
+        if content is None and key is not None:
+            asset_store.acquire(key)
+            digest = AssetStore.digest(key)
+            self.__key = key
+        else:
+            base, ext = os.path.splitext(filename)
+            digest = _digest(content)
+            self.__key = asset_store.put(content, ext, digest)
+        self.__filename = AssetStore.path(self.__key)
+        self.__hash = base64.b64encode(digest).decode('utf8')
+        self.__imgdim = self.__get_img_dimensions()
+        self.__caption = kwargs.pop('caption', '')
 
     def __get_img_dimensions(self):
-        status, output = getstatusoutput("file {}".format(self.__filename))
-        mobj = re.search(r"(?P<w>\d+)\s*x\s*(?P<h>\d+)", output)
-        if not mobj:
+        try:
+            dim = image_dimensions(self.__filename)
+        except OSError:
+            dim = None
+        if not dim:
             return (480, 640)  # default dimensions :-(
-        w = int(mobj.group('w'))
-        h = int(mobj.group('h'))
-        return (w, h)
+        return dim
 
-    def render(self, webview, width, height):
-        self.displayed()
+    def __show_size(self, width, height):
+        '''
+        Return which dimension of the image is constrained when showing it
+        in a width x height web view, and the size along that dimension.
+        '''
         imgw, imgh = self.__imgdim
-        showwidth = int(min(width, imgw) * 0.9)
-        showheight = int(min(height, imgh) * 0.9)
         if imgw < imgh:
-            wh = 'height'
-            dim = showheight
+            return 'height', int(min(height, imgh) * 0.9)
+        return 'width', int(min(width, imgw) * 0.9)
+
+    def prepare(self, width, height):
+        '''
+        Make a copy of the image scaled down to the size at which it is
+        shown in a width x height web view, so that large images aren't
+        decoded and scaled by the web view each time they are shown.
+        '''
+        wh, dim = self.__show_size(width, height)
+        with ImageContent.__derived_lock:
+            # a copy lost in a crash before its replacement was journaled
+            # is made again
+            if self.__removed or self.__derived is not None and \
+                    self.__derived[1:] == (wh, dim) and \
+                    os.path.exists(AssetStore.path(self.__derived[0])):
+                return False
+        derived = self.__make_derived(wh, dim)
+        with ImageContent.__derived_lock:
+            if self.__removed:
+                stale, changed = derived, False
+            else:
+                stale, changed = self.__derived, derived != self.__derived
+                self.__derived = derived
+        if stale is not None:
+            asset_store.release(stale[0])
+        return changed
+
+    def __make_derived(self, wh, dim):
+        ext = os.path.splitext(self.__filename)[1].lower()
+        imgw, imgh = self.__imgdim
+        # only scale down; GIFs may be animated and SVGs scale for free
+        if ext not in ImageContent.DERIVED_TYPES or \
+                dim >= (imgw if wh == 'width' else imgh):
+            return None
+        image = QImage(self.__filename)
+        if image.isNull():
+            return None
+        if wh == 'width':
+            image = image.scaledToWidth(dim, Qt.SmoothTransformation)
+        else:
+            image = image.scaledToHeight(dim, Qt.SmoothTransformation)
+        if ext in ('.jpg', '.jpeg'):
+            fmt, quality = 'JPG', 90
+        else:
+            fmt, quality = 'PNG', -1
+        xbuffer = QBuffer()
+        xbuffer.open(QIODevice.WriteOnly)
+        if not image.save(xbuffer, fmt, quality):
+            return None
+        key = asset_store.put(bytes(xbuffer.data()), '.' + fmt.lower())
+        return (key, wh, dim)
+
+    def render(self, webview, width, height):
+        self.displayed()
+        wh, dim = self.__show_size(width, height)
+        # the scaled copy is remade by the queue (see prepare) when the
+        # display size changes; until then, show the original
+        if self.__derived is None or self.__derived[1:] != (wh, dim):
+            filename = self.__filename
         else:
-            wh = 'width'
-            dim = showwidth
+            filename = AssetStore.path(self.__derived[0])
         wh = '{}="{}"'.format(wh, dim)
-        content = self.__frame.format(self.__filename, wh,
-                                      self.__caption)
-        webview.setHtml(content)
+        # the page only changes with the display size
+        if self.__page is None or self.__page[0] != (filename, wh):
+            self.__page = ((filename, wh), ImageContent.FRAME.format(
+                builtin_style(), filename, wh, self.__caption))
+        webview.setHtml(self.__page[1])
 
     def content_removed(self):
-        os.unlink(self.__filename)
+        with ImageContent.__derived_lock:
+            self.__removed = True
+            derived = self.__derived
+        if derived is not None:
+            asset_store.release(derived[0])
+        if self.__key is None:
+            os.unlink(self.__filename)
+        else:
+            asset_store.release(self.__key)
+
+    def to_record(self):
+        record = ContentItem.to_record(self)
+        record['key'] = self.__key
+        record['derived'] = self.__derived
+        record['filename'] = self.__filename
+        record['hash'] = self.__hash
+        record['dimensions'] = list(self.__imgdim)
+        record['caption'] = self.__caption
+        return record
+
+    def _restore(self, record):
+        ContentItem._restore(self, record)
+        self.__key = record.get('key', None)
+        if self.__key is not None:
+            asset_store.acquire(self.__key)
+        derived = record.get('derived', None)
+        if derived is not None:
+            self.__derived = tuple(derived)
+            asset_store.acquire(self.__derived[0])
+        self.__filename = record['filename']
+        self.__hash = record['hash']
+        self.__imgdim = tuple(record['dimensions'])
+        self.__caption = record['caption']
 
     def __str__(self):
         return '{} {}'.format(ContentItem.__str__(self), self.__filename)
 
-    def to_dict(self):
-        xdict = ContentItem.to_dict(self)
+    def to_dict(self, summary=False):
+        xdict = ContentItem.to_dict(self, summary)
         xdict['hash'] = self.__hash
-        xdict['content'] = str(self.__filename)
+        if not summary:
+            xdict['content'] = str(self.__filename)
         xdict['caption'] = self.__caption
         xdict['dimensions'] = 'x'.join(map(str, self.__imgdim))
         return xdict
 
 
 class HTMLContent(ContentItem):
+    INDEX = 'index.html'
+    # asset store keys; not set for items saved before the asset store
+    # existed
+    __page_key = None
+    __asset_keys = ()
+
     def __init__(self, htmltext, name, **kwargs):
         super(HTMLContent, self).__init__(name, **kwargs)
-        self.__dir, index = self._store_assets(htmltext, **kwargs)
-        self.__hash = _make_hash(htmltext)
+        digest = _digest(htmltext)
+        self.__dir, self.__index = self._store_assets(htmltext, digest,
+                                                      **kwargs)
+        self.__hash = base64.b64encode(digest).decode('utf8')
         self.__page = htmltext
-        self.__url = "file://{}".format(index)
+        self.__url = "file://{}".format(self.__index)
 
-    def _store_assets(self, htmltext, **kwargs):
+    def _store_assets(self, htmltext, digest, **kwargs):
         assets = {}
         for k, v in kwargs.items():
             if k.startswith('assetname'):
-                name = v
+                name = os.path.normpath(v)
+                if os.path.isabs(name) or name.startswith(os.pardir):
+                    raise Exception("Invalid asset name {}".format(v))
                 base, num = k.split('_')
                 content = kwargs.get("assetcontent_{}".format(num), None)
                 if content is None:
@@ -359,36 +963,81 @@ class HTMLContent(ContentItem):
 
         self.__assetnames = list(assets.keys())
 
-        xdir = tempfile.mkdtemp(dir=os.path.join(os.getcwd(), CACHE_DIR))
-        fd, indexpath = tempfile.mkstemp(suffix='.html', dir=xdir)
-        os.close(fd)
-        with open(indexpath, 'w') as outfile:
-            outfile.write(htmltext)
-
+        files = {}
         for name, content in assets.items():
-            outname = os.path.join(xdir, name)
-            with open(outname, 'wb') as outfile:
-                outfile.write(content)
-        return xdir, indexpath
+            files[name] = asset_store.put(content, os.path.splitext(name)[1])
+        files[HTMLContent.INDEX] = asset_store.put(htmltext.encode('utf8'),
+                                                   '.html', digest)
+        self.__asset_keys = list(files.values())
+        self.__page_key = asset_store.put_dir(files)
+
+        xdir = AssetStore.path(self.__page_key)
+        return xdir, os.path.join(xdir, HTMLContent.INDEX)
 
     def render(self, webview, width, height):
         self.displayed()
         webview.load(QUrl(self.__url))
 
     def content_removed(self):
-        shutil.rmtree(self.__dir, ignore_errors=True)
+        if self.__page_key is None:
+            shutil.rmtree(self.__dir, ignore_errors=True)
+            return
+        asset_store.release(self.__page_key)
+        for key in self.__asset_keys:
+            asset_store.release(key)
+
+    def to_record(self):
+        record = ContentItem.to_record(self)
+        record['page_key'] = self.__page_key
+        record['asset_keys'] = list(self.__asset_keys)
+        record['dir'] = self.__dir
+        record['index'] = self.__url[len('file://'):]
+        record['assets'] = self.__assetnames
+        return record
+
+    def _restore(self, record):
+        ContentItem._restore(self, record)
+        self.__dir = record['dir']
+        self.__index = record['index']
+        self.__assetnames = record['assets']
+        # read the page before taking references, so that an item whose
+        # files are gone holds none
+        with open(self.__index, encoding='utf8') as infile:
+            self.__page = infile.read()
+        self.__page_key = record.get('page_key', None)
+        self.__asset_keys = record.get('asset_keys', [])
+        for key in [self.__page_key] + self.__asset_keys:
+            if key is not None:
+                asset_store.acquire(key)
+        self.__hash = _make_hash(self.__page)
+        self.__url = "file://{}".format(self.__index)
 
     def __str__(self):
         return "{} '{}...'".format(ContentItem.__str__(self), self.__page[:20])
 
-    def to_dict(self):
-        xdict = ContentItem.to_dict(self)
+    def to_dict(self, summary=False):
+        xdict = ContentItem.to_dict(self, summary)
         xdict['hash'] = self.__hash
-        xdict['content'] = str(self.__page)
+        if not summary:
+            xdict['content'] = str(self.__page)
         xdict['assets'] = ','.join(self.__assetnames)
         return xdict
 
 
+def content_from_record(record):
+    '''
+    Recreate a content item from a dict made by ContentItem.to_record.
+    '''
+    classes = {cls.__name__: cls for cls in
+               (URLContent, ImageContent, HTMLContent)}
+    cls = classes.get(record['type'], None)
+    if cls is None:
+        raise Exception("Unknown content type {}".format(record['type']))
+    item = cls.__new__(cls)
+    item._restore(record)
+    return item
+
+
 class NoSuitableContentException(Exception):
     '''
     Exception is raised when no content items exist in the content queue,
@@ -398,29 +1047,467 @@ class NoSuitableContentException(Exception):
     pass
 
 
+class ScheduleIndex(object):
+    '''
+    Index of time-constrained content items by weekday-minute bucket
+    (bucket 0 is Monday 00:00, bucket MINUTES_PER_WEEK-1 is Sunday 23:59).
+
+    Each item's only/except specs are compiled once, when the item is
+    created, into a weekly bitmask with one bit per bucket (see
+    ContentItem.schedule_mask).  The set of items that are *not* eligible
+    is recomputed only when the bucket changes (at most once a minute), so
+    checking an item during rotation is a set lookup.  Items without any
+    time constraints are never indexed and are always eligible.
+    '''
+    ALWAYS = (1 << MINUTES_PER_WEEK) - 1
+
+    def __init__(self):
+        self.__masks = {}
+        self.__bucket = None
+        self.__blocked = set()
+
+    @staticmethod
+    def bucket(now):
+        return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+    @staticmethod
+    def spec_mask(spec):
+        '''
+        Return the weekly bitmask of buckets covered by a single
+        TimeConstraintSpec.
+        '''
+        end = min(spec.end, MINUTES_PER_DAY)
+        if end <= spec.begin:
+            return 0
+        span = (1 << (end - spec.begin)) - 1
+        mask = 0
+        for dow in (spec.days or range(7)):
+            mask |= span << (dow * MINUTES_PER_DAY + spec.begin)
+        return mask
+
+    @staticmethod
+    def compile(only, xexcept):
+        '''
+        Compile lists of only/except TimeConstraintSpecs into the weekly
+        bitmask of buckets in which an item may be displayed (any only
+        clause, and none of the except clauses).
+        '''
+        if only:
+            mask = 0
+            for spec in only:
+                mask |= ScheduleIndex.spec_mask(spec)
+        else:
+            mask = ScheduleIndex.ALWAYS
+        for spec in xexcept:
+            mask &= ~ScheduleIndex.spec_mask(spec)
+        return mask
+
+    def add(self, item):
+        mask = item.schedule_mask
+        if mask == ScheduleIndex.ALWAYS:
+            return
+        self.__masks[item.name] = mask
+        if self.__bucket is not None and not (mask >> self.__bucket) & 1:
+            self.__blocked.add(item.name)
+
+    def remove(self, name):
+        self.__masks.pop(name, None)
+        self.__blocked.discard(name)
+
+    def advance(self, now):
+        '''
+        Move the index to the bucket containing now.  Returns True if
+        the bucket changed (and eligibility may therefore have changed).
+        '''
+        bucket = ScheduleIndex.bucket(now)
+        if bucket == self.__bucket:
+            return False
+        self.__bucket = bucket
+        self.__blocked = { name for name, mask in self.__masks.items()
+                           if not (mask >> bucket) & 1 }
+        return True
+
+    def blocked(self, name):
+        '''
+        Return True if the named item may not be displayed in the
+        current bucket.
+        '''
+        return name in self.__blocked
+
+
+def _atomic_write(path, data):
+    '''
+    Replace the file at path with data (bytes), so that after a crash
+    the file holds either the old or the new contents in full.
+    '''
+    xdir = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=xdir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+    dirfd = os.open(xdir, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+class ContentJournal(object):
+    '''
+    Write-ahead journal for the content queue.  The saved state is a JSON
+    snapshot (a list of ContentItem.to_record dicts, in rotation order)
+    plus an append-only journal with one JSON entry per line, one of
+    {"op": "add", "item": record}, {"op": "update", "item": record},
+    {"op": "remove", "name": name} or {"op": "batch", "entries": [...]}.
+    A batch is a single line, so it is replayed either whole or not at all.
+
+    Once the journal grows past COMPACT_SIZE bytes it is set aside and a
+    new snapshot is written on a background thread; the set-aside journal
+    is deleted once the snapshot is safely on disk.  If a set-aside
+    journal is still there (its snapshot failed), the journal is appended
+    to it instead.  Replaying entries
+    onto a snapshot that already includes them is harmless, since adds
+    replace and removes of missing items are ignored.
+    '''
+    SNAPSHOT_FILE = 'content_queue.json'
+    JOURNAL_FILE = 'content_queue.journal'
+    COMPACT_SIZE = 64 * 1024
+
+    def __init__(self, snapshot_file=SNAPSHOT_FILE, journal_file=JOURNAL_FILE,
+                 compact_size=COMPACT_SIZE):
+        self.__snapshot_file = snapshot_file
+        self.__journal_file = journal_file
+        self.__old_journal_file = journal_file + '.old'
+        self.__compact_size = compact_size
+        self.__lock = Lock()
+        self.__compactor = None
+
+    def exists(self):
+        return any(os.path.exists(f) for f in (self.__snapshot_file,
+                   self.__journal_file, self.__old_journal_file))
+
+    def load(self):
+        '''
+        Return the list of item records given by the snapshot with the
+        journal(s) replayed on top of it.
+        '''
+        records = OrderedDict()
+        try:
+            with open(self.__snapshot_file) as infile:
+                for record in json.load(infile):
+                    records[record['name']] = record
+        except FileNotFoundError:
+            pass
+
+        for journal in (self.__old_journal_file, self.__journal_file):
+            try:
+                infile = open(journal)
+            except FileNotFoundError:
+                continue
+            with infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn final entry from a crash mid-append
+                        break
+                    if entry['op'] == 'batch':
+                        for subentry in entry['entries']:
+                            ContentJournal.__replay(records, subentry)
+                    else:
+                        ContentJournal.__replay(records, entry)
+        return list(records.values())
+
+    @staticmethod
+    def __replay(records, entry):
+        if entry['op'] == 'add':
+            records.pop(entry['item']['name'], None)
+            records[entry['item']['name']] = entry['item']
+        elif entry['op'] == 'update':
+            # replaced in place, keeping its position in the rotation
+            records[entry['item']['name']] = entry['item']
+        elif entry['op'] == 'remove':
+            records.pop(entry['name'], None)
+
+    def append(self, entry):
+        '''
+        Durably append an entry to the journal.  Returns True if the
+        journal has grown large enough that it should be compacted.
+        '''
+        line = json.dumps(entry) + '\n'
+        with self.__lock:
+            with open(self.__journal_file, 'a') as outfile:
+                outfile.write(line)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                size = outfile.tell()
+            return size > self.__compact_size and self.__compactor is None
+
+    def compact(self, records, background=True):
+        '''
+        Write records as the new snapshot and drop the journal entries
+        it supersedes.  records must reflect every entry appended so far,
+        so the caller must prevent concurrent appends until this returns.
+        If background is False, the snapshot is written before returning,
+        and a failure to write it is raised.
+        '''
+        with self.__lock:
+            # read once, since the writer clears it when done
+            compactor = self.__compactor
+            if compactor is not None:
+                if background:
+                    return
+                compactor.join()
+            if os.path.exists(self.__journal_file):
+                self.__set_aside()
+            data = json.dumps(records).encode('utf8')
+            if not background:
+                self.__write_snapshot(data)
+                return
+            compactor = Thread(target=self.__write_snapshot,
+                               args=(data,), daemon=True)
+            self.__compactor = compactor
+            compactor.start()
+
+    def __set_aside(self):
+        '''
+        Move the journal's entries to the end of the set-aside journal.
+        '''
+        try:
+            with open(self.__old_journal_file, 'rb') as infile:
+                old = infile.read()
+        except FileNotFoundError:
+            os.replace(self.__journal_file, self.__old_journal_file)
+            return
+        # drop a torn final entry, which would hide everything after it
+        old = old[:old.rfind(b'\n') + 1]
+        with open(self.__journal_file, 'rb') as infile:
+            _atomic_write(self.__old_journal_file, old + infile.read())
+        os.unlink(self.__journal_file)
+
+    def __write_snapshot(self, data):
+        try:
+            _atomic_write(self.__snapshot_file, data)
+            try:
+                os.unlink(self.__old_journal_file)
+            except FileNotFoundError:
+                pass
+        finally:
+            self.__compactor = None
+
+
 class ContentQueue(object):
-    SAVE_FILE = 'content_queue.bin'
+    # content queue state from older versions, migrated to the journal
+    # on startup
+    LEGACY_SAVE_FILE = 'content_queue.bin'
+    # display counters are saved separately from the queue itself, after
+    # STATS_FLUSH_DISPLAYS displays or STATS_FLUSH_SECONDS seconds,
+    # whichever comes first
+    STATS_FILE = 'content_stats.json'
+    STATS_FLUSH_DISPLAYS = 20
+    STATS_FLUSH_SECONDS = 300
 
     def __init__(self):
-        self.__queue = []
+        # rotation order, keyed by name; the first entry is the next
+        # candidate for display
+        self.__queue = OrderedDict()
+        # items taken out of rotation because their time window is
+        # closed; they rejoin at the tail of the rotation when it opens
+        self.__parked = OrderedDict()
+        # name -> item for everything in either of the above
+        self.__index = {}
+        self.__schedule = ScheduleIndex()
+        # min-heap of (expiry, seq, item); entries for items that have
+        # since been removed are discarded lazily when they reach the top
+        self.__expiry = []
+        self.__expiry_seq = count()
         self.__qlock = Lock()
+        self.__journal = ContentJournal()
+        self.__unflushed_displays = 0
+        self.__stats_flushed = time()
+        self.__stats_writer = None
+        self.__display_size = None
+        # bumped on every change to the set of items or their settings,
+        # and when display counters are flushed; the prefix keeps values
+        # from repeating across restarts
+        self.__instance = os.urandom(4).hex()
+        self.__changes = 0
         self.__create_cache_dir()
+        self.__legacy_restored = False
         self.__restore_content()
+        self.__restore_stats()
+        asset_store.sweep()
         self.__save_content()
+        if self.__legacy_restored:
+            # only once its content is safely in the snapshot, so that it
+            # is read again if that failed
+            os.replace(ContentQueue.LEGACY_SAVE_FILE,
+                       ContentQueue.LEGACY_SAVE_FILE + '.migrated')
 
     def __len__(self):
-        return len(self.__queue)
+        return len(self.__index)
+
+    def __contains__(self, name):
+        return name in self.__index
+
+    @property
+    def generation(self):
+        '''
+        Return a string that changes whenever items are added, removed or
+        updated, for clients to tell whether a listing they hold is out of
+        date.  Display counters change with every item shown, so they are
+        only covered as of the last time they were flushed to the stats
+        file (see STATS_FLUSH_DISPLAYS and STATS_FLUSH_SECONDS).  Read
+        this before listing the content, so that
+        a concurrent change makes the listing newer than the generation,
+        never older.
+        '''
+        return "{}.{}".format(self.__instance, self.__changes)
+
+    def __all_content(self):
+        return list(self.__queue.values()) + list(self.__parked.values())
+
+    def __index_content(self, item):
+        self.__index[item.name] = item
+        self.__schedule.add(item)
+        if item.expiry is not None:
+            heapq.heappush(self.__expiry,
+                           (item.expiry, next(self.__expiry_seq), item))
+
+    def __discard(self, item):
+        '''
+        Take item out of the rotation (or the parked list).  Returns
+        False if the item is no longer in the queue.
+        '''
+        name = item.name
+        if self.__index.get(name) is not item:
+            return False
+        del self.__index[name]
+        if self.__queue.pop(name, None) is None:
+            del self.__parked[name]
+        self.__schedule.remove(name)
+        return True
 
     def add_content(self, content):
+        '''
+        Add a content item to the tail of the rotation.  Returns False
+        (and does not add the item) if an item with the same name already
+        exists.
+        '''
+        # checked before preparing, which may decode the whole image, and
+        # again after, in case the name was taken meanwhile
+        if content.name in self:
+            return False
+        if self.__display_size is not None:
+            content.prepare(*self.__display_size)
         with self.__qlock:
-            self.__queue.append(content)
-        self.__save_content()
+            if content.name in self.__index:
+                return False
+            self.__index_content(content)
+            self.__queue[content.name] = content
+            self.__log({'op': 'add', 'item': content.to_record()})
+        return True
 
     def get_content(self, name):
         with self.__qlock:
-            for i in range(len(self.__queue)):
-                if self.__queue[i].name == name:
-                    return self.__queue[i]
+            return self.__index.get(name, None)
+
+    def __replace(self, item):
+        '''
+        Put item in place of the existing item of the same name, keeping
+        its place in the rotation and its display counters.
+        '''
+        name = item.name
+        old = self.__index[name]
+        item._restore_stats(old.display_count, old.last_display)
+        self.__schedule.remove(name)
+        self.__index_content(item)
+        if name in self.__queue:
+            self.__queue[name] = item
+        elif self.__schedule.blocked(name):
+            self.__parked[name] = item
+        else:
+            del self.__parked[name]
+            self.__queue[name] = item
+        old.content_replaced(item)
+
+    def apply_batch(self, operations, atomic=False):
+        '''
+        Apply a list of changes to the queue with a single lock
+        acquisition and a single journal write, so that neither the
+        display nor the saved state ever reflects part of a batch.  Each
+        operation is ('add', item), ('update', item) or ('remove', name);
+        an update replaces the item of the same name in place.
+
+        Operations that can't be applied (adding a name that exists, or
+        updating or removing one that doesn't) are skipped, or if atomic
+        is True, the whole batch is.  Returns a (success, reason) pair
+        for each operation.  As with add_content, items that were not
+        added are left for the caller to clean up.
+        '''
+        if self.__display_size is not None:
+            for op, arg in operations:
+                if op in ('add', 'update'):
+                    arg.prepare(*self.__display_size)
+
+        with self.__qlock:
+            # check the operations in order against the names they'd leave
+            names = set(self.__index)
+            results = []
+            for op, arg in operations:
+                name = arg if op == 'remove' else getattr(arg, 'name', None)
+                if op not in ('add', 'update', 'remove'):
+                    results.append((False, "unknown operation '{}'".format(op)))
+                elif op == 'add' and name in names:
+                    results.append((False, "content already exists with that name"))
+                elif op != 'add' and name not in names:
+                    results.append((False, "no content object named '{}'".format(name)))
+                elif op == 'add':
+                    names.add(name)
+                    results.append((True, "Create item: {}".format(str(arg))))
+                elif op == 'update':
+                    results.append((True, "content item '{}' updated".format(name)))
+                else:
+                    names.discard(name)
+                    results.append((True, "content item '{}' deleted".format(name)))
+
+            if atomic and not all(ok for ok, reason in results):
+                return [ (False, reason if not ok else "not applied: batch failed")
+                         for ok, reason in results ]
+
+            entries = []
+            for (op, arg), (ok, reason) in zip(operations, results):
+                if not ok:
+                    continue
+                if op == 'add':
+                    self.__index_content(arg)
+                    self.__queue[arg.name] = arg
+                    entries.append({'op': 'add', 'item': arg.to_record()})
+                elif op == 'update':
+                    self.__replace(arg)
+                    entries.append({'op': 'update', 'item': arg.to_record()})
+                else:
+                    item = self.__index[arg]
+                    self.__discard(item)
+                    item.content_removed()
+                    entries.append({'op': 'remove', 'name': arg})
+            if entries:
+                self.__log({'op': 'batch', 'entries': entries})
+            return results
+
+    def set_display_size(self, width, height):
+        '''
+        Set the size of the web view that content is rendered in, so that
+        items added from now on can be prepared for it.  Items already in
+        the queue are prepared for a new size as next_content returns them.
+        '''
+        self.__display_size = (width, height)
 
     def __create_cache_dir(self):
         try:
@@ -430,85 +1517,297 @@ class ContentQueue(object):
 
     def __restore_content(self):
         '''
-        Read saved content queue state from 'pickle' file.
+        Read saved content queue state from the snapshot and journal.
+        '''
+        if self.__journal.exists():
+            items = []
+            for record in self.__journal.load():
+                # an item that can't be restored (e.g., its files are
+                # gone) is dropped rather than keeping the display down
+                try:
+                    items.append(content_from_record(record))
+                except Exception as e:
+                    print("Skipping saved content item {}: {}".format(
+                          record.get('name'), e), file=sys.stderr)
+        else:
+            items = self.__restore_legacy()
+
+        for item in items:
+            self.__index_content(item)
+            self.__queue[item.name] = item
+
+    def __restore_legacy(self):
+        '''
+        Read content queue state saved by older versions as a 'pickle'
+        file.  The file is renamed once the first snapshot has been
+        written, so this happens only once.
         '''
         try:
-            pfile = open(ContentQueue.SAVE_FILE, 'rb')
+            pfile = open(ContentQueue.LEGACY_SAVE_FILE, 'rb')
         except:
-            self.__queue = []
-            return
+            return []
 
         with pfile:
-            self.__queue = pickle.load(pfile)
+            items = pickle.load(pfile)
+        self.__legacy_restored = True
+        return items
+
+    def __restore_stats(self):
+        '''
+        Apply saved display counters to the restored content items.  The
+        snapshot may hold newer counters than the stats file, so the
+        larger count wins.
+        '''
+        try:
+            with open(ContentQueue.STATS_FILE) as infile:
+                stats = json.load(infile)
+        except (OSError, ValueError):
+            return
+
+        for name, (display_count, last_display) in stats.items():
+            item = self.__index.get(name, None)
+            if item is not None and display_count > item.display_count:
+                item._restore_stats(display_count, last_display)
+
+    def __flush_stats(self, background=True):
+        '''
+        Write display counters for all items to the stats file.
+        '''
+        with self.__qlock:
+            if self.__stats_writer is not None and \
+                    self.__stats_writer.is_alive():
+                if background:
+                    return
+                self.__stats_writer.join()
+            stats = { c.name: [c.display_count, c.last_display]
+                      for c in self.__all_content() }
+            if self.__unflushed_displays:
+                # so that clients holding a listing refetch the counters
+                self.__changes += 1
+            self.__unflushed_displays = 0
+            self.__stats_flushed = time()
+        data = json.dumps(stats).encode('utf8')
+        if background:
+            self.__stats_writer = Thread(target=_atomic_write, daemon=True,
+                                         args=(ContentQueue.STATS_FILE, data))
+            self.__stats_writer.start()
+        else:
+            _atomic_write(ContentQueue.STATS_FILE, data)
 
     def __save_content(self):
         '''
-        Save current content queue data to 'pickle' file.
+        Write a full snapshot of the content queue, replacing the journal.
+        '''
+        with self.__qlock:
+            records = [ c.to_record() for c in self.__all_content() ]
+            self.__journal.compact(records, background=False)
+
+    def __log(self, entry):
+        '''
+        Record a change to the queue in the journal.  Must be called with
+        the queue lock held, so that the journal and any snapshot taken
+        for compaction agree with the queue.
         '''
-        with open(ContentQueue.SAVE_FILE, 'wb') as pfile:
-            pickle.dump(self.__queue, pfile)
+        self.__changes += 1
+        if self.__journal.append(entry):
+            records = [ c.to_record() for c in self.__all_content() ]
+            self.__journal.compact(records)
 
     def shutdown(self):
         self.__save_content()
+        self.__flush_stats(background=False)
 
-    def __expire_content(self):
+    def next_expiry(self):
+        '''
+        Return the earliest expiration time of any item in the queue, or
+        None if no item has an expiration time.
+        '''
+        with self.__qlock:
+            while self.__expiry:
+                item = self.__expiry[0][2]
+                if self.__index.get(item.name) is item:
+                    return self.__expiry[0][0]
+                heapq.heappop(self.__expiry)
+            return None
+
+    def expire_content(self):
+        '''
+        Remove all items whose expiration time has passed.  Returns the
+        number of items removed.
+        '''
         now = datetime.now()
-        killlist = []
+        expired = []
         with self.__qlock:
-            for i in range(len(self.__queue)):
-                if self.__queue[i].expiry and now >= self.__queue[i].expiry:
-                    killlist.append(i)
-            for i in killlist:
-                self.__queue[i].content_removed()
-                del self.__queue[i]
-            if killlist:
-                self.__save_content()
-
-    def next_content(self):
-        self.__expire_content()
+            # common case: nothing has expired, so a single peek suffices
+            if not self.__expiry or self.__expiry[0][0] > now:
+                return 0
+            while self.__expiry and self.__expiry[0][0] <= now:
+                item = heapq.heappop(self.__expiry)[2]
+                if self.__discard(item):
+                    expired.append(item)
+            for item in expired:
+                item.content_removed()
+                self.__log({'op': 'remove', 'name': item.name})
+        return len(expired)
+
+    def __unpark(self):
+        '''
+        Return parked items whose time window has opened to the tail of
+        the rotation, keeping their relative order.
+        '''
+        for name in list(self.__parked):
+            if not self.__schedule.blocked(name):
+                self.__queue[name] = self.__parked.pop(name)
 
-        if not len(self.__queue):
-            raise NoSuitableContentException()
+    def next_content(self, expire=True):
+        '''
+        Return the next content item to display, rotating the queue.  If
+        expire is False, expired items are not purged first (the caller
+        is expected to call expire_content on its own schedule).
+        '''
+        if expire:
+            self.expire_content()
 
         with self.__qlock:
-            maxiter = len(self.__queue)
-            i = 0
-
-            now = datetime.now()
-            while True:
-                xnext = self.__queue.pop(0)
-                self.__queue.append(xnext)
-                i += 1
-
-                if xnext.should_display(now):
-                    return xnext
-
-                if i == maxiter:
-                    raise NoSuitableContentException()
+            if self.__schedule.advance(datetime.now()):
+                self.__unpark()
+
+            # each blocked item is parked at most once per bucket, so
+            # over a run of ticks this is amortized O(1)
+            xnext = None
+            while self.__queue:
+                name, item = self.__queue.popitem(last=False)
+                if self.__schedule.blocked(name):
+                    self.__parked[name] = item
+                    continue
+                self.__queue[name] = item
+                xnext = item
+                break
+
+            if xnext is None:
+                raise NoSuitableContentException()
+
+            # counters are bumped when the returned item is rendered, so
+            # a flush here picks up all displays up to the previous one
+            self.__unflushed_displays += 1
+            flush = self.__unflushed_displays > \
+                ContentQueue.STATS_FLUSH_DISPLAYS or \
+                time() - self.__stats_flushed >= ContentQueue.STATS_FLUSH_SECONDS
+
+        if flush:
+            self.__flush_stats()
+
+        # adapt to a change in display size, journaling the new record so
+        # that a restored item doesn't refer to files prepare released
+        if self.__display_size is not None and \
+                xnext.prepare(*self.__display_size):
+            with self.__qlock:
+                if self.__index.get(xnext.name) is xnext:
+                    self.__log({'op': 'update', 'item': xnext.to_record()})
+        return xnext
 
     def remove_content(self, name):
+        '''
+        Remove the named content item.  Returns the removed item, or None
+        if no item has that name.
+        '''
         with self.__qlock:
-            killidx = -1
-            for i in range(len(self.__queue)):
-                if self.__queue[i].name == name:
-                    killidx = i
-                    break
-
-            if killidx != -1:
-                self.__queue[i].content_removed()
-                del self.__queue[i]
-                self.__save_content()
+            item = self.__index.get(name, None)
+            if item is None:
+                return None
+            self.__discard(item)
+            item.content_removed()
+            self.__log({'op': 'remove', 'name': name})
+            return item
+
+    def refresh_snapshots(self):
+        '''
+        Start refreshing, in the background, the snapshots of any URL
+        items that are due for it (see URLContent.refresh_snapshot).
+        '''
+        with self.__qlock:
+            items = self.__all_content()
+        for item in items:
+            if isinstance(item, URLContent):
+                item.refresh_snapshot()
 
     def list_content(self):
         with self.__qlock:
-            return [ str(c) for c in self.__queue ]
+            return [ str(c) for c in self.__all_content() ]
+
+    def manifest(self):
+        '''
+        Return a dict mapping each item's name to its manifest entry (see
+        ContentItem.manifest_entry).
+        '''
+        with self.__qlock:
+            return { c.name: c.manifest_entry() for c in self.__all_content() }
 
-    def list_content_as_dict(self):
+    def list_content_as_dict(self, summary=False):
         with self.__qlock:
-            return [ c.to_dict() for c in self.__queue ]
+            return [ c.to_dict(summary) for c in self.__all_content() ]
+
+
+def _benchmark(nitems=200, nchecks=2000):
+    # time should_display over a week of random times for items with
+    # random constraints, against evaluating the constraint objects
+    import random
+    from time import perf_counter
+
+    rng = random.Random(1)
+
+    def constraint():
+        days = ''.join(d for d in 'MTWRFSU' if rng.random() < 0.4)
+        begin = rng.randrange(0, 23 * 60)
+        end = rng.randrange(begin + 1, 24 * 60 + 1)
+        return '{}:{:02d}{:02d}-{:02d}{:02d}'.format(
+            days, begin // 60, begin % 60, end // 60, end % 60)
+
+    specs = []
+    for i in range(nitems):
+        specs.append(([ constraint() for j in range(rng.randrange(3)) ],
+                      [ constraint() for j in range(rng.randrange(3)) ]))
+    start = perf_counter()
+    items = [ URLContent('http://cs.colgate.edu/', 'item{}'.format(i),
+                         only=only, xexcept=xexcept)
+              for i, (only, xexcept) in enumerate(specs) ]
+    elapsed = perf_counter() - start
+    print("{:>24}: {:8.2f} us/item".format('create', elapsed * 1e6 / nitems))
+    objects = [ ([ Only(c) for c in only ], [ Except(c) for c in xexcept ])
+                for only, xexcept in specs ]
+    week = datetime(2017, 5, 22)
+    times = [ week + timedelta(minutes=rng.randrange(MINUTES_PER_WEEK))
+              for i in range(nchecks) ]
+
+    start = perf_counter()
+    old = [ _should_display_unindexed(only, xexcept, now)
+            for now in times for only, xexcept in objects ]
+    elapsed = perf_counter() - start
+    print("{:>24}: {:8.3f} us/check".format(
+          'constraint objects', elapsed * 1e6 / len(old)))
+    start = perf_counter()
+    new = [ item.should_display(now) for now in times for item in items ]
+    elapsed = perf_counter() - start
+    print("{:>24}: {:8.3f} us/check".format(
+          'compiled bitmask', elapsed * 1e6 / len(new)))
+    start = perf_counter()
+    for now in times[:nchecks // 10]:
+        for item in items:
+            item.next_display_time(now)
+    elapsed = perf_counter() - start
+    print("{:>24}: {:8.3f} us/call".format(
+          'next_display_time', elapsed * 1e6 / (nchecks // 10 * nitems)))
+    if old != new:
+        print("  results differ!")
 
 
 if __name__ == '__main__':
+    # microbenchmark of the time constraint checks:
+    #   python3 screencontent.py --bench
+    if sys.argv[1:] == ['--bench']:
+        _benchmark()
+        sys.exit(0)
+
     q = ContentQueue()
     q.shutdown()
 
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
-from time import asctime
+from time import asctime, monotonic
+from datetime import datetime
+from collections import deque
 import signal
 import os
 from abc import ABCMeta,abstractmethod
@@ -9,36 +11,46 @@ import argparse
 
 from screencontent import *
 from screenrpc import start_rpc_server
+from screenmetrics import ItemMetrics
 
 assert(sys.version_info.major == 3)
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from PyQt4.QtWebKit import *
+from PyQt4.QtNetwork import *
 
 running = True
 
 class Display(QWidget):
-    def __init__(self, content_queue, parent=None, timefontsize=20):
+    # longest wait, in seconds, for the next item to finish loading
+    # before it is shown anyway
+    LOAD_TIMEOUT = 5
+    # the web views' disk cache is kept in CACHE_DIR/WEB_CACHE_DIR
+    WEB_CACHE_DIR = 'web'
+    # how often, in seconds, to check for URL snapshots due a refresh
+    SNAPSHOT_CHECK = 30
+
+    def __init__(self, content_queue, parent=None, timefontsize=20,
+                 expiry_timer=False, web_cache_size=0):
         super(Display, self).__init__(parent)
 
         self.__content_queue = content_queue
         self.__timefontsize = timefontsize
+        self.__expiry_timer = expiry_timer
 
         self.__nocontent = HTMLContent('''
         <!DOCTYPE html>
         <html lang="en">
         <head>
-          <script src="https://code.jquery.com/jquery-2.1.1.min.js"></script>
-            <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css">
-            <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js"></script>
+          <style>{}</style>
         </head>
         <body>
           <div class="jumbotron">
           <h1><span class="alert alert-danger">No content here!</span></h1>
           <br><br>
           <p>This screen would be way more interesting if content were added, right?</p>
-          </div></body></html>''', 'nocontent', duration=2)
+          </div></body></html>'''.format(builtin_style()), 'nocontent', duration=2)
 
 
         self.time = QLabel()
@@ -49,13 +61,51 @@ class Display(QWidget):
         p = QPalette()
         p.setBrush(QPalette.Text,QColor("darkRed"))
 
-        self.webview = QWebView()
+        # two web views, one showing the current item while the next
+        # item loads in the other, so that items are only shown once
+        # they have loaded; self.webview is the one on screen
+        self.__views = (QWebView(), QWebView())
+        self.__stack = QStackedWidget()
+        self.__network = self.__make_network(web_cache_size)
+        for view in self.__views:
+            view.page().setNetworkAccessManager(self.__network)
+            self.__stack.addWidget(view)
+            view.loadStarted.connect(
+                lambda view=view: self.load_started(view))
+            view.loadFinished.connect(
+                lambda ok, view=view: self.load_finished(view, ok))
+        self.webview = self.__views[0]
         self.webview.setHtml("<h1>Starting...</h1>")
 
+        # the item loading in the hidden view; each preload is numbered,
+        # and __started is the number of the last one whose page load
+        # has started, so that signals from an aborted earlier load in
+        # the same view are ignored
+        self.__next_item = None
+        self.__load_start = None
+        self.__loaded = False
+        self.__preloads = 0
+        self.__started = None
+        # whether the current item's time is up, and the next item is
+        # shown as soon as it has loaded
+        self.__waiting = False
+        # recent (item name, seconds to load) and how many items were
+        # shown late or before they had loaded
+        self.__load_times = deque(maxlen=100)
+        self.__late = 0
+        self.__timeouts = 0
+        # the item on screen and since when, and since when the display
+        # has been waiting for the next item to load
+        self.__shown = None
+        self.__shown_since = None
+        self.__wait_start = None
+        # per-item metrics, for the RPC /metrics request
+        self.metrics = ItemMetrics()
+
         mainLayout = QVBoxLayout()
         mainLayout.addWidget(self.time, 1)
         mainLayout.addSpacing(10)
-        mainLayout.addWidget(self.webview, 100)
+        mainLayout.addWidget(self.__stack, 100)
 
         self.setLayout(mainLayout)
         self.setWindowTitle("csdisplay")
@@ -63,11 +113,66 @@ class Display(QWidget):
         self.clock = QTimer()
         self.clock.timeout.connect(self.clock_update)
         self.clock.start(1000)
+        # how late each clock tick ran, as a measure of how responsive
+        # the GUI thread is
+        self.__last_tick = monotonic()
+        self.__tick_lag = deque(maxlen=60)
+
+        # optional dedicated timer that fires at the next content expiry,
+        # instead of checking for expired content on every rotation
+        self.expiry_clock = QTimer()
+        self.expiry_clock.setSingleShot(True)
+        self.expiry_clock.timeout.connect(self.expiry_update)
+
+        self.load_clock = QTimer()
+        self.load_clock.setSingleShot(True)
+        self.load_clock.timeout.connect(self.load_timeout)
+
+        # URL snapshots are refreshed on their own schedule, not only
+        # when their items come up for display
+        self.snapshot_clock = QTimer()
+        self.snapshot_clock.timeout.connect(
+            self.__content_queue.refresh_snapshots)
+        self.snapshot_clock.start(self.SNAPSHOT_CHECK * 1000)
 
         QTimer.singleShot(1000, self.content_update)
 
+    def __make_network(self, web_cache_size):
+        # one network access manager for both web views, so that they
+        # share connections and, if web_cache_size (in bytes) is given, a
+        # disk cache that is kept across restarts.  Cached responses are
+        # used as their HTTP cache headers allow.
+        network = QNetworkAccessManager(self)
+        self.__web_cache = None
+        if web_cache_size:
+            self.__web_cache = QNetworkDiskCache(network)
+            self.__web_cache.setCacheDirectory(os.path.join(
+                os.getcwd(), CACHE_DIR, Display.WEB_CACHE_DIR))
+            self.__web_cache.setMaximumCacheSize(web_cache_size)
+            network.setCache(self.__web_cache)
+        network.finished.connect(self.request_finished)
+        self.__cache_hits = 0
+        self.__cache_misses = 0
+        self.__cache_size = 0
+        self.__cache_max = web_cache_size
+        return network
+
+    def request_finished(self, reply):
+        if reply.url().scheme() not in ('http', 'https'):
+            return
+        if reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
+            self.__cache_hits += 1
+        else:
+            self.__cache_misses += 1
+        if self.__web_cache is not None:
+            # read here rather than from the RPC server thread
+            self.__cache_size = self.__web_cache.cacheSize()
+
     def stop(self):
         self.clock.stop()
+        self.expiry_clock.stop()
+        self.load_clock.stop()
+        self.snapshot_clock.stop()
         self.close()
         self.__nocontent.content_removed()
 
@@ -77,27 +182,172 @@ class Display(QWidget):
             self.stop()
             return
 
+        now = monotonic()
+        self.__tick_lag.append(max(0, now - self.__last_tick - 1.0))
+        self.__last_tick = now
+
         self.time.setText(asctime())
 
+    def status(self):
+        '''
+        Return a dict of display status for the RPC /ping request.  Called
+        from the RPC server thread.
+        '''
+        xstatus = {}
+        lag = list(self.__tick_lag)
+        if lag:
+            xstatus['gui_lag_ms'] = {
+                'mean': round(sum(lag) * 1000 / len(lag), 1),
+                'max': round(max(lag) * 1000, 1),
+            }
+        loads = list(self.__load_times)
+        if loads:
+            times = [ t for name, t in loads ]
+            xstatus['load_ms'] = {
+                'mean': round(sum(times) * 1000 / len(times), 1),
+                'max': round(max(times) * 1000, 1),
+                # the latest load time of each recently shown item
+                'items': { name: round(t * 1000, 1) for name, t in loads },
+                'late': self.__late,
+                'timeouts': self.__timeouts,
+            }
+        if self.__web_cache is not None:
+            xstatus['web_cache'] = {
+                'hits': self.__cache_hits,
+                'misses': self.__cache_misses,
+                'size': self.__cache_size,
+                'max_size': self.__cache_max,
+            }
+        return xstatus
+
+    def schedule_expiry(self):
+        self.expiry_clock.stop()
+        when = self.__content_queue.next_expiry()
+        if when is None:
+            return
+        msec = (when - datetime.now()).total_seconds() * 1000
+        # QTimer intervals are limited to a signed 32-bit msec value;
+        # cap at an hour and just reschedule when the timer fires
+        self.expiry_clock.start(int(min(max(msec, 0), 3600*1000)))
+
+    def expiry_update(self):
+        self.__content_queue.expire_content()
+        self.schedule_expiry()
+
     def content_update(self):
+        '''
+        Called when the current item's time is up: show the next item,
+        which has usually finished loading in the hidden view by now.
+        Otherwise it is shown once it has loaded, or after LOAD_TIMEOUT
+        seconds.
+        '''
         global running
         if not running:
             self.stop()
             return
 
+        if self.__expiry_timer:
+            # pick up any newly added content with an earlier expiry
+            self.schedule_expiry()
+
+        if not self.__next_wanted():
+            self.preload()
+        if self.__loaded:
+            self.swap()
+        else:
+            self.__waiting = True
+            self.__wait_start = monotonic()
+            self.load_clock.start(self.LOAD_TIMEOUT * 1000)
+
+    def __hidden_view(self):
+        return self.__views[1] if self.webview is self.__views[0] \
+            else self.__views[0]
+
+    def __next_wanted(self):
+        # whether the preloaded item is still the one to show, i.e., it
+        # hasn't been removed or replaced, and (for the no-content page)
+        # no content has since been added
+        item = self.__next_item
+        if item is None:
+            return False
+        if item is self.__nocontent:
+            return len(self.__content_queue) == 0
+        return self.__content_queue.get_content(item.name) is item
+
+    def preload(self):
+        '''
+        Start loading the next item from the content queue in the hidden
+        web view.
+        '''
+        # qsize = self.webview.page().mainFrame().contentsSize()
+        qsize = self.webview.frameSize()
+        # lets newly added content prepare itself for this display size
+        self.__content_queue.set_display_size(qsize.width(), qsize.height())
+
         try:
-            item = self.__content_queue.next_content()
+            item = self.__content_queue.next_content(
+                expire=not self.__expiry_timer)
         except NoSuitableContentException:
             item = self.__nocontent
 
-        # qsize = self.webview.page().mainFrame().contentsSize()
-        qsize = self.webview.frameSize()
-
-        # as content item to render itself to the display
-        item.render(self.webview, qsize.width(), qsize.height())
+        # an unfinished load of a replaced item signals its end now,
+        # which is ignored as it doesn't belong to this preload
+        self.__preloads += 1
+        view = self.__hidden_view()
+        view.stop()
+        self.__next_item = item
+        self.__loaded = False
+        self.__load_start = monotonic()
+        # as content item to render itself to the (hidden) display
+        item.render(view, qsize.width(), qsize.height())
+
+    def load_started(self, view):
+        if view is not self.webview:
+            self.__started = self.__preloads
+
+    def load_finished(self, view, ok):
+        # pages may signal more than once, e.g., for frames; only the
+        # first signal from the hidden view for the current preload counts
+        if view is self.webview or self.__next_item is None or \
+                self.__started != self.__preloads or self.__loaded:
+            return
+        self.__loaded = True
+        elapsed = monotonic() - self.__load_start
+        self.__load_times.append((self.__next_item.name, elapsed))
+        self.metrics.loaded(self.__next_item.name, elapsed, ok,
+                            view.page().bytesReceived())
+        if self.__waiting:
+            self.__late += 1
+            self.swap()
+
+    def load_timeout(self):
+        if self.__waiting:
+            self.__timeouts += 1
+            self.metrics.load_timeout(self.__next_item.name)
+            self.swap()
+
+    def swap(self):
+        '''
+        Show the item in the hidden web view for its display duration, and
+        start loading the item after it.
+        '''
+        self.load_clock.stop()
+        item = self.__next_item
+        now = monotonic()
+        if self.__waiting:
+            self.metrics.waited(item.name, now - self.__wait_start)
+        self.__waiting = False
+        if self.__shown is not None:
+            self.metrics.shown(self.__shown.name, now - self.__shown_since,
+                               self.__shown.display_duration)
+        self.__shown = item
+        self.__shown_since = now
+        self.webview = self.__hidden_view()
+        self.__stack.setCurrentWidget(self.webview)
 
         # display_duration is in sec
         QTimer.singleShot(item.display_duration*1000, self.content_update)
+        self.preload()
 
 def sigint(*args):
     global running
@@ -121,13 +371,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='CS screen display')
     parser.add_argument('--password', '-p', default='password', help='Specify password used to authenticate requests for modifying and querying content on the display')
     parser.add_argument('--fullscreen', default=False, action='store_true', help='Specify whether the display should go into full screen on startup')
+    parser.add_argument('--web-cache', type=int, default=50, metavar='MB', help='Size in MB of the disk cache for pages, images, stylesheets and so on loaded by the display (0 for none)')
+    parser.add_argument('--expiry-timer', default=False, action='store_true', help='Remove expired content using a timer set for the next expiration time, rather than checking on each content rotation')
     args = parser.parse_args()
 
     content_queue = ContentQueue()
 
-    rpcserver = start_rpc_server(content_queue, args.password)
+    screen = Display(content_queue, expiry_timer=args.expiry_timer,
+                     web_cache_size=args.web_cache * 1024 * 1024)
 
-    screen = Display(content_queue)
+    rpcserver = start_rpc_server(content_queue, args.password,
+                                 status=screen.status,
+                                 metrics=screen.metrics.exposition)
 
     # block here until app dies
     if args.fullscreen:
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+'''
+Read image dimensions from file headers, without decoding the image or
+running an external program.  Supports PNG, JPEG, GIF, WebP, BMP and SVG.
+'''
+
+import sys
+import re
+import struct
+
+assert(sys.version_info.major == 3)
+
+# enough for every supported header except JPEG, whose segments are
+# skipped with seeks instead of being read
+HEADER_SIZE = 4096
+
+_SVG_TAG = re.compile(rb'<svg\b[^>]*>', re.IGNORECASE | re.DOTALL)
+_SVG_NUMBER = r'\s*([0-9]*\.?[0-9]+)\s*(px)?\s*$'
+
+
+def _png(head, infile):
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+
+
+def _gif(head, infile):
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+
+
+def _bmp(head, infile):
+    if head[:2] != b'BM' or len(head) < 26:
+        return None
+    size, = struct.unpack('<I', head[14:18])
+    if size == 12:
+        # OS/2 BITMAPCOREHEADER
+        return struct.unpack('<HH', head[18:22])
+    w, h = struct.unpack('<ii', head[18:26])
+    return w, abs(h)
+
+
+def _webp(head, infile):
+    if head[:4] != b'RIFF' or head[8:12] != b'WEBP':
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        w, h = struct.unpack('<HH', head[26:30])
+        return w & 0x3fff, h & 0x3fff
+    if chunk == b'VP8L' and head[20:21] == b'\x2f':
+        bits, = struct.unpack('<I', head[21:25])
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        w = int.from_bytes(head[24:27], 'little') + 1
+        h = int.from_bytes(head[27:30], 'little') + 1
+        return w, h
+
+
+def _jpeg(head, infile):
+    if head[:2] != b'\xff\xd8':
+        return None
+    infile.seek(2)
+    while True:
+        marker = infile.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        code = marker[1]
+        # fill bytes and standalone markers have no length field
+        if code == 0xff:
+            infile.seek(-1, 1)
+            continue
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            continue
+        seglen = infile.read(2)
+        if len(seglen) < 2:
+            return None
+        seglen, = struct.unpack('>H', seglen)
+        # SOF0-SOF15, except DHT (c4), JPG (c8) and DAC (cc)
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            sof = infile.read(5)
+            if len(sof) < 5:
+                return None
+            h, w = struct.unpack('>HH', sof[1:5])
+            return w, h
+        infile.seek(seglen - 2, 1)
+
+
+def _svg_length(value):
+    mobj = re.match(_SVG_NUMBER, value)
+    if mobj:
+        return float(mobj.group(1))
+
+
+def _svg(head, infile):
+    mobj = _SVG_TAG.search(head)
+    if not mobj:
+        return None
+    tag = mobj.group(0).decode('utf8', 'replace')
+    attrs = dict(re.findall(r'([\w:-]+)\s*=\s*["\']([^"\']*)["\']', tag))
+    w = _svg_length(attrs.get('width', ''))
+    h = _svg_length(attrs.get('height', ''))
+    if w and h:
+        return int(round(w)), int(round(h))
+    viewbox = attrs.get('viewBox', '').replace(',', ' ').split()
+    if len(viewbox) == 4:
+        try:
+            vw, vh = float(viewbox[2]), float(viewbox[3])
+        except ValueError:
+            return None
+        if vw <= 0 or vh <= 0:
+            return None
+        # a single given dimension scales the viewBox
+        if w:
+            return int(round(w)), int(round(w * vh / vw))
+        if h:
+            return int(round(h * vw / vh)), int(round(h))
+        return int(round(vw)), int(round(vh))
+
+
+_READERS = (_png, _jpeg, _gif, _webp, _bmp, _svg)
+
+
+def image_dimensions(filename):
+    '''
+    Return the (width, height) of the image in filename, or None if the
+    format is not recognized or the header is damaged.
+    '''
+    with open(filename, 'rb') as infile:
+        head = infile.read(HEADER_SIZE)
+        for reader in _READERS:
+            try:
+                dim = reader(head, infile)
+            except struct.error:
+                dim = None
+            if dim:
+                return dim
+    return None
+
+
+def _file_dimensions(filename):
+    # the subprocess-based method previously used by ImageContent, kept
+    # here for benchmarking
+    from subprocess import getstatusoutput
+    status, output = getstatusoutput("file {}".format(filename))
+    mobj = re.search(r"(?P<w>\d+)\s*x\s*(?P<h>\d+)", output)
+    if not mobj:
+        return None
+    return int(mobj.group('w')), int(mobj.group('h'))
+
+
+def _decode_cost(filename, size=None):
+    # time and memory to decode an image, optionally after scaling it the
+    # way ImageContent does for a web view of the given size
+    from time import perf_counter
+    from PyQt4.QtCore import Qt, QBuffer, QIODevice
+    from PyQt4.QtGui import QImage
+
+    if size is not None:
+        image = QImage(filename)
+        if image.isNull():
+            return None
+        image = image.scaledToWidth(size, Qt.SmoothTransformation)
+        xbuffer = QBuffer()
+        xbuffer.open(QIODevice.WriteOnly)
+        image.save(xbuffer, 'PNG')
+        data = bytes(xbuffer.data())
+        start = perf_counter()
+        image = QImage.fromData(data)
+    else:
+        start = perf_counter()
+        image = QImage(filename)
+    elapsed = perf_counter() - start
+    if image.isNull():
+        return None
+    return elapsed, image.byteCount()
+
+
+if __name__ == '__main__':
+    # benchmark against 'file' across a corpus of images:
+    #   python3 screenimage.py image_dir_or_file ...
+    # or compare decode time and memory of full-size images with copies
+    # scaled for a display of the given width (needs PyQt4):
+    #   python3 screenimage.py --decode 1920 image_dir_or_file ...
+    import os
+    import argparse
+    from time import perf_counter
+
+    parser = argparse.ArgumentParser(description='Image header benchmark')
+    parser.add_argument('--decode', type=int, default=None, metavar='WIDTH',
+                        help='Measure decode cost of full-size vs scaled images')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    files = []
+    for arg in args.paths:
+        if os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                files.extend(os.path.join(dirpath, f) for f in filenames)
+        else:
+            files.append(arg)
+    files = [ f for f in files if os.path.isfile(f) ]
+
+    if args.decode:
+        from PyQt4.QtGui import QApplication
+        app = QApplication(sys.argv)
+        for label, size in (('full size', None),
+                            ('scaled', int(args.decode * 0.9))):
+            costs = [ c for c in (_decode_cost(f, size) for f in files) if c ]
+            if not costs:
+                continue
+            print("{:>10}: {:8.2f} ms/image decode, {:8.1f} KiB/image".format(
+                  label, sum(c[0] for c in costs) * 1000 / len(costs),
+                  sum(c[1] for c in costs) / 1024 / len(costs)))
+        sys.exit(0)
+
+    results = {}
+    for method in (image_dimensions, _file_dimensions):
+        start = perf_counter()
+        results[method] = [ method(f) for f in files ]
+        elapsed = perf_counter() - start
+        print("{:>18}: {:8.2f} ms total, {:7.3f} ms/image".format(
+              method.__name__, elapsed * 1000, elapsed * 1000 / len(files)))
+
+    for f, native, sub in zip(files, results[image_dimensions],
+                              results[_file_dimensions]):
+        if native != sub:
+            print("  differs: {} native={} file={}".format(f, native, sub))
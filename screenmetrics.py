@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+'''
+Per-item display metrics (load times, load failures, bytes loaded and
+time on screen), kept as counters and histograms and written out in the
+Prometheus text exposition format for the RPC /metrics request.
+'''
+
+import sys
+from bisect import bisect_left
+from threading import Lock
+
+assert(sys.version_info.major == 3)
+
+
+class Histogram(object):
+    '''
+    Counts of observed values falling at or below each of a fixed set of
+    bucket bounds, plus their sum and count.
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket, and one for values above the last
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.__counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        Return a list of (bound, count of values <= bound) for each
+        bucket, ending with (float('inf'), count).
+        '''
+        result = []
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.__counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ItemMetrics(object):
+    '''
+    Metrics for each content item, by name.  Updated by the display on
+    the GUI thread and read by the RPC server thread.
+    '''
+    # bounds in seconds of the load time and time on screen histograms
+    LOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    SHOWN_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 60, 120)
+
+    # name, type and help text of each metric, in the order written out
+    METRICS = (
+        ('screen_item_load_seconds', 'histogram',
+         'Time from starting to render an item until its page had loaded.'),
+        ('screen_item_load_failures_total', 'counter',
+         'Loads of an item\'s page that failed.'),
+        ('screen_item_load_timeouts_total', 'counter',
+         'Times an item was shown before its page had loaded.'),
+        ('screen_item_bytes_loaded_total', 'counter',
+         'Bytes received from the network to show an item.'),
+        ('screen_item_wait_seconds_total', 'counter',
+         'Time the display waited past the end of the previous item for '
+         'an item to load.'),
+        ('screen_item_shown_seconds', 'histogram',
+         'Time an item was actually on screen.'),
+        ('screen_item_display_duration_seconds', 'gauge',
+         'Time an item is meant to be on screen.'),
+    )
+
+    def __init__(self):
+        self.__lock = Lock()
+        # metric name -> item name -> Histogram or number
+        self.__values = { name: {} for name, xtype, xhelp in self.METRICS }
+
+    def __add(self, metric, item, amount):
+        values = self.__values[metric]
+        values[item] = values.get(item, 0) + amount
+
+    def __observe(self, metric, item, value, buckets):
+        values = self.__values[metric]
+        if item not in values:
+            values[item] = Histogram(buckets)
+        values[item].observe(value)
+
+    def loaded(self, item, seconds, ok=True, nbytes=0):
+        '''
+        Record that the named item's page finished loading (successfully
+        or not, according to ok) seconds after rendering began, having
+        received nbytes from the network.
+        '''
+        with self.__lock:
+            self.__observe('screen_item_load_seconds', item, seconds,
+                           self.LOAD_BUCKETS)
+            self.__add('screen_item_load_failures_total', item,
+                       0 if ok else 1)
+            self.__add('screen_item_bytes_loaded_total', item, nbytes)
+
+    def load_timeout(self, item):
+        with self.__lock:
+            self.__add('screen_item_load_timeouts_total', item, 1)
+
+    def waited(self, item, seconds):
+        with self.__lock:
+            self.__add('screen_item_wait_seconds_total', item, seconds)
+
+    def shown(self, item, seconds, duration):
+        '''
+        Record that the named item, meant to be shown for duration
+        seconds, was on screen for seconds.
+        '''
+        with self.__lock:
+            self.__observe('screen_item_shown_seconds', item, seconds,
+                           self.SHOWN_BUCKETS)
+            self.__values['screen_item_display_duration_seconds'][item] = \
+                duration
+
+    def exposition(self):
+        '''
+        Return all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.__lock:
+            for metric, xtype, xhelp in self.METRICS:
+                lines.append('# HELP {} {}'.format(metric, xhelp))
+                lines.append('# TYPE {} {}'.format(metric, xtype))
+                values = self.__values[metric]
+                for item in sorted(values):
+                    label = 'item="{}"'.format(_label(item))
+                    value = values[item]
+                    if xtype != 'histogram':
+                        lines.append('{}{{{}}} {}'.format(
+                            metric, label, _number(value)))
+                        continue
+                    for bound, n in value.cumulative():
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                            metric, label, _number(bound), n))
+                    lines.append('{}_sum{{{}}} {}'.format(
+                        metric, label, _number(value.sum)))
+                    lines.append('{}_count{{{}}} {}'.format(
+                        metric, label, value.count))
+        return '\n'.join(lines) + '\n'
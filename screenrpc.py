@@ -1,14 +1,30 @@
 import sys
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 import ssl
+import socket
 import json
-from urllib.parse import urlparse, parse_qs
-from time import sleep
+from urllib.parse import urlparse, parse_qs, unquote
+from time import sleep, monotonic
 import base64
-from PyQt4.QtCore import QTimer, QThread
-from screencontent import URLContent, ImageContent, HTMLContent
+import os
+from threading import Lock
+from PyQt4.QtCore import QThread
+from screencontent import URLContent, ImageContent, HTMLContent, \
+    AssetStore, asset_store
 
 class MyRequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests so clients don't pay for a
+    # new TCP and TLS handshake each time
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent as separate writes; without this the body
+    # waits on the client's delayed ACK of the headers on a kept-alive
+    # connection (~40 ms per request)
+    disable_nagle_algorithm = True
+    # seconds a client may stall mid-request, or leave a kept-alive
+    # connection idle, before it is dropped
+    timeout = 30
+
     def __verify_password(self):
         parsed_path = urlparse(self.path)
         queryparms = parse_qs(parsed_path.query)
@@ -24,23 +40,60 @@ class MyRequestHandler(BaseHTTPRequestHandler):
                 'status':'failure',
                 'reason':failmsg
             }
+            # any request body is left unread, so the connection can't
+            # be used for another request
+            self.close_connection = True
             self.__do_response(response_data)
             return False
 
         return True
 
-    def __do_response(self, response_data):
+    def send_error(self, code, message=None, explain=None):
+        # as above, the request body may not have been read
+        self.close_connection = True
+        BaseHTTPRequestHandler.send_error(self, code, message, explain)
+
+    def __not_modified(self, etag):
+        '''
+        Send a 304 response and return True if the request's
+        If-None-Match header matches etag (a weak entity tag).
+        '''
+        # weak comparison, ignoring any W/ prefixes
+        tags = [ t.strip() for t in
+                 self.headers.get('If-None-Match', '').split(',') ]
+        tags = [ t[2:] if t.startswith('W/') else t for t in tags ]
+        if etag[2:] not in tags:
+            return False
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return True
+
+    def __do_response(self, response_data, etag=None):
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
+        if etag is not None:
+            self.send_header('ETag', etag)
         output = json.dumps(response_data)
         self.send_header('Content-Length', len(output))
         self.end_headers()
         self.wfile.write(output.encode('ascii'))
 
+    def __do_text_response(self, text, content_type='text/plain'):
+        output = text.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', len(output))
+        self.end_headers()
+        self.wfile.write(output)
+
     def do_GET(self):
         # valid GET requests:
+        #    /ping
         #    /display
         #    /display/{name}
+        #    /manifest
+        #    /metrics
         # print ("GET received: {}".format(self.path))
 
         if not self.__verify_password():
@@ -53,12 +106,45 @@ class MyRequestHandler(BaseHTTPRequestHandler):
             response_data['content'] = {
                 'display_items': len(self.server.content_queue)
             }
+            if self.server.status is not None:
+                response_data['content'].update(self.server.status())
+            stats = self.server.ssl_context.session_stats()
+            response_data['content']['tls'] = {
+                'handshakes': stats['accept_good'],
+                'resumed': stats['hits'],
+            }
         elif parsed_path.path == '/display':
-            # list content
+            # list content; ?summary=1 leaves out each item's content.
+            # The listing is tagged with the queue generation, so a
+            # client can ask for it only if it has changed.
+            queryparms = parse_qs(parsed_path.query)
+            summary = queryparms.get('summary', ['0'])[0] not in ('', '0')
+            etag = 'W/"{}{}"'.format(self.server.content_queue.generation,
+                                     '.s' if summary else '')
+            if self.__not_modified(etag):
+                return
             response_data['content'] = \
-                self.server.content_queue.list_content_as_dict()
+                self.server.content_queue.list_content_as_dict(summary)
+            self.__do_response(response_data, etag)
+            return
+        elif parsed_path.path == '/manifest':
+            # name -> content hash, version and install time of each item
+            etag = 'W/"{}.m"'.format(self.server.content_queue.generation)
+            if self.__not_modified(etag):
+                return
+            response_data['content'] = self.server.content_queue.manifest()
+            self.__do_response(response_data, etag)
+            return
+        elif parsed_path.path == '/metrics':
+            # per-item display metrics, in the Prometheus text format
+            if self.server.metrics is None:
+                self.send_error(404)
+                return
+            self.__do_text_response(self.server.metrics(),
+                                    'text/plain; version=0.0.4')
+            return
         elif parsed_path.path.startswith('/display/'):
-            xname = parsed_path.path[9:] # slice off '/display/'
+            xname = unquote(parsed_path.path[9:]) # slice off '/display/'
             contentitem = self.server.content_queue.get_content(xname)
             if contentitem:
                 response_data['content'] = json.dumps(contentitem.to_dict())
@@ -82,10 +168,8 @@ class MyRequestHandler(BaseHTTPRequestHandler):
         parsed_path = urlparse(self.path)
         response_data = { 'status':'success' }
         if parsed_path.path.startswith('/display/'):
-            xname = parsed_path.path[9:] # slice off '/display/'
-            contentitem = self.server.content_queue.get_content(xname)
-            if contentitem:
-                self.server.content_queue.remove_content(xname)
+            xname = unquote(parsed_path.path[9:]) # slice off '/display/'
+            if self.server.content_queue.remove_content(xname):
                 response_data['reason'] = "content item '{}' deleted".format(xname)
             else:
                 response_data['status'] = 'failure'
@@ -97,88 +181,325 @@ class MyRequestHandler(BaseHTTPRequestHandler):
         self.__do_response(response_data)
 
 
+    def do_PUT(self):
+        # valid PUT request:
+        #   /display/{name}/content?filename={filename}
+        # The request body is the raw content data (image file or HTML
+        # text) for the item, which is then created by a POST to /display
+        # with a JSON specification that has no 'content' field.
+
+        if not self.__verify_password():
+            return
+
+        parsed_path = urlparse(self.path)
+        queryparms = parse_qs(parsed_path.query)
+        parts = parsed_path.path.split('/')
+        if len(parts) != 4 or parts[1] != 'display' or parts[3] != 'content':
+            self.send_error(404)
+            return
+        xname = unquote(parts[2])
+
+        response_data = { 'status':'success' }
+        filename = queryparms.get('filename', [''])[0]
+        ext = os.path.splitext(filename)[1]
+        try:
+            xlen = int(self.headers['Content-Length'])
+            key = asset_store.put_stream(self.rfile, xlen, ext)
+        except Exception as e:
+            # the body may have been only partly read
+            self.close_connection = True
+            response_data['status'] = 'failure'
+            response_data['reason'] = "upload failed: {}".format(e)
+        else:
+            self.server.stage_upload(xname, key)
+            response_data['reason'] = "content for '{}' uploaded".format(xname)
+            response_data['content'] = {
+                'hash': base64.b64encode(AssetStore.digest(key)).decode('utf8')
+            }
+
+        self.__do_response(response_data)
+
+    def __make_item(self, contentspec):
+        '''
+        Create a content item from a JSON specification as sent to
+        /display.  Returns the item and an empty string, or None and a
+        reason for the failure.
+        '''
+        contentspec = dict(contentspec)
+        name = contentspec.pop('name', '')
+        xtype = contentspec.pop('type', '')
+        item = None
+        # content data either comes base64-encoded in the request, or
+        # was streamed earlier with a PUT to /display/{name}/content
+        staged = None
+        if 'content' not in contentspec:
+            staged = self.server.take_upload(name)
+            if staged is None:
+                return None, "no content given or uploaded for '{}'".format(name)
+        content = base64.b64decode(contentspec.pop('content', '').encode('utf-8'))
+
+        errorstr = ''
+        try:
+            if xtype == 'url':
+                item = URLContent(content.decode('ascii'), name, **contentspec)
+            elif xtype == 'image':
+                xfilename = contentspec.get('filename', '')
+                contentspec.pop('filename', '')
+                if staged is not None:
+                    item = ImageContent(xfilename, name, content=None,
+                                        key=staged, **contentspec)
+                else:
+                    item = ImageContent(xfilename, name, content=content, **contentspec)
+            elif xtype == 'html':
+                if staged is not None:
+                    with open(AssetStore.path(staged), 'rb') as infile:
+                        content = infile.read()
+                item = HTMLContent(content.decode('ascii'), name, **contentspec)
+        except Exception as e:
+            errorstr = str(e)
+        finally:
+            # the item holds its own reference to staged data
+            if staged is not None:
+                asset_store.release(staged)
+
+        if errorstr or not (name and xtype and item):
+            if item is not None:
+                item.content_removed()
+            return None, "failed to create content for specification {} {}".format(contentspec, errorstr)
+        return item, ''
+
+    def __read_json(self):
+        xlen = int(self.headers['Content-Length'])
+        indata = self.rfile.read(xlen).decode('ascii')
+        return json.loads(indata)
+
     def do_POST(self):
         # valid POST requests:
         #   /display
+        #   /display/batch
         # print ("POST received: {}".format(self.path))
 
         if not self.__verify_password():
             return
 
         parsed_path = urlparse(self.path)
+        if parsed_path.path == '/display/batch':
+            self.__do_batch()
+            return
         response_data = { 'status':'success' }
         if parsed_path.path != '/display':
             self.send_error(404)
             return
         else:
-            xlen = int(self.headers['Content-Length'])
-            indata = self.rfile.read(xlen).decode('ascii')
-            contentspec = json.loads(indata)
+            contentspec = self.__read_json()
             # print ("Got json data for new content: <{}>".format(contentspec))
 
             name = contentspec.get('name', '')
-            xtype = contentspec.get('type', '')
-            item = None
-            contentspec.pop('name', '')
-            contentspec.pop('type', '')
-            content = base64.b64decode(contentspec.get('content', '').encode('utf-8'))
-            contentspec.pop('content','')
-
-            errorstr = ''
-
-            try:
-                if xtype == 'url':
-                    item = URLContent(content.decode('ascii'), name, **contentspec)
-                elif xtype == 'image':
-                    xfilename = contentspec.get('filename', '')
-                    contentspec.pop('filename', '')
-                    item = ImageContent(xfilename, name, content=content, **contentspec)
-                elif xtype == 'html':
-                    item = HTMLContent(content.decode('ascii'), name, **contentspec)
-            except Exception as e:
-                errorstr = str(e)
-
-            if self.server.content_queue.get_content(name):
+            if name in self.server.content_queue:
+                if 'content' not in contentspec:
+                    staged = self.server.take_upload(name)
+                    if staged is not None:
+                        asset_store.release(staged)
                 response_data['status'] = 'failure'
                 response_data['reason'] = "content already exists with that name"
-            elif errorstr or not (name and xtype and item):
+                self.__do_response(response_data)
+                return
+
+            item, errorstr = self.__make_item(contentspec)
+            if item is None:
+                response_data['status'] = 'failure'
+                response_data['reason'] = errorstr
+            elif not self.server.content_queue.add_content(item):
+                item.content_removed()
                 response_data['status'] = 'failure'
-                response_data['reason'] = "failed to create content for specification {} {}".format(contentspec, errorstr)
+                response_data['reason'] = "content already exists with that name"
             else:
-                self.server.content_queue.add_content(item)
                 response_data['reason'] = "Create item: {}".format(str(item))
 
         self.__do_response(response_data)
 
+    def __do_batch(self):
+        # The request body is a JSON object:
+        #   {"operations": [op, ...], "atomic": false}
+        # where each op is {"op": "add" or "update", ...} with the rest
+        # of a specification as POSTed to /display, or
+        # {"op": "delete", "name": name}.  The operations are applied to
+        # the queue together; with "atomic", none are applied unless all
+        # can be.
+        try:
+            batchspec = self.__read_json()
+            opspecs = batchspec['operations']
+            if not isinstance(opspecs, list) or \
+                    not all(isinstance(o, dict) for o in opspecs):
+                raise TypeError("operations must be a list of objects")
+            atomic = bool(batchspec.get('atomic', False))
+        except (ValueError, AttributeError, TypeError, KeyError) as e:
+            response_data = {
+                'status': 'failure',
+                'reason': "malformed batch request: {}".format(e),
+            }
+            self.__do_response(response_data)
+            return
+
+        operations = []
+        results = []
+        for opspec in opspecs:
+            opspec = dict(opspec)
+            op = opspec.pop('op', '')
+            name = opspec.get('name', '')
+            if op == 'delete':
+                operations.append(('remove', name))
+                results.append(None)
+            elif op in ('add', 'update'):
+                item, errorstr = self.__make_item(opspec)
+                if item is None:
+                    results.append((name, op, (False, errorstr)))
+                else:
+                    operations.append((op, item))
+                    results.append(None)
+            else:
+                results.append((name, op, (False, "unknown operation '{}'".format(op))))
+
+        if atomic and any(results):
+            applied = [ (False, "not applied: batch failed") ] * len(operations)
+        else:
+            applied = self.server.content_queue.apply_batch(operations, atomic)
+        for (op, arg), (ok, reason) in zip(operations, applied):
+            if not ok and op != 'remove':
+                arg.content_removed()
+
+        # merge results of operations that were applied to the queue with
+        # those that failed before getting that far, in request order
+        applied = iter(zip(operations, applied))
+        report = []
+        for result in results:
+            if result is None:
+                (op, arg), outcome = next(applied)
+                name, op = (arg, 'delete') if op == 'remove' else (arg.name, op)
+            else:
+                name, op, outcome = result
+            report.append({'name': name, 'op': op,
+                           'status': 'success' if outcome[0] else 'failure',
+                           'reason': outcome[1]})
+
+        nok = sum(r['status'] == 'success' for r in report)
+        response_data = {
+            'status': 'success' if nok == len(report) else 'failure',
+            'reason': "{} of {} operations applied".format(nok, len(report)),
+            'content': report,
+        }
+        self.__do_response(response_data)
+
     def log_message(self, fmt, *args):
         pass
         # print (fmt % args)
 
+class ScreenHTTPServer(ThreadingMixIn, HTTPServer):
+    '''
+    HTTPS server that handles each connection on its own thread.  The
+    TLS handshake is done on that thread too, rather than in accept(), so
+    a slow client cannot hold up other connections.  All connections
+    share one SSLContext, so a client reconnecting with a session ticket
+    resumes its TLS session instead of doing a full handshake.
+    '''
+    daemon_threads = True
+    # seconds a streamed upload is kept waiting for the POST that
+    # creates its item
+    UPLOAD_TIMEOUT = 600
+
+    def __init__(self, address, handler, ssl_context, content_queue,
+                 password, status=None, metrics=None):
+        HTTPServer.__init__(self, address, handler)
+        self.ssl_context = ssl_context
+        # made available to request handlers
+        self.content_queue = content_queue
+        self.password = password
+        # optional callable returning a dict of extra status for /ping
+        self.status = status
+        # optional callable returning metrics text for /metrics
+        self.metrics = metrics
+        # name -> (asset store key, time) of content streamed in by PUT
+        # requests, waiting for the POST that creates the item
+        self.__uploads = {}
+        self.__upload_lock = Lock()
+
+    def __expired_uploads(self):
+        # must be called with the upload lock held
+        now = monotonic()
+        expired = [ name for name, (key, since) in self.__uploads.items()
+                    if now - since > self.UPLOAD_TIMEOUT ]
+        return [ self.__uploads.pop(name)[0] for name in expired ]
+
+    def stage_upload(self, name, key):
+        '''
+        Hold the asset store key of uploaded content for the item to be
+        created with the given name, in place of any earlier upload for
+        it.  Uploads left unclaimed past UPLOAD_TIMEOUT are dropped.
+        '''
+        with self.__upload_lock:
+            old = self.__uploads.pop(name, None)
+            stale = self.__expired_uploads()
+            self.__uploads[name] = (key, monotonic())
+        if old is not None:
+            stale.append(old[0])
+        for key in stale:
+            asset_store.release(key)
+
+    def take_upload(self, name):
+        '''
+        Return the key of the content uploaded for the named item, or
+        None, and stop holding it; the caller takes over its reference.
+        '''
+        with self.__upload_lock:
+            entry = self.__uploads.pop(name, None)
+            stale = self.__expired_uploads()
+        for key in stale:
+            asset_store.release(key)
+        return entry[0] if entry is not None else None
+
+    def finish_request(self, request, client_address):
+        request.settimeout(self.RequestHandlerClass.timeout)
+        conn = self.ssl_context.wrap_socket(request, server_side=True)
+        try:
+            self.RequestHandlerClass(conn, client_address, self)
+        finally:
+            conn.close()
+
+    def handle_error(self, request, client_address):
+        # clients that fail the handshake, hang up or stall are routine;
+        # anything else is a bug in a handler, so print its traceback
+        if isinstance(sys.exc_info()[1],
+                      (ssl.SSLError, ConnectionError, socket.timeout)):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
 class ScreenRpcServer(QThread):
-    def __init__(self, content_queue, password):
+    '''
+    Runs the RPC server on its own thread.  Request handlers only touch
+    the display through ContentQueue, whose methods are thread-safe.
+    '''
+    def __init__(self, content_queue, password, status=None, metrics=None):
         QThread.__init__(self)
 
-        self.__content_queue = content_queue
-        self.__httpd = HTTPServer(('0.0.0.0', 4443), MyRequestHandler)
-        self.__httpd.socket = ssl.wrap_socket(self.__httpd.socket, certfile='server.pem', server_side=True)
-        self.__httpd.timeout = 0.0
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile='server.pem')
 
-        # make content_queue available inside request handlers
-        self.__httpd.content_queue = self.__content_queue
-        self.__httpd.password = password
+        self.__httpd = ScreenHTTPServer(('0.0.0.0', 4443), MyRequestHandler,
+                                        context, content_queue, password,
+                                        status, metrics)
 
-        self.__stopped = False
+    def run(self):
+        self.__httpd.serve_forever(poll_interval=0.5)
 
     def stop(self):
-        self.__stopped = True
-
-    def request_check(self):
-        if self.__stopped:
-            return
-        self.__httpd.handle_request()
-        QTimer.singleShot(100, self.request_check)
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        self.wait()
 
-def start_rpc_server(content_queue, rpc_password):
-    rpcserver = ScreenRpcServer(content_queue, rpc_password)
-    QTimer.singleShot(100, rpcserver.request_check)
+def start_rpc_server(content_queue, rpc_password, status=None,
+                     metrics=None):
+    rpcserver = ScreenRpcServer(content_queue, rpc_password, status,
+                                metrics)
+    rpcserver.start()
     return rpcserver
@@ -0,0 +1,687 @@
+import io
+import json
+import os
+import pickle
+import shutil
+import random
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from contextlib import redirect_stderr
+from unittest.mock import Mock, patch
+from screencontent import ContentQueue, ContentJournal, AssetStore, \
+    URLContent, NoSuitableContentException, CACHE_DIR, Only, Except, \
+    MINUTES_PER_WEEK, _should_display_unindexed, content_from_record, \
+    ImageContent, HTMLContent, ScheduleIndex
+
+
+class ScaledImage(object):
+    # stands in for QImage when making scaled copies of images
+    def __init__(self, filename):
+        self.size = None
+
+    def isNull(self):
+        return False
+
+    def scaledToWidth(self, size, mode):
+        self.size = size
+        return self
+
+    scaledToHeight = scaledToWidth
+
+    def save(self, xbuffer, fmt, quality):
+        xbuffer.saved = 'scaled to {}'.format(self.size).encode('utf8')
+        return True
+
+
+class ImageBuffer(object):
+    def open(self, mode):
+        pass
+
+    def data(self):
+        return self.saved
+
+
+class ContentQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.q = ContentQueue()
+
+    def tearDown(self):
+        # waits for any background stats write
+        self.q.shutdown()
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def add(self, name, **kwargs):
+        item = URLContent('http://cs.colgate.edu/{}'.format(name), name,
+                          **kwargs)
+        return self.q.add_content(item)
+
+    def rotate(self, n):
+        return [ self.q.next_content().name for i in range(n) ]
+
+    def test_empty(self):
+        self.assertEqual(len(self.q), 0)
+        with self.assertRaises(NoSuitableContentException):
+            self.q.next_content()
+
+    def test_round_robin(self):
+        for name in 'abc':
+            self.add(name)
+        self.assertEqual(self.rotate(7), list('abcabca'))
+
+    def test_lookup(self):
+        self.add('a')
+        self.assertIn('a', self.q)
+        self.assertNotIn('b', self.q)
+        self.assertEqual(self.q.get_content('a').name, 'a')
+        self.assertIsNone(self.q.get_content('b'))
+
+    def test_duplicate(self):
+        self.assertTrue(self.add('a'))
+        self.assertFalse(self.add('a'))
+        self.assertEqual(len(self.q), 1)
+        # a duplicate isn't prepared for the display
+        self.q.set_display_size(800, 600)
+        item = URLContent('http://cs.colgate.edu/a', 'a')
+        item.prepare = Mock()
+        self.assertFalse(self.q.add_content(item))
+        item.prepare.assert_not_called()
+
+    def test_remove(self):
+        for name in 'abcd':
+            self.add(name)
+        self.assertEqual(self.rotate(2), ['a', 'b'])
+        self.assertEqual(self.q.remove_content('c').name, 'c')
+        self.assertIsNone(self.q.remove_content('c'))
+        self.assertNotIn('c', self.q)
+        self.assertEqual(self.rotate(4), ['d', 'a', 'b', 'd'])
+
+    def test_add_joins_tail(self):
+        for name in 'abc':
+            self.add(name)
+        self.assertEqual(self.rotate(1), ['a'])
+        self.add('x')
+        self.assertEqual(self.rotate(5), ['b', 'c', 'a', 'x', 'b'])
+
+    def test_mixed_sequence(self):
+        # compare against a plain list rotated the way the queue used to be
+        rng = random.Random(42)
+        model = []
+        names = [ 'item{}'.format(i) for i in range(20) ]
+        for step in range(500):
+            op = rng.choice(['add', 'remove', 'rotate', 'rotate'])
+            name = rng.choice(names)
+            if op == 'add':
+                self.assertEqual(self.add(name), name not in model)
+                if name not in model:
+                    model.append(name)
+            elif op == 'remove':
+                removed = self.q.remove_content(name)
+                self.assertEqual(removed is not None, name in model)
+                if name in model:
+                    model.remove(name)
+            elif model:
+                model.append(model.pop(0))
+                self.assertEqual(self.q.next_content().name, model[-1])
+            self.assertEqual(len(self.q), len(model))
+            self.assertEqual([ d['name'] for d in
+                               self.q.list_content_as_dict() ], model)
+
+    def test_expire_together(self):
+        for name in 'abc':
+            self.add(name, expiry='20000101')
+        self.add('d', expiry='20991231')
+        self.add('e')
+        self.assertEqual(self.q.next_expiry(), datetime(2000, 1, 1))
+        self.assertEqual(self.q.expire_content(), 3)
+        self.assertEqual([ d['name'] for d in self.q.list_content_as_dict() ],
+                         ['d', 'e'])
+        self.assertEqual(self.q.next_expiry(), datetime(2099, 12, 31))
+        self.assertEqual(self.q.expire_content(), 0)
+
+    def test_expiry_stale_entries(self):
+        url = 'http://cs.colgate.edu/'
+        self.add('a', expiry='20980101')
+        self.add('b', expiry='20990101')
+        # heap entries for removed or replaced items are skipped
+        self.q.remove_content('a')
+        self.assertEqual(self.q.next_expiry(), datetime(2099, 1, 1))
+        self.q.apply_batch([('update', URLContent(url, 'b',
+                                                  expiry='20991231'))])
+        self.assertEqual(self.q.next_expiry(), datetime(2099, 12, 31))
+        self.q.apply_batch([('update', URLContent(url, 'b'))])
+        self.assertIsNone(self.q.next_expiry())
+        # nor do they remove a later item of the same name
+        self.add('c', expiry='20000101')
+        self.q.remove_content('c')
+        self.add('c')
+        self.assertEqual(self.q.expire_content(), 0)
+        self.assertIn('c', self.q)
+        self.assertIn('b', self.q)
+
+    def test_generation(self):
+        gen = self.q.generation
+        self.add('a')
+        self.assertNotEqual(self.q.generation, gen)
+        gen = self.q.generation
+        self.q.next_content().displayed()
+        self.assertFalse(self.add('a'))
+        self.assertEqual(self.q.generation, gen)
+        self.q.remove_content('a')
+        self.assertNotEqual(self.q.generation, gen)
+        # not repeated by a restarted queue
+        self.assertNotEqual(ContentQueue().generation, self.q.generation)
+
+    def test_generation_counters(self):
+        # a client that got "not modified" while items were being shown
+        # sees the new counters once they are flushed
+        self.add('a')
+        gen = self.q.generation
+        for i in range(ContentQueue.STATS_FLUSH_DISPLAYS):
+            self.q.next_content().displayed()
+        self.assertEqual(self.q.generation, gen)
+        self.q.next_content().displayed()
+        self.assertNotEqual(self.q.generation, gen)
+        self.assertEqual(self.q.list_content_as_dict()[0]['display_count'],
+                         ContentQueue.STATS_FLUSH_DISPLAYS + 1)
+
+    def test_summary(self):
+        self.add('a')
+        self.assertIn('content', self.q.list_content_as_dict()[0])
+        summary = self.q.list_content_as_dict(summary=True)[0]
+        self.assertNotIn('content', summary)
+        self.assertEqual(summary['name'], 'a')
+
+    def test_manifest(self):
+        self.add('a', version='v1')
+        self.add('b')
+        manifest = self.q.manifest()
+        self.assertEqual(manifest['a']['hash'],
+                         self.q.get_content('a').to_dict()['hash'])
+        self.assertEqual(manifest['a']['version'], 'v1')
+        self.assertIsNone(manifest['b']['version'])
+        self.assertLessEqual(abs(manifest['a']['mtime'] - time.time()), 2)
+        self.assertEqual(ContentQueue().manifest(), manifest)
+
+    def test_batch(self):
+        for name in 'abc':
+            self.add(name)
+        self.q.next_content().displayed()
+        update = URLContent('http://cs.colgate.edu/new', 'a', duration=5)
+        ops = [('add', URLContent('http://cs.colgate.edu/d', 'd')),
+               ('remove', 'b'),
+               ('update', update),
+               ('add', URLContent('http://cs.colgate.edu/c', 'c')),
+               ('remove', 'x')]
+        with open(ContentJournal.JOURNAL_FILE) as infile:
+            nentries = len(infile.readlines())
+        results = self.q.apply_batch(ops)
+        self.assertEqual([ ok for ok, reason in results ],
+                         [True, True, True, False, False])
+        # updated in place, keeping its counters
+        self.assertEqual([ d['name'] for d in self.q.list_content_as_dict() ],
+                         ['c', 'a', 'd'])
+        self.assertIs(self.q.get_content('a'), update)
+        self.assertEqual(update.display_count, 1)
+        # one journal entry for the whole batch
+        with open(ContentJournal.JOURNAL_FILE) as infile:
+            self.assertEqual(len(infile.readlines()), nentries + 1)
+        # rotation position isn't saved, so compare items by name
+        q = ContentQueue()
+        self.assertEqual(
+            sorted(q.list_content_as_dict(), key=lambda d: d['name']),
+            sorted(self.q.list_content_as_dict(), key=lambda d: d['name']))
+
+    def test_batch_atomic(self):
+        self.add('a')
+        ops = [('add', URLContent('http://cs.colgate.edu/b', 'b')),
+               ('remove', 'x')]
+        results = self.q.apply_batch(ops, atomic=True)
+        self.assertEqual([ ok for ok, reason in results ], [False, False])
+        self.assertNotIn('b', self.q)
+        self.assertEqual(len(self.q), 1)
+
+    def test_restore(self):
+        for name in 'abcd':
+            self.add(name, duration=5, only=['MWF:08:00-17:00'],
+                     expiry='20991231')
+        self.q.remove_content('b')
+        q = ContentQueue()
+        self.assertEqual([ d['name'] for d in q.list_content_as_dict() ],
+                         ['a', 'c', 'd'])
+        self.assertEqual(q.list_content_as_dict(),
+                         self.q.list_content_as_dict())
+
+    def test_restore_torn_journal(self):
+        self.add('a')
+        self.add('b')
+        with open(ContentJournal.JOURNAL_FILE, 'a') as outfile:
+            outfile.write('{"op": "remove", "na')
+        q = ContentQueue()
+        self.assertEqual(len(q), 2)
+
+    def test_restore_missing_files(self):
+        self.q.add_content(HTMLContent('<p>hello</p>', 'page'))
+        self.add('a')
+        shutil.rmtree(os.path.join(CACHE_DIR, AssetStore.PAGE_DIR))
+        with redirect_stderr(io.StringIO()) as err:
+            q = ContentQueue()
+        self.assertEqual([ d['name'] for d in q.list_content_as_dict() ],
+                         ['a'])
+        self.assertIn('page', err.getvalue())
+
+    def test_restore_resized(self):
+        png = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + \
+            struct.pack('>II', 1920, 1080)
+        with patch('screencontent.QImage', ScaledImage), \
+                patch('screencontent.QBuffer', ImageBuffer):
+            self.q.set_display_size(1000, 800)
+            self.q.add_content(ImageContent('big.png', 'big', png))
+            self.q.set_display_size(500, 400)
+            self.q.next_content()
+        # the copy made for the new size is in the journal
+        derived = ContentQueue().get_content('big').to_record()['derived']
+        self.assertEqual(list(derived[1:]), ['width', 450])
+        self.assertTrue(os.path.exists(AssetStore.path(derived[0])))
+
+    def test_removed_while_resizing(self):
+        png = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + \
+            struct.pack('>II', 1920, 1080)
+        item = ImageContent('big.png', 'big', png)
+        self.q.add_content(item)
+        self.q.set_display_size(500, 400)
+
+        class RemovedImage(ScaledImage):
+            # removed over RPC while the copy is being made
+            def scaledToWidth(image, size, mode):
+                self.q.remove_content('big')
+                return ScaledImage.scaledToWidth(image, size, mode)
+        with patch('screencontent.QImage', RemovedImage), \
+                patch('screencontent.QBuffer', ImageBuffer):
+            self.q.next_content()
+        self.assertNotIn('big', self.q)
+        self.assertEqual(os.listdir(os.path.join(CACHE_DIR,
+                                                 AssetStore.OBJECT_DIR)), [])
+
+    def test_restore_legacy(self):
+        with open(ContentQueue.LEGACY_SAVE_FILE, 'wb') as outfile:
+            pickle.dump([URLContent('http://cs.colgate.edu/a', 'a')], outfile)
+        for name in (ContentJournal.SNAPSHOT_FILE, ContentJournal.JOURNAL_FILE):
+            if os.path.exists(name):
+                os.unlink(name)
+        # the pickle is kept until its content is in a snapshot
+        with patch('screencontent._atomic_write', side_effect=OSError):
+            with self.assertRaises(OSError):
+                ContentQueue()
+        self.assertTrue(os.path.exists(ContentQueue.LEGACY_SAVE_FILE))
+        self.assertIn('a', ContentQueue())
+        self.assertFalse(os.path.exists(ContentQueue.LEGACY_SAVE_FILE))
+        self.assertIn('a', ContentQueue())
+
+    def test_restore_stats(self):
+        self.add('a')
+        self.add('b')
+        for i in range(5):
+            self.q.next_content().displayed()
+        # counters go to the stats file, not the journal; flush them
+        # without the snapshot that shutdown would also write
+        self.q._ContentQueue__flush_stats(background=False)
+        q = ContentQueue()
+        self.assertEqual(q.get_content('a').display_count, 3)
+        self.assertEqual(q.get_content('b').display_count, 2)
+        self.assertEqual(q.get_content('a').last_display,
+                         self.q.get_content('a').last_display)
+        self.assertNotEqual(q.get_content('a').last_display,
+                            URLContent('http://x', 'x').last_display)
+
+
+class ScheduleTests(unittest.TestCase):
+    # Tuesday
+    NOW = datetime(2017, 5, 23, 10, 5, 30)
+
+    def item(self, **kwargs):
+        return URLContent('http://cs.colgate.edu/', 'a', **kwargs)
+
+    def test_matches_constraint_objects(self):
+        rng = random.Random(7)
+
+        def constraint():
+            days = ''.join(d for d in 'MTWRFSU' if rng.random() < 0.3)
+            begin = rng.randrange(24 * 60)
+            end = rng.randrange(24 * 60 + 1)
+            return '{}:{:02d}{:02d}-{:02d}{:02d}'.format(
+                days, begin // 60, begin % 60, end // 60, end % 60)
+        for i in range(200):
+            only = [ constraint() for j in range(rng.randrange(3)) ]
+            xexcept = [ constraint() for j in range(rng.randrange(3)) ]
+            item = self.item(only=only, xexcept=xexcept)
+            objects = [ Only(c) for c in only ], [ Except(c) for c in xexcept ]
+            for j in range(50):
+                now = self.NOW + timedelta(
+                    minutes=rng.randrange(MINUTES_PER_WEEK))
+                self.assertEqual(item.should_display(now),
+                                 _should_display_unindexed(*objects, now),
+                                 (only, xexcept, now))
+
+    def test_next_display_time(self):
+        item = self.item(only=['MWF:08:00-17:00'])
+        self.assertEqual(item.next_display_time(self.NOW),
+                         datetime(2017, 5, 24, 8, 0))
+        wednesday = datetime(2017, 5, 24, 9, 30, 10)
+        self.assertEqual(item.next_display_time(wednesday), wednesday)
+        # wraps around to next week
+        self.assertEqual(item.next_display_time(datetime(2017, 5, 26, 17)),
+                         datetime(2017, 5, 29, 8, 0))
+        item = self.item(xexcept=['T:10:00-12:00'])
+        self.assertEqual(item.next_display_time(self.NOW),
+                         datetime(2017, 5, 23, 12, 0))
+        self.assertEqual(self.item().next_display_time(self.NOW), self.NOW)
+
+    def test_never_displayed(self):
+        item = self.item(only=['MWF:08:00-17:00'], expiry='20170524')
+        self.assertIsNone(item.next_display_time(self.NOW))
+        item = self.item(only=['M:10:00-09:00'])
+        self.assertIsNone(item.next_display_time(self.NOW))
+        self.assertFalse(item.should_display(self.NOW))
+
+    def test_unconstrained_mask(self):
+        # a mask equal to ALWAYS but computed separately is a distinct
+        # int object; it still needs no place in the index
+        mask = (ScheduleIndex.ALWAYS << 1) >> 1
+        self.assertIsNot(mask, ScheduleIndex.ALWAYS)
+        item = Mock(schedule_mask=mask)
+        item.name = 'a'
+        index = ScheduleIndex()
+        index.add(item)
+        self.assertEqual(index._ScheduleIndex__masks, {})
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.page is None:
+            self.send_error(503)
+            return
+        data = self.server.page.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         '{}; charset=utf-8'.format(self.server.ctype))
+        self.send_header('Content-Length', len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class URLSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.server = HTTPServer(('127.0.0.1', 0), PageHandler)
+        self.server.page = '<p>first</p>'
+        self.server.ctype = 'text/html'
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/dash'.format(
+            self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def render(self, item):
+        webview = Mock()
+        item.render(webview, 800, 600)
+        return webview
+
+    def test_snapshot(self):
+        item = URLContent(self.url, 'dash', snapshot=3600)
+        # live until the first copy has been fetched
+        self.assertTrue(self.render(item).load.called)
+        for i in range(100):
+            if item.snapshot_age is not None:
+                break
+            time.sleep(0.01)
+        webview = self.render(item)
+        webview.setHtml.assert_called_with('<p>first</p>', self.url)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(item.to_dict()['snapshot']['max_age'], 3600)
+
+        # kept across a restart
+        restored = content_from_record(item.to_record())
+        self.render(restored).setHtml.assert_called_with('<p>first</p>',
+                                                         self.url)
+        self.assertEqual(self.server.requests, 1)
+        restored.content_removed()
+        self.assertEqual(os.listdir(os.path.join(CACHE_DIR, 'snapshots')), [])
+
+    def test_refresh_failure(self):
+        item = URLContent(self.url, 'dash', snapshot=1)
+        item.refresh_snapshot(background=False)
+        self.server.page = None
+        time.sleep(1.1)
+        item.refresh_snapshot(background=False)
+        # the last good copy is still shown
+        self.render(item).setHtml.assert_called_with('<p>first</p>', self.url)
+        self.assertIn('503', item.to_dict()['snapshot']['error'])
+        self.server.page = '<p>second</p>'
+        time.sleep(1.1)
+        item.refresh_snapshot(background=False)
+        self.render(item).setHtml.assert_called_with('<p>second</p>',
+                                                     self.url)
+        self.assertIsNone(item.to_dict()['snapshot']['error'])
+
+    def test_queue_refresh(self):
+        # refreshed on the queue's schedule, without being shown
+        q = ContentQueue()
+        q.add_content(URLContent(self.url, 'dash', snapshot=3600))
+        q.add_content(URLContent(self.url, 'live'))
+        q.refresh_snapshots()
+        item = q.get_content('dash')
+        for i in range(100):
+            if item.snapshot_age is not None:
+                break
+            time.sleep(0.01)
+        self.assertIsNotNone(item.snapshot_age)
+        self.assertEqual(item.display_count, 0)
+        q.refresh_snapshots()
+        self.assertEqual(self.server.requests, 1)
+        q.shutdown()
+
+    def test_update_keeps_snapshot(self):
+        q = ContentQueue()
+        item = URLContent(self.url, 'dash', snapshot=3600)
+        item.refresh_snapshot(background=False)
+        q.add_content(item)
+        q.apply_batch([('update', URLContent(self.url, 'dash', snapshot=60,
+                                             duration=30))])
+        q.shutdown()
+        # the replacement shows the copy, and still has it after a restart
+        q = ContentQueue()
+        self.render(q.get_content('dash')).setHtml.assert_called_with(
+            '<p>first</p>', self.url)
+        self.assertEqual(self.server.requests, 1)
+        # but not once snapshots are turned off for it
+        q.apply_batch([('update', URLContent(self.url, 'dash'))])
+        self.assertEqual(os.listdir(os.path.join(CACHE_DIR, 'snapshots')), [])
+        q.shutdown()
+
+    def test_xhtml(self):
+        # not copied, since it would be shown as HTML
+        self.server.ctype = 'application/xhtml+xml'
+        item = URLContent(self.url, 'dash', snapshot=3600)
+        item.refresh_snapshot(background=False)
+        self.assertIn('application/xhtml+xml',
+                      item.to_dict()['snapshot']['error'])
+        self.render(item).load.assert_called_with(self.url)
+
+    def test_live(self):
+        item = URLContent(self.url, 'dash')
+        self.render(item).load.assert_called_with(self.url)
+        self.assertNotIn('snapshot', item.to_dict())
+        self.assertEqual(self.server.requests, 0)
+
+
+class ImageContentTests(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def test_frame(self):
+        gif = b'GIF89a' + struct.pack('<HH', 320, 200)
+        item = ImageContent('logo.gif', 'logo', gif, caption='Logo')
+        webview = Mock()
+        item.render(webview, 800, 600)
+        page = webview.setHtml.call_args[0][0]
+        # styled without fetching anything
+        self.assertIn('.center-block', page)
+        self.assertNotIn('<link', page)
+        self.assertIn('width="288"', page)
+        item.render(webview, 800, 600)
+        self.assertIs(webview.setHtml.call_args[0][0], page)
+        item.render(webview, 200, 150)
+        self.assertIn('width="180"', webview.setHtml.call_args[0][0])
+        item.content_removed()
+
+
+class ContentJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def test_compaction(self):
+        journal = ContentJournal(compact_size=200)
+        records = []
+        for i in range(10):
+            record = {'name': 'item{}'.format(i), 'type': 'URLContent'}
+            records.append(record)
+            if journal.append({'op': 'add', 'item': record}):
+                journal.compact(list(records), background=False)
+                self.assertFalse(
+                    os.path.exists(ContentJournal.JOURNAL_FILE + '.old'))
+        journal.append({'op': 'remove', 'name': 'item3'})
+        del records[3]
+        self.assertTrue(os.path.exists(ContentJournal.SNAPSHOT_FILE))
+        self.assertEqual(ContentJournal().load(), records)
+
+    def test_compaction_in_flight(self):
+        import screencontent
+        write = screencontent._atomic_write
+        gate = threading.Event()
+
+        def slow_write(path, data):
+            gate.wait(5)
+            write(path, data)
+        a = {'name': 'a', 'type': 'URLContent'}
+        b = {'name': 'b', 'type': 'URLContent'}
+        journal = ContentJournal()
+        journal.append({'op': 'add', 'item': a})
+        with patch('screencontent._atomic_write', side_effect=slow_write):
+            journal.compact([a], background=True)
+            # the snapshot write finishes while the foreground compact
+            # waits for it
+            threading.Timer(0.05, gate.set).start()
+            journal.append({'op': 'add', 'item': b})
+            journal.compact([a, b], background=False)
+        self.assertEqual(ContentJournal().load(), [a, b])
+        self.assertFalse(os.path.exists(ContentJournal.JOURNAL_FILE))
+        self.assertFalse(
+            os.path.exists(ContentJournal.JOURNAL_FILE + '.old'))
+
+    def test_compaction_after_failure(self):
+        a = {'name': 'a', 'type': 'URLContent'}
+        b = {'name': 'b', 'type': 'URLContent'}
+        # left set aside by a snapshot that never made it to disk, and
+        # ending in a torn entry
+        with open(ContentJournal.JOURNAL_FILE + '.old', 'w') as outfile:
+            outfile.write(json.dumps({'op': 'add', 'item': a}) + '\n')
+            outfile.write('{"op": "ad')
+        journal = ContentJournal()
+        journal.append({'op': 'add', 'item': b})
+        with patch.object(journal, '_ContentJournal__write_snapshot'):
+            journal.compact([a, b], background=False)
+        self.assertFalse(os.path.exists(ContentJournal.JOURNAL_FILE))
+        self.assertEqual(ContentJournal().load(), [a, b])
+
+
+class AssetStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.store = AssetStore()
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def objects(self):
+        return os.listdir(os.path.join(CACHE_DIR, AssetStore.OBJECT_DIR))
+
+    def test_dedup(self):
+        k1 = self.store.put(b'logo', '.png')
+        k2 = self.store.put(b'logo', '.png')
+        k3 = self.store.put(b'other', '.png')
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+        self.assertEqual(len(self.objects()), 2)
+        self.store.release(k1)
+        self.assertTrue(os.path.exists(AssetStore.path(k1)))
+        self.store.release(k2)
+        self.assertFalse(os.path.exists(AssetStore.path(k1)))
+
+    def test_dir(self):
+        css = self.store.put(b'body {}', '.css')
+        page = self.store.put(b'<html></html>', '.html')
+        files = {'index.html': page, 'css/x.css': css}
+        d1 = self.store.put_dir(files)
+        d2 = self.store.put_dir(dict(files))
+        self.assertEqual(d1, d2)
+        with open(os.path.join(AssetStore.path(d1), 'css/x.css'), 'rb') as f:
+            self.assertEqual(f.read(), b'body {}')
+        self.store.release(d1)
+        self.store.release(d2)
+        self.assertFalse(os.path.exists(AssetStore.path(d1)))
+
+    def test_stream(self):
+        data = os.urandom(3 * AssetStore.CHUNK_SIZE + 17)
+        key = self.store.put_stream(io.BytesIO(data), len(data), '.jpg')
+        self.assertEqual(key, self.store.put(data, '.jpg'))
+        with open(AssetStore.path(key), 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        with self.assertRaises(Exception):
+            self.store.put_stream(io.BytesIO(data), len(data) + 1)
+        self.assertEqual(len(self.objects()), 1)
+
+    def test_sweep(self):
+        key = self.store.put(b'data')
+        AssetStore().sweep()
+        self.assertEqual(self.objects(), [])
+        self.assertFalse(os.path.exists(AssetStore.path(key)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import struct
+import tempfile
+import unittest
+from screenimage import image_dimensions
+
+
+class ImageDimensionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def dim(self, data, name='image'):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as outfile:
+            outfile.write(data)
+        return image_dimensions(path)
+
+    def test_png(self):
+        data = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + \
+            struct.pack('>II', 1920, 1080) + b'\x08\x06\x00\x00\x00'
+        self.assertEqual(self.dim(data), (1920, 1080))
+
+    def test_gif(self):
+        self.assertEqual(self.dim(b'GIF89a' + struct.pack('<HH', 320, 200)),
+                         (320, 200))
+
+    def test_bmp(self):
+        data = b'BM' + b'\x00' * 12 + struct.pack('<Iii', 40, 640, -480)
+        self.assertEqual(self.dim(data), (640, 480))
+
+    def test_jpeg(self):
+        # SOI, an APP1 segment longer than the initial header read, a
+        # DHT segment, then SOF2
+        app1 = b'\xff\xe1' + struct.pack('>H', 10002) + b'\x00' * 10000
+        dht = b'\xff\xc4' + struct.pack('>H', 4) + b'\x00\x00'
+        sof = b'\xff\xc2' + struct.pack('>HBHH', 17, 8, 3024, 4032)
+        data = b'\xff\xd8' + app1 + dht + sof + b'\x00' * 16
+        self.assertEqual(self.dim(data), (4032, 3024))
+
+    def test_webp(self):
+        riff = b'RIFF' + struct.pack('<I', 100) + b'WEBP'
+        vp8x = riff + b'VP8X' + struct.pack('<I', 10) + b'\x00' * 4 + \
+            (799).to_bytes(3, 'little') + (599).to_bytes(3, 'little')
+        self.assertEqual(self.dim(vp8x), (800, 600))
+        bits = (800 - 1) | ((600 - 1) << 14)
+        vp8l = riff + b'VP8L' + struct.pack('<I', 10) + b'\x2f' + \
+            struct.pack('<I', bits)
+        self.assertEqual(self.dim(vp8l), (800, 600))
+        vp8 = riff + b'VP8 ' + struct.pack('<I', 10) + b'\x00' * 3 + \
+            b'\x9d\x01\x2a' + struct.pack('<HH', 800, 600)
+        self.assertEqual(self.dim(vp8), (800, 600))
+
+    def test_svg(self):
+        self.assertEqual(
+            self.dim(b'<?xml version="1.0"?>\n<svg xmlns="x" width="200px"'
+                     b' height="100">'), (200, 100))
+        self.assertEqual(
+            self.dim(b'<svg viewBox="0 0 300 150" width="100%">'), (300, 150))
+        self.assertEqual(
+            self.dim(b'<svg viewBox="0,0,300,150" width="600">'), (600, 300))
+        self.assertIsNone(self.dim(b'<svg viewBox="0 0 0 150" width="600">'))
+        self.assertIsNone(self.dim(b'<svg viewBox="0 0 300 0" height="50">'))
+
+    def test_unknown(self):
+        self.assertIsNone(self.dim(b'not an image'))
+        self.assertIsNone(self.dim(b'\xff\xd8\xff\xe0\x00'))
+        self.assertIsNone(self.dim(b''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from screenmetrics import Histogram, ItemMetrics
+
+
+class HistogramTests(unittest.TestCase):
+    def test_cumulative(self):
+        hist = Histogram((1, 0.5, 5))
+        for value in (0.1, 0.5, 0.7, 3, 60):
+            hist.observe(value)
+        self.assertEqual(hist.cumulative(),
+                         [(0.5, 2), (1, 3), (5, 4), (float('inf'), 5)])
+        self.assertEqual(hist.count, 5)
+        self.assertAlmostEqual(hist.sum, 64.3)
+
+
+class ItemMetricsTests(unittest.TestCase):
+    def test_exposition(self):
+        metrics = ItemMetrics()
+        metrics.loaded('a', 0.2, nbytes=1000)
+        metrics.loaded('a', 12, ok=False, nbytes=500)
+        metrics.load_timeout('a')
+        metrics.waited('a', 1.5)
+        metrics.shown('a', 9.5, 10)
+        metrics.shown('b"x', 4, 5)
+        lines = metrics.exposition().splitlines()
+        for line in (
+                '# TYPE screen_item_load_seconds histogram',
+                'screen_item_load_seconds_bucket{item="a",le="0.1"} 0',
+                'screen_item_load_seconds_bucket{item="a",le="0.25"} 1',
+                'screen_item_load_seconds_bucket{item="a",le="10"} 1',
+                'screen_item_load_seconds_bucket{item="a",le="+Inf"} 2',
+                'screen_item_load_seconds_sum{item="a"} 12.2',
+                'screen_item_load_seconds_count{item="a"} 2',
+                'screen_item_load_failures_total{item="a"} 1',
+                'screen_item_load_timeouts_total{item="a"} 1',
+                'screen_item_bytes_loaded_total{item="a"} 1500',
+                'screen_item_wait_seconds_total{item="a"} 1.5',
+                'screen_item_shown_seconds_count{item="b\\"x"} 1',
+                'screen_item_display_duration_seconds{item="a"} 10'):
+            self.assertIn(line, lines)
+        # every metric is described, even with no values yet
+        empty = ItemMetrics().exposition().splitlines()
+        self.assertEqual(len(empty), 2 * len(ItemMetrics.METRICS))
+
+
+if __name__ == '__main__':
+    unittest.main()
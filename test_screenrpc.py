@@ -0,0 +1,208 @@
+import base64
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr
+from screencontent import ContentQueue, AssetStore, CACHE_DIR
+from screenrpc import ScreenHTTPServer, MyRequestHandler
+
+
+@unittest.skipUnless(shutil.which('openssl'), "needs openssl for a test cert")
+class RpcTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.certdir = tempfile.TemporaryDirectory()
+        certfile = os.path.join(cls.certdir.name, 'server.pem')
+        subprocess.run(['openssl', 'req', '-new', '-x509', '-days', '1',
+                        '-nodes', '-subj', '/CN=localhost',
+                        '-newkey', 'ec', '-pkeyopt',
+                        'ec_paramgen_curve:prime256v1',
+                        '-out', certfile, '-keyout', certfile],
+                       check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        cls.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        cls.context.load_cert_chain(certfile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.certdir.cleanup()
+
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.q = ContentQueue()
+        self.server = ScreenHTTPServer(('127.0.0.1', 0), MyRequestHandler,
+                                       self.context, self.q, 'pw')
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.conn = http.client.HTTPSConnection(
+            '127.0.0.1', self.server.server_address[1],
+            context=ssl._create_unverified_context())
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.q.shutdown()
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+
+    def request(self, method, path, body=None, headers={}):
+        sep = '&' if '?' in path else '?'
+        self.conn.request(method, path + sep + 'password=pw', body, headers)
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def call(self, method, path, data=None):
+        body = None if data is None else json.dumps(data)
+        response, output = self.request(method, path, body)
+        self.assertEqual(response.status, 200)
+        return json.loads(output.decode('utf8'))
+
+    def objects(self):
+        return os.listdir(os.path.join(CACHE_DIR, AssetStore.OBJECT_DIR))
+
+    def test_staged_upload(self):
+        rdata = self.call('PUT', '/display/my%20page/content?filename=p.html',
+                          '<p>hello</p>')
+        self.assertEqual(rdata['status'], 'success')
+        rdata = self.call('POST', '/display',
+                          {'type': 'html', 'name': 'my page'})
+        self.assertEqual(rdata['status'], 'success')
+        self.assertIn('my page', self.q)
+        self.assertEqual(self.call('GET', '/display/my%20page')['status'],
+                         'success')
+        self.assertEqual(self.call('DELETE', '/display/my%20page')['status'],
+                         'success')
+        self.assertNotIn('my page', self.q)
+
+    def test_missing_upload(self):
+        rdata = self.call('POST', '/display', {'type': 'image', 'name': 'x'})
+        self.assertEqual(rdata['status'], 'failure')
+        self.assertIn('no content', rdata['reason'])
+        self.assertNotIn('x', self.q)
+
+    def test_unclaimed_upload(self):
+        self.call('PUT', '/display/a/content?filename=a.png', 'first')
+        self.call('PUT', '/display/a/content?filename=a.png', 'second')
+        # replaced by the second upload for the same name
+        self.assertEqual(len(self.objects()), 1)
+        self.server.UPLOAD_TIMEOUT = 0
+        self.call('PUT', '/display/b/content?filename=b.png', 'third')
+        # dropped once past the timeout
+        self.assertEqual(len(self.objects()), 1)
+        self.assertEqual(self.call('POST', '/display',
+                                   {'type': 'image', 'name': 'b',
+                                    'filename': 'b.png'})['status'],
+                         'success')
+        rdata = self.call('POST', '/display', {'type': 'image', 'name': 'a'})
+        self.assertEqual(rdata['status'], 'failure')
+
+    def url(self, name, op='add'):
+        return {'op': op, 'type': 'url', 'name': name,
+                'content': base64.b64encode(
+                    'http://cs.colgate.edu/{}'.format(name).encode()).decode()}
+
+    def test_batch(self):
+        self.call('POST', '/display', dict(self.url('a'), op=None))
+        rdata = self.call('POST', '/display/batch', {'operations': [
+            self.url('b'),
+            dict(self.url('a', 'update'), duration=30),
+            {'op': 'delete', 'name': 'x'},
+            {'op': 'add', 'type': 'bogus', 'name': 'c', 'content': ''},
+            {'op': 'frob', 'name': 'd'},
+        ]})
+        # results in request order, whether they failed before or when
+        # being applied to the queue
+        self.assertEqual(rdata['status'], 'failure')
+        self.assertEqual(rdata['reason'], '2 of 5 operations applied')
+        self.assertEqual([ (r['name'], r['op'], r['status'])
+                           for r in rdata['content'] ],
+                         [('b', 'add', 'success'), ('a', 'update', 'success'),
+                          ('x', 'delete', 'failure'), ('c', 'add', 'failure'),
+                          ('d', 'frob', 'failure')])
+        self.assertIn('unknown operation', rdata['content'][4]['reason'])
+        self.assertEqual(self.q.get_content('a').display_duration, 30)
+        self.assertIn('b', self.q)
+
+    def test_batch_atomic(self):
+        for ops in ([self.url('e'), {'op': 'delete', 'name': 'missing'}],
+                    [self.url('e'), {'op': 'frob', 'name': 'f'}]):
+            rdata = self.call('POST', '/display/batch',
+                              {'operations': ops, 'atomic': True})
+            self.assertEqual(rdata['status'], 'failure')
+            self.assertEqual([ r['status'] for r in rdata['content'] ],
+                             ['failure', 'failure'])
+            self.assertNotIn('e', self.q)
+        self.assertEqual(os.listdir(CACHE_DIR), [])
+
+    def test_batch_malformed(self):
+        for body in ('not json', '[1]', '{}', '{"operations": 3}',
+                     '{"operations": [1]}'):
+            response, output = self.request('POST', '/display/batch', body)
+            rdata = json.loads(output.decode('utf8'))
+            self.assertEqual(rdata['status'], 'failure')
+            self.assertIn('malformed', rdata['reason'])
+        # the connection is still usable
+        self.assertEqual(self.call('GET', '/ping')['status'], 'success')
+
+    def test_listing_etag(self):
+        self.call('POST', '/display', dict(self.url('a'), op=None))
+        response, output = self.request('GET', '/display')
+        self.assertEqual(response.status, 200)
+        etag = response.getheader('ETag')
+        response, output = self.request('GET', '/display',
+                                        headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(output, b'')
+
+        # the summary is tagged separately from the full listing
+        response, output = self.request('GET', '/display?summary=1',
+                                        headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.getheader('ETag').endswith('.s"'))
+        self.assertNotEqual(response.getheader('ETag'), etag)
+
+        def changed(change):
+            nonlocal etag
+            change()
+            response, output = self.request('GET', '/display',
+                                            headers={'If-None-Match': etag})
+            self.assertEqual(response.status, 200)
+            self.assertNotEqual(response.getheader('ETag'), etag)
+            etag = response.getheader('ETag')
+            return json.loads(output.decode('utf8'))
+
+        changed(lambda: self.call('POST', '/display', self.url('b')))
+        self.q.next_content().displayed()
+        rdata = changed(
+            lambda: self.q._ContentQueue__flush_stats(background=False))
+        self.assertEqual(sum(c['display_count'] for c in rdata['content']), 1)
+        rdata = changed(lambda: self.call('DELETE', '/display/a'))
+        self.assertEqual([ c['name'] for c in rdata['content'] ], ['b'])
+
+    def test_errors_logged(self):
+        with redirect_stderr(io.StringIO()) as err:
+            # a client hanging up before the handshake isn't an error
+            socket.create_connection(self.server.server_address).close()
+            time.sleep(0.2)
+            self.assertEqual(err.getvalue(), '')
+            # a request that makes a handler raise is
+            with self.assertRaises(http.client.HTTPException):
+                self.request('POST', '/display', 'not json')
+            time.sleep(0.2)
+        self.assertIn('Traceback', err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()